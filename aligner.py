@@ -0,0 +1,310 @@
+"""
+Viterbi forced alignment in-process, as an alternative to HVite -a
+
+Each utterance's word transcription, bounded by the silence word as HVite's
+-b does, becomes a graph of model instances: every pronunciation of every
+word is a path (the training dictionary lists each with an sp and a sil
+ending). With cross-word triphones (FORCECXTEXP in the align config) each
+pronunciation is copied once per pair of neighbouring contexts, so the
+triphone names along any path agree; sp is skipped when finding contexts,
+as HLEd's NB sp does when making the triphone MLF. The graph is folded into
+a baum_welch.Network, Viterbi runs with a beam like HVite's -t, and the
+best path is written as model-level labels, as with HVite -m, with the
+sil/sp merges HLEd applied after HVite.
+"""
+
+import os
+import numpy
+import util, mmf, gmm, archive, baum_welch, mlf
+
+BEAM = 250
+MERGES = [('sil', ['sp', 'sil']), ('sil', ['sil', 'sil']), ('sp', ['sil', 'sil'])]
+
+def load_dict(path):
+    """
+    HTK dictionary: word -> [pronunciations as phone lists]
+    """
+    prons = {}
+    for line in open(path):
+        items = line.split()
+        if not items: continue
+        if len(items) > 1 and items[1].startswith('[') and items[1].endswith(']'): items = items[:1] + items[2:]
+        prons.setdefault(items[0], []).append(items[1:])
+    return prons
+
+def uses_xword(align_config):
+    """
+    Whether an HVite config asks for cross-word context expansion
+    """
+    for line in open(align_config):
+        items = line.replace('=', ' ').split()
+        if len(items) >= 2 and items[0].split(':')[-1] == 'FORCECXTEXP' and items[1].upper() == 'T': return True
+    return False
+
+def edge_contexts(pron):
+    """
+    Context a pronunciation gives the word before it and the word after
+    it: its first and last phones other than sp
+    """
+    phones = [p for p in pron if p != 'sp']
+    if not phones: return None, None
+    return phones[0], phones[-1]
+
+def model_names(pron, left, right, free=('sp', 'sil')):
+    """
+    Logical model names of a pronunciation between the contexts left and
+    right (None for monophones); phones in free take no context
+    """
+    if left is None and right is None: return list(pron)
+    contexts = []
+    for n, phone in enumerate(pron):
+        l = left
+        for p in reversed(pron[:n]):
+            if p != 'sp':
+                l = p
+                break
+        r = right
+        for p in pron[n+1:]:
+            if p != 'sp':
+                r = p
+                break
+        contexts.append((l, r))
+    names = []
+    for phone, (l, r) in zip(pron, contexts):
+        if phone in free: names.append(phone)
+        else: names.append('%s%s%s' %(l and l + '-' or '', phone, r and '+' + r or ''))
+    return names
+
+def build_graph(words, prons, xword, boundary='silence'):
+    """
+    Model instances of an utterance: (logical names, word label of each
+    instance or None, successor lists, start instances, end instances).
+    Raises KeyError for a word missing from the dictionary.
+    """
+
+    slots = [prons[word] for word in [boundary] + words + [boundary]]
+    labels = [boundary] + words + [boundary]
+    names, word_of, succ = [], [], []
+
+    ## Copies of each pronunciation keyed by (left context, right context)
+    copies = []
+    for s, slot in enumerate(slots):
+        lefts = rights = [None]
+        if xword and s > 0: lefts = sorted(set([edge_contexts(p)[1] for p in slots[s-1]]))
+        if xword and s < len(slots) - 1: rights = sorted(set([edge_contexts(p)[0] for p in slots[s+1]]))
+        slot_copies = []
+        for k, pron in enumerate(slot):
+            for left in lefts:
+                for right in rights:
+                    first = len(names)
+                    for n, name in enumerate(model_names(pron, left, right)):
+                        names.append(name)
+                        word_of.append(n == 0 and labels[s] or None)
+                        succ.append([len(names)] if n < len(pron) - 1 else [])
+                    slot_copies.append((k, left, right, first, len(names) - 1))
+        copies.append(slot_copies)
+
+    ## Link copies whose contexts agree with their neighbours
+    for s in range(len(slots) - 1):
+        for k, left, right, first, last in copies[s]:
+            for k2, left2, right2, first2, last2 in copies[s+1]:
+                if xword and (right != edge_contexts(slots[s+1][k2])[0] or left2 != edge_contexts(slots[s][k])[1]): continue
+                succ[last].append(first2)
+
+    starts = [first for k, left, right, first, last in copies[0]]
+    ends = [last for k, left, right, first, last in copies[-1]]
+    return names, word_of, succ, starts, ends
+
+def viterbi(net, log_b, beam):
+    """
+    Best path through net given log emission likelihoods (frames x
+    composite states), pruning states more than beam below the best at
+    each frame. Returns None if no path survives, otherwise (state of each
+    frame, arc into each frame, start arc, end arc, cumulative log
+    likelihood of each frame).
+    """
+
+    T, Q = log_b.shape
+    A = len(net.src)
+    with numpy.errstate(divide='ignore'):
+        log_prob = numpy.append(numpy.log(net.prob), -numpy.inf)
+        start_prob = numpy.log(net.start_prob)
+        end_prob = numpy.log(net.end_prob)
+    src = numpy.append(net.src, 0)
+
+    ## Incoming arcs of each state, padded with a dummy arc A
+    order = numpy.argsort(net.dst, kind='mergesort')
+    counts = numpy.bincount(net.dst, minlength=Q)
+    width = max(1, counts.max())
+    incoming = numpy.empty((Q, width), dtype=numpy.int64)
+    incoming.fill(A)
+    rank = numpy.arange(A) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    incoming[net.dst[order], rank] = order
+    rows = numpy.arange(Q)
+
+    delta = numpy.empty(Q)
+    delta.fill(-numpy.inf)
+    start_arc = numpy.empty(Q, dtype=numpy.int64)
+    start_arc.fill(-1)
+    for n in numpy.argsort(start_prob):
+        delta[net.start_dst[n]] = start_prob[n]
+        start_arc[net.start_dst[n]] = n
+    back = numpy.empty((T, Q), dtype=numpy.int32)
+    best = numpy.empty((T, Q))
+    for t in range(T):
+        if t > 0:
+            scores = (delta[src] + log_prob)[incoming]
+            arc = scores.argmax(axis=1)
+            delta = scores[rows, arc]
+            back[t] = incoming[rows, arc]
+        delta = delta + log_b[t]
+        top = delta.max()
+        if top == -numpy.inf: return None
+        delta[delta < top - beam] = -numpy.inf
+        best[t] = delta
+
+    final = delta[net.end_src] + end_prob
+    if not len(final) or final.max() == -numpy.inf: return None
+    end_arc = int(final.argmax())
+
+    path = numpy.empty(T, dtype=numpy.int64)
+    arcs = numpy.empty(T, dtype=numpy.int64)
+    q = net.end_src[end_arc]
+    for t in range(T - 1, 0, -1):
+        path[t] = q
+        arcs[t] = back[t][q]
+        q = src[arcs[t]]
+    path[0] = q
+    arcs[0] = -1
+    score = best[numpy.arange(T), path]
+    score[-1] += end_prob[end_arc]
+    return path, arcs, start_arc[q], end_arc, score
+
+def tee_score(net, m):
+    A = net.hmmset.transps[net.hmmset.hmms[net.hmms[m]].transp].matrix
+    return float(numpy.log(A[0, len(A) - 1]))
+
+def best_labels(net, names, word_of, result):
+    """
+    Model-level labels of a Viterbi path: [start frame, end frame
+    (exclusive), logical name, log likelihood, word or None]. Skipped tee
+    models get zero-length labels.
+    """
+
+    path, arcs, start_arc, end_arc, score = result
+    T = len(path)
+    labels = []
+    def add_tees(skips, t):
+        total = 0.0
+        for m in skips:
+            labels.append([t, t, names[m], tee_score(net, m), word_of[m]])
+            total += labels[-1][3]
+        return total
+
+    last_score = add_tees(net.start_skips[start_arc], 0)
+    segment_start = 0
+    for t in range(1, T + 1):
+        if t < T and net.model[path[t]] == net.model[path[t-1]] and not net.arc_skips[arcs[t]]: continue
+        m = net.model[path[t-1]]
+        labels.append([segment_start, t, names[m], score[t-1] - last_score, word_of[m]])
+        last_score = score[t-1]
+        if t < T: last_score += add_tees(net.arc_skips[arcs[t]], t)
+        segment_start = t
+    add_tees(net.end_skips[end_arc], T)
+    return labels
+
+def merge_labels(labels, merges=MERGES):
+    """
+    HLEd's ME: replace each run of labels matching a pattern with one label
+    """
+    for name, pattern in merges:
+        merged = []
+        for label in labels:
+            merged.append(label)
+            if len(merged) < len(pattern): continue
+            tail = merged[-len(pattern):]
+            if [l[2] for l in tail] != pattern: continue
+            word = ([l[4] for l in tail if l[4]] + [None])[0]
+            del merged[-len(pattern):]
+            merged.append([tail[0][0], tail[-1][1], name, sum([l[3] for l in tail]), word])
+        labels = merged
+    return labels
+
+def align_utt(hmmset, lookup, offsets, words, prons, xword, frames, beam):
+    """
+    Labels of one utterance, or None if it can't be aligned
+    """
+    try: names, word_of, succ, starts, ends = build_graph(words, prons, xword)
+    except KeyError: return None
+    try: hmms = [lookup[name] for name in names]
+    except KeyError: return None
+    net = baum_welch.Network(hmmset, hmms, offsets, succ, starts, ends)
+
+    unique, inverse = numpy.unique(net.states, return_inverse=True)
+    scorer = gmm.Scorer(hmmset, states=unique, dtype=numpy.float64)
+    log_b = scorer.state_loglik(numpy.asarray(frames, dtype=numpy.float64))[:, inverse]
+    result = viterbi(net, log_b, beam)
+    if result is None: return None
+    return merge_labels(best_labels(net, names, word_of, result))
+
+def format_labels(labels, period):
+    """
+    MLF lines of labels, times in HTK units of period
+    """
+    lines = []
+    for start, end, name, score, word in labels:
+        lines.append('%d %d %s %f' %(start * period, end * period, name, score))
+        if word: lines[-1] += ' %s' %word
+    return lines
+
+def align_split(job):
+    """
+    Worker: align the utterances of one mfc list split, writing their
+    labels to an MLF; returns (MLF, utterances aligned, failed)
+    """
+
+    model_dir, word_mlf, dict, xword, mfc_list, data_dir, period, beam, output = job
+    hmmset = mmf.load_compiled(model_dir)
+    offsets = baum_welch.transp_offsets(hmmset)
+    lookup = baum_welch.hmm_lookup(hmmset)
+    prons = load_dict(dict)
+    features = archive.FeatureSource(data_dir)
+    mfcs = [line.strip() for line in open(mfc_list) if line.strip()]
+    words = mlf.MLF(word_mlf).labels([archive.utt_id(mfc) for mfc in mfcs])
+
+    aligned = failed = 0
+    writer = mlf.Writer(output)
+    for mfc in mfcs:
+        utt = archive.utt_id(mfc)
+        labels = None
+        if utt in words: labels = align_utt(hmmset, lookup, offsets, words[utt], prons, xword, features.get(mfc), beam)
+        if labels is None:
+            failed += 1
+            continue
+        writer.write('*/%s.lab' %utt, format_labels(labels, period))
+        aligned += 1
+    writer.close()
+    return output, aligned, failed
+
+def run(model, model_dir, inputs, word_mlf, new_mlf, model_list, dict, align_config, beam=BEAM):
+    """
+    Align the mfc list splits in inputs with the model in model_dir,
+    writing the phone MLF new_mlf. Returns (aligned, failed), or None,
+    having done nothing, if the model needs HVite.
+    """
+
+    hmmset = mmf.load('%s/MMF' %model_dir)
+    if not baum_welch.supported(hmmset): return None
+    output_dir = os.path.dirname(inputs[0])
+    compiled = mmf.compile('%s/MMF' %model_dir, model_list, model.model_cache, hmmset)
+
+    period = int(round(model.frame_length * 10000))
+    xword = uses_xword(align_config)
+    mlf.load_index(word_mlf)
+    jobs = [(compiled, word_mlf, dict, xword, input, model.data, period, beam, input.replace('mfc.list', 'align.output'))
+            for input in inputs]
+    njobs = 1 if model.local == 1 else model.jobs
+    results = util.map_parallel(align_split, jobs, njobs)
+
+    mlf.merge([r[0] for r in results], new_mlf)
+    return sum([r[1] for r in results]), sum([r[2] for r in results])
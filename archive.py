@@ -0,0 +1,200 @@
+"""
+Packed feature archives: every utterance's features appended to a few large
+files, with an index keyed by the path of the utterance's HTK file relative
+to the data directory (without the extension), so files with the same name
+in different directories are kept apart
+
+<prefix>.index   one line per utterance:
+                 <key> <ark number> <byte offset> <frames> <dim> <kind> <period>
+<prefix>.<n>.ark little-endian float32 frames, back to back
+
+Later index lines override earlier ones for the same id, so updating an
+archive only appends. Readers get memory-mapped slices, and export writes
+ordinary HTK parameter files for tools that need them.
+"""
+
+import os
+import numpy
+import htk_param
+
+MAX_ARK_BYTES = 2 ** 31
+
+def utt_id(path):
+    """
+    Utterance id as the MLFs name it, e.g. .../011/011c0201.mfc -> 011c0201
+    """
+    return os.path.basename(path).split('.')[0]
+
+def utt_key(path, root):
+    """
+    Archive key of an HTK file: its path relative to root without the
+    extension, e.g. <root>/011/011c0201.mfc -> 011/011c0201
+    """
+    path, root = os.path.abspath(path), os.path.abspath(root)
+    if path.startswith(root + os.sep): path = path[len(root) + 1:]
+    return os.path.splitext(path)[0]
+
+def get_prefix(data_dir):
+    return '%s/feats' %data_dir
+
+def get_root(prefix):
+    return os.path.dirname(prefix) or '.'
+
+def load_index(prefix):
+    index = {}
+    path = '%s.index' %prefix
+    if not os.path.isfile(path): return index
+    for line in open(path):
+        items = line.split()
+        if len(items) != 7: continue
+        index[items[0]] = tuple(map(int, items[1:]))
+    return index
+
+class ArchiveWriter:
+    """
+    Append utterances to an archive; call close() to flush the index
+    """
+
+    def __init__(self, prefix, max_bytes=MAX_ARK_BYTES):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        dir = os.path.dirname(prefix)
+        if dir and not os.path.isdir(dir): os.makedirs(dir)
+
+        ## Continue in the last ark file
+        self.ark = 0
+        while os.path.isfile(self.ark_file(self.ark + 1)): self.ark += 1
+        self.fh = open(self.ark_file(self.ark), 'ab')
+        self.index_fh = open('%s.index' %prefix, 'a')
+
+    def ark_file(self, ark):
+        return '%s.%d.ark' %(self.prefix, ark)
+
+    def add(self, utt, frames, kind, period):
+        frames = numpy.asarray(frames, dtype='<f4')
+        if frames.ndim == 1: frames = frames.reshape((-1, 1))
+        data = frames.tostring()
+
+        self.fh.seek(0, 2)
+        if self.fh.tell() > 0 and self.fh.tell() + len(data) > self.max_bytes:
+            self.fh.close()
+            self.ark += 1
+            self.fh = open(self.ark_file(self.ark), 'ab')
+        offset = self.fh.tell()
+        self.fh.write(data)
+        self.index_fh.write('%s %d %d %d %d %d %d\n' %(utt, self.ark, offset, frames.shape[0],
+                                                      frames.shape[1], kind, period))
+
+    def close(self):
+        self.fh.close()
+        self.index_fh.close()
+
+class Archive:
+    """
+    Read access to an archive
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.root = get_root(prefix)
+        self.index = load_index(prefix)
+        self.maps = {}
+
+    def __contains__(self, utt):
+        return utt in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def header(self, utt):
+        ark, offset, frames, dim, kind, period = self.index[utt]
+        return htk_param.Header(frames, period, 4 * dim, kind)
+
+    def get(self, utt):
+        """
+        Frames of one utterance as a read-only view of the memory-mapped ark
+        """
+        ark, offset, frames, dim, kind, period = self.index[utt]
+        if ark not in self.maps:
+            self.maps[ark] = numpy.memmap('%s.%d.ark' %(self.prefix, ark), dtype='<f4', mode='r')
+        start = offset / 4
+        return self.maps[ark][start:start + frames * dim].reshape((frames, dim))
+
+    def export(self, utt, path, compressed=False, crc=False):
+        """
+        Materialise one utterance as an HTK parameter file
+        """
+        header = self.header(utt)
+        htk_param.write(path, self.get(utt), header.kind, header.period, compressed, crc)
+        return path
+
+    def export_list(self, mfc_list, output_dir, new_list):
+        """
+        Export every utterance in mfc_list under output_dir and write the
+        exported paths to new_list
+        """
+        fh = open(new_list, 'w')
+        for line in open(mfc_list):
+            utt = utt_key(line.strip(), self.root)
+            if utt not in self.index: continue
+            path = '%s/%s.mfc' %(output_dir, utt)
+            if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+            fh.write('%s\n' %self.export(utt, path))
+        fh.close()
+
+def pack(mfcs, prefix, replace=()):
+    """
+    Add HTK parameter files to an archive: any not yet in it, plus those
+    listed in replace (e.g. just recoded). Returns the number added.
+    """
+
+    root = get_root(prefix)
+    index = load_index(prefix)
+    replace = set([utt_key(mfc, root) for mfc in replace])
+    writer = ArchiveWriter(prefix)
+    count = 0
+    for mfc in mfcs:
+        utt = utt_key(mfc, root)
+        if utt in index and utt not in replace: continue
+        if not os.path.isfile(mfc): continue
+        header, frames = htk_param.read(mfc)
+        writer.add(utt, frames, header.kind & ~(htk_param.HAS_COMPRESSION | htk_param.HAS_CRC), header.period)
+        count += 1
+    writer.close()
+    return count
+
+class FeatureSource:
+    """
+    Features by mfc path: from the data directory's archive when the
+    utterance is packed there, otherwise from the HTK file itself
+    """
+
+    def __init__(self, data_dir):
+        self.archive = None
+        prefix = get_prefix(data_dir)
+        if os.path.isfile('%s.index' %prefix): self.archive = Archive(prefix)
+
+    def get(self, mfc):
+        if self.archive is not None:
+            utt = utt_key(mfc, self.archive.root)
+            if utt in self.archive: return self.archive.get(utt)
+        return htk_param.read(mfc)[1]
+
+if __name__ == '__main__':
+
+    import sys
+    usage = 'Usage: python %s pack <data dir> <mfc list>\n' %sys.argv[0]
+    usage += '       python %s export <data dir> <mfc list> <output dir> <new mfc list>\n' %sys.argv[0]
+    if len(sys.argv) < 4 or sys.argv[1] not in ['pack', 'export']:
+        sys.stderr.write(usage)
+        sys.exit()
+
+    prefix = get_prefix(sys.argv[2])
+    if sys.argv[1] == 'pack':
+        mfcs = [line.strip() for line in open(sys.argv[3]) if line.strip()]
+        print 'packed [%d] files into [%s]' %(pack(mfcs, prefix), prefix)
+    else:
+        Archive(prefix).export_list(sys.argv[3], sys.argv[4], sys.argv[5])
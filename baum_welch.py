@@ -0,0 +1,495 @@
+"""
+Embedded Baum-Welch training in-process, as an alternative to HERest
+
+Each utterance's labels are joined into a composite HMM whose states are the
+emitting states of the label models. The entry, exit and tee (skip)
+transitions of each model are folded into arcs between emitting states, so
+an optional sp simply adds arcs that jump over it. Forward-backward follows
+HERest: a pruned backward pass with beam -t <thresh> (widened by <inc> up to
+<limit> when no path survives), then a forward pass restricted to the states
+the backward pass kept.
+
+Accumulators hold, per Gaussian, the occupancy and first and second order
+sums (optionally full second order sums, stored as the upper triangle like
+HTK's, for semi-tied transforms), plus
+state occupancies and transition counts. They are saved as .npz
+files so the splits can run in separate processes, then summed as a tree of
+parallel k-way merges; update() is the M-step.
+"""
+
+import os, time
+import numpy
+import util, mmf, gmm, archive, mlf
+
+MIN_MIX = 1e-5
+PRUNE_THRESH = 250
+PRUNE_INC = 150
+PRUNE_LIMIT = 2000
+MERGE_FANIN = 4
+LOG_RANGE = 700.0
+ACC_ARRAYS = ['occ', 'first', 'second', 'full', 'state_occ', 'trans', 'hmm_count']
+
+def get_beams(thresh=PRUNE_THRESH, inc=PRUNE_INC, limit=PRUNE_LIMIT):
+    beams = [thresh]
+    while inc > 0 and beams[-1] + inc <= limit: beams.append(beams[-1] + inc)
+    return beams
+
+def transp_offsets(hmmset):
+    """
+    Start of each transition matrix in a flat array of all of them
+    """
+    sizes = [len(transp.matrix) ** 2 for transp in hmmset.transps]
+    return numpy.concatenate([[0], numpy.cumsum(sizes)]).astype(numpy.int64)
+
+def hmm_lookup(hmmset):
+    """
+    Logical model name -> physical HMM index
+    """
+    lookup = dict([(hmm.name, index) for index, hmm in enumerate(hmmset.hmms)])
+    for logical, physical in hmmset.hmm_list:
+        lookup[logical] = hmmset.hmm_names[physical]
+    return lookup
+
+class Network:
+    """
+    Composite HMM over model instances (HMM indices), by default a
+    sequence; succ, starts and ends give a graph of instances instead
+    (successors of each, and those that may begin or end the utterance).
+    Composite state q is emitting state pos[q] (1-based within its model,
+    as in HTK minus the entry state) of instance model[q]; states[q] is its
+    physical state. Arcs go src -> dst with probability prob; start and end
+    arcs enter from and leave to the utterance boundaries. Each arc also
+    records the HTK transitions it crosses as indices into the flat
+    transition array, and the tee instances it skips.
+    """
+
+    def __init__(self, hmmset, hmms, offsets, succ=None, starts=None, ends=None):
+        self.hmmset = hmmset
+        self.hmms = hmms
+        self.offsets = offsets
+        if succ is None:
+            succ = [[m + 1] for m in range(len(hmms) - 1)] + [[]]
+            starts, ends = [0], [len(hmms) - 1]
+        self.succ = succ
+        self.ends = set(ends)
+        matrices = [hmmset.transps[hmmset.hmms[h].transp].matrix for h in hmms]
+
+        ## Composite states
+        self.first = []
+        states, model, pos = [], [], []
+        for m, h in enumerate(hmms):
+            self.first.append(len(states))
+            for i, state in enumerate(hmmset.hmms[h].states):
+                states.append(state)
+                model.append(m)
+                pos.append(i + 1)
+        self.states = numpy.array(states, dtype=numpy.int64)
+        self.model = numpy.array(model, dtype=numpy.int64)
+        self.pos = numpy.array(pos, dtype=numpy.int64)
+
+        arcs, start_arcs, end_arcs = [], [], []
+        for dst, prob, trans, skips in self.follow(matrices, starts, 1.0, [], []):
+            if dst is not None: start_arcs.append((dst, prob, trans, skips))
+        for m, A in enumerate(matrices):
+            N = len(A)
+            for i in range(1, N - 1):
+                src = self.first[m] + i - 1
+                for j in range(1, N - 1):
+                    if A[i,j] > 0: arcs.append((src, self.first[m] + j - 1, A[i,j], [self.flat(m, i, j)], []))
+                if A[i,N-1] <= 0: continue
+                out = [self.flat(m, i, N - 1)]
+                if m in self.ends: end_arcs.append((src, A[i,N-1], out, []))
+                for dst, prob, trans, skips in self.follow(matrices, succ[m], A[i,N-1], out, []):
+                    if dst is None: end_arcs.append((src, prob, trans, skips))
+                    else: arcs.append((src, dst, prob, trans, skips))
+        starts, ends = start_arcs, end_arcs
+
+        self.src = numpy.array([arc[0] for arc in arcs], dtype=numpy.int64)
+        self.dst = numpy.array([arc[1] for arc in arcs], dtype=numpy.int64)
+        self.prob = numpy.array([arc[2] for arc in arcs], dtype=numpy.float64)
+        self.start_dst = numpy.array([arc[0] for arc in starts], dtype=numpy.int64)
+        self.start_prob = numpy.array([arc[1] for arc in starts], dtype=numpy.float64)
+        self.end_src = numpy.array([arc[0] for arc in ends], dtype=numpy.int64)
+        self.end_prob = numpy.array([arc[1] for arc in ends], dtype=numpy.float64)
+        self.arc_skips = [arc[4] for arc in arcs]
+        self.start_skips = [arc[3] for arc in starts]
+        self.end_skips = [arc[3] for arc in ends]
+
+        ## Flattened (arc, transition) pairs for accumulating counts
+        def pairs(arc_list, trans_index):
+            arc_ids = [n for n, arc in enumerate(arc_list) for t in arc[trans_index]]
+            flat = [t for arc in arc_list for t in arc[trans_index]]
+            return numpy.array(arc_ids, dtype=numpy.int64), numpy.array(flat, dtype=numpy.int64)
+        self.arc_trans = pairs(arcs, 3)
+        self.start_trans = pairs(starts, 2)
+        self.end_trans = pairs(ends, 2)
+
+    def flat(self, m, i, j):
+        hmm = self.hmmset.hmms[self.hmms[m]]
+        return self.offsets[hmm.transp] + i * hmm.num_states() + j
+
+    def follow(self, matrices, instances, prob, trans, skips):
+        """
+        Destinations reachable on entering any of instances, passing
+        through tee models: (composite state or None for the end, prob,
+        transitions crossed, tee instances skipped)
+        """
+        targets = []
+        for m in instances:
+            A = matrices[m]
+            N = len(A)
+            for j in range(1, N - 1):
+                if A[0,j] > 0: targets.append((self.first[m] + j - 1, prob * A[0,j], trans + [self.flat(m, 0, j)], skips))
+            if A[0,N-1] <= 0: continue
+            tee_prob = prob * A[0,N-1]
+            tee_trans = trans + [self.flat(m, 0, N - 1)]
+            if m in self.ends: targets.append((None, tee_prob, tee_trans, skips + [m]))
+            targets.extend(self.follow(matrices, self.succ[m], tee_prob, tee_trans, skips + [m]))
+        return targets
+
+    def num_states(self):
+        return len(self.states)
+
+def reachable(net, T):
+    """
+    Composite states each frame can be in on some complete path through
+    the network, ignoring the emissions: frames x states booleans
+    """
+    Q = net.num_states()
+    fwd = numpy.zeros((T, Q), dtype=bool)
+    bwd = numpy.zeros((T, Q), dtype=bool)
+    fwd[0][net.start_dst] = True
+    bwd[T-1][net.end_src] = True
+    for t in range(1, T):
+        fwd[t] = numpy.bincount(net.dst, weights=fwd[t-1][net.src], minlength=Q) > 0
+        bwd[T-1-t] = numpy.bincount(net.src, weights=bwd[T-t][net.dst], minlength=Q) > 0
+    return fwd & bwd
+
+def forward_backward(net, b, beam):
+    """
+    b holds the emission likelihoods of each composite state, frames x
+    states, scaled per frame. Returns None if no path survives the beam,
+    otherwise (state posteriors, arc counts, start arc counts, end arc
+    counts, log likelihood excluding the emission scaling).
+    """
+
+    T, Q = b.shape
+    min_ratio = numpy.exp(-beam)
+
+    ## Pruned backward pass, each frame scaled to a maximum of 1
+    beta = numpy.zeros((T, Q))
+    scale = numpy.ones(T)
+    beta[T-1][net.end_src] = net.end_prob
+    for t in range(T - 1, -1, -1):
+        if t < T - 1:
+            beta[t] = numpy.bincount(net.src, weights=net.prob * (b[t+1] * beta[t+1])[net.dst], minlength=Q)
+        scale[t] = beta[t].max()
+        if scale[t] <= 0: return None
+        beta[t] /= scale[t]
+        beta[t][beta[t] < min_ratio] = 0
+
+    ## Forward pass over the surviving states
+    alpha = numpy.zeros((T, Q))
+    norm = numpy.zeros(T)
+    for t in range(T):
+        if t == 0: alpha[0] = numpy.bincount(net.start_dst, weights=net.start_prob, minlength=Q)
+        else: alpha[t] = numpy.bincount(net.dst, weights=net.prob * alpha[t-1][net.src], minlength=Q)
+        alpha[t] *= b[t]
+        alpha[t][beta[t] == 0] = 0
+        norm[t] = alpha[t].sum()
+        if norm[t] <= 0: return None
+        alpha[t] /= norm[t]
+    end = (alpha[T-1][net.end_src] * net.end_prob).sum()
+    if end <= 0: return None
+    log_lik = numpy.log(norm).sum() + numpy.log(end)
+
+    occ = alpha * beta
+    total = occ.sum(axis=1)
+    occ /= total[:,numpy.newaxis]
+
+    ## Expected arc counts: alpha_t(src) a b_t+1(dst) beta_t+1(dst), normalised
+    arc_counts = numpy.zeros(len(net.src))
+    if T > 1 and len(net.src):
+        weight = (b[1:] * beta[1:])[:, net.dst] * alpha[:-1][:, net.src]
+        arc_counts = numpy.dot(1.0 / (total[:-1] * scale[:-1]), weight) * net.prob
+    start_counts = occ[0][net.start_dst]
+    end_counts = alpha[T-1][net.end_src] * net.end_prob / end
+    return occ, arc_counts, start_counts, end_counts, log_lik
+
+class Accumulator:
+    """
+    Sufficient statistics for re-estimating an HMMSet
+    """
+
+    def __init__(self, hmmset=None, full=False):
+        self.occ = self.first = self.second = self.full = self.state_occ = self.trans = self.hmm_count = None
+        self.log_lik = 0.0
+        self.frames = 0
+        self.utts = 0
+        self.failed = 0
+        if hmmset is not None:
+            G, D = hmmset.num_gaussians(), hmmset.vec_size
+            self.occ = numpy.zeros(G)
+            self.first = numpy.zeros((G, D))
+            self.second = numpy.zeros((G, D))
+            if full: self.full = numpy.zeros((G, D * (D + 1) / 2))
+            self.state_occ = numpy.zeros(hmmset.num_states())
+            self.trans = numpy.zeros(transp_offsets(hmmset)[-1])
+            self.hmm_count = numpy.zeros(len(hmmset.hmms), dtype=numpy.int64)
+
+    def add(self, other):
+        for key in ACC_ARRAYS:
+            if other.__dict__[key] is None: continue
+            if self.__dict__[key] is None: self.__dict__[key] = other.__dict__[key].copy()
+            else: self.__dict__[key] += other.__dict__[key]
+        for key in ['log_lik', 'frames', 'utts', 'failed']:
+            self.__dict__[key] += other.__dict__[key]
+
+    def save(self, path):
+        arrays = dict([(key, self.__dict__[key]) for key in ACC_ARRAYS if self.__dict__[key] is not None])
+        arrays['totals'] = numpy.array([self.log_lik, self.frames, self.utts, self.failed])
+        fh = open(path, 'wb')
+        numpy.savez(fh, **arrays)
+        fh.close()
+
+def load_accumulator(path):
+    data = numpy.load(path)
+    acc = Accumulator()
+    for key in ACC_ARRAYS:
+        if key in data.files: acc.__dict__[key] = data[key]
+    totals = data['totals']
+    acc.log_lik = float(totals[0])
+    acc.frames, acc.utts, acc.failed = int(totals[1]), int(totals[2]), int(totals[3])
+    return acc
+
+def merge_files(job):
+    """
+    Worker: sum a group of accumulator files into one, removing the inputs
+    """
+    acc_files, output = job
+    acc = Accumulator()
+    for acc_file in acc_files:
+        acc.add(load_accumulator(acc_file))
+        os.remove(acc_file)
+    acc.save(output)
+    return output
+
+def tree_merge(acc_files, output_dir, njobs, fanin=MERGE_FANIN):
+    """
+    Merge accumulator files as a tree: each level sums groups of fanin
+    files in parallel until few enough remain to sum here. Returns the
+    accumulator, the number of levels and the total bytes read.
+    """
+
+    level = 0
+    bytes_read = 0
+    while len(acc_files) > fanin:
+        bytes_read += util.file_bytes(acc_files)
+        jobs = [(acc_files[i:i+fanin], '%s/merge.%d.%d.acc.npz' %(output_dir, level, i / fanin))
+                for i in range(0, len(acc_files), fanin)]
+        acc_files = util.map_parallel(merge_files, jobs, njobs)
+        level += 1
+
+    bytes_read += util.file_bytes(acc_files)
+    acc = Accumulator()
+    for acc_file in acc_files:
+        acc.add(load_accumulator(acc_file))
+        os.remove(acc_file)
+    return acc, level + 1, bytes_read
+
+def accumulate_utt(acc, hmmset, net, frames, beams):
+    """
+    Add one utterance's statistics to acc; returns False if it has no
+    frames or could not be aligned within the widest beam
+    """
+
+    frames = numpy.asarray(frames, dtype=numpy.float64)
+    if len(frames) == 0: return False
+    unique, inverse = numpy.unique(net.states, return_inverse=True)
+    scorer = gmm.Scorer(hmmset, states=unique, dtype=numpy.float64)
+    comp_ll = scorer.gaussian_loglik(frames)
+    state_ll = scorer.combine(comp_ll.copy())
+
+    ## Emissions scaled per frame by the best state, or where that leaves
+    ## states below exp's range, by the best state a complete path can be
+    ## in at that frame; whatever is still further below is clamped
+    net_ll = state_ll[:, inverse]
+    peak = state_ll.max(axis=1)
+    if (state_ll.min(axis=1) - peak).min() < -LOG_RANGE:
+        mask = reachable(net, len(frames))
+        ok = mask.any(axis=1)
+        peak[ok] = numpy.where(mask, net_ll, -numpy.inf).max(axis=1)[ok]
+    b = numpy.exp(numpy.clip(net_ll - peak[:,numpy.newaxis], -LOG_RANGE, 0))
+
+    result = None
+    for beam in beams:
+        result = forward_backward(net, b, beam)
+        if result is not None: break
+    if result is None: return False
+    occ, arc_counts, start_counts, end_counts, log_lik = result
+
+    ## Occupancy of each distinct state, then of its components
+    to_unique = numpy.zeros((net.num_states(), len(unique)))
+    to_unique[numpy.arange(net.num_states()), inverse] = 1
+    state_occ = numpy.dot(occ, to_unique)
+    post = numpy.exp(comp_ll - numpy.repeat(state_ll, scorer.sizes, axis=1))
+    post *= numpy.repeat(state_occ, scorer.sizes, axis=1)
+
+    g = scorer.gaussians
+    acc.occ[g] += post.sum(axis=0)
+    acc.first[g] += numpy.dot(post.T, frames)
+    acc.second[g] += numpy.dot(post.T, frames * frames)
+    if acc.full is not None:
+        i, j = numpy.triu_indices(frames.shape[1])
+        acc.full[g] += numpy.dot(post.T, frames[:,i] * frames[:,j])
+    acc.state_occ[unique] += state_occ.sum(axis=0)
+    for counts, (arc_ids, flat) in [(arc_counts, net.arc_trans), (start_counts, net.start_trans),
+                                    (end_counts, net.end_trans)]:
+        numpy.add.at(acc.trans, flat, counts[arc_ids])
+    numpy.add.at(acc.hmm_count, net.hmms, 1)
+    acc.log_lik += log_lik + peak.sum()
+    acc.frames += len(frames)
+    return True
+
+def accumulate_split(job):
+    """
+    Worker: accumulate over the utterances of one mfc list split and save
+    the accumulator; full adds full second order sums
+    """
+
+    model_dir, mlf_file, mfc_list, data_dir, beams, full, acc_file = job
+    hmmset = mmf.load_compiled(model_dir)
+    offsets = transp_offsets(hmmset)
+    lookup = hmm_lookup(hmmset)
+    features = archive.FeatureSource(data_dir)
+    mfcs = [line.strip() for line in open(mfc_list) if line.strip()]
+    labels = mlf.MLF(mlf_file).labels([archive.utt_id(mfc) for mfc in mfcs])
+
+    acc = Accumulator(hmmset, full)
+    for mfc in mfcs:
+        utt = archive.utt_id(mfc)
+        if utt not in labels or not labels[utt]:
+            acc.failed += 1
+            continue
+        try: hmms = [lookup[label] for label in labels[utt]]
+        except KeyError:
+            acc.failed += 1
+            continue
+        net = Network(hmmset, hmms, offsets)
+        if accumulate_utt(acc, hmmset, net, features.get(mfc), beams): acc.utts += 1
+        else: acc.failed += 1
+    acc.save(acc_file)
+    return acc_file
+
+def update(hmmset, acc):
+    """
+    M-step: new means, variances (floored by varFloor1 if the model has
+    one), mixture weights and transition matrices. Parameters with no
+    occupancy keep their old values.
+    """
+
+    occ = acc.occ
+    ok = occ > 0
+    means = hmmset.means.copy()
+    vars = hmmset.vars.copy()
+    means[ok] = acc.first[ok] / occ[ok][:,numpy.newaxis]
+    vars[ok] = acc.second[ok] / occ[ok][:,numpy.newaxis] - means[ok] ** 2
+    floor = hmmset.var_floors.get('varFloor1')
+    if floor is not None: vars = numpy.maximum(vars, floor)
+    vars = numpy.maximum(vars, 1e-10)
+
+    weights = hmmset.weights.copy()
+    states = hmmset.gaussian_states()
+    state_total = numpy.bincount(states, weights=occ, minlength=hmmset.num_states())
+    has_occ = state_total[states] > 0
+    weights[has_occ] = numpy.maximum(occ[has_occ] / state_total[states][has_occ], MIN_MIX)
+    weights /= numpy.bincount(states, weights=weights, minlength=hmmset.num_states())[states]
+    hmmset.set_state_sizes(hmmset.num_mixes(), means, vars, weights)
+
+    offsets = transp_offsets(hmmset)
+    for index, transp in enumerate(hmmset.transps):
+        N = len(transp.matrix)
+        counts = acc.trans[offsets[index]:offsets[index+1]].reshape((N, N))
+        for i in range(N):
+            if counts[i].sum() > 0: transp.matrix[i] = counts[i] / counts[i].sum()
+
+def write_stats(hmmset, acc, path):
+    """
+    State occupation statistics in the format of HERest -s, for HHEd RO
+    """
+    fh = open(path, 'w')
+    for index, hmm in enumerate(hmmset.hmms):
+        fh.write('%4d %14s %4d' %(index + 1, '"%s"' %hmm.name, acc.hmm_count[index]))
+        for state in hmm.states: fh.write(' %10f' %acc.state_occ[state])
+        fh.write('\n')
+    fh.close()
+
+def supported(hmmset):
+    """
+    Native training covers single-stream diagonal models without input
+    transforms or other macros that HERest would have to interpret
+    """
+    for kind, item in hmmset.macros:
+        if kind != 'raw': continue
+        if not item.startswith('~o') or '<INPUTXFORM>' in item.upper(): return False
+    return hmmset.cov_kind == '<DIAGC>'
+
+def accumulate(model, hmmset, mmf_file, output_dir, mlf_file, model_list, inputs, prune, full=False):
+    """
+    E-step with hmmset (parsed from mmf_file) over the mfc list splits in
+    inputs, in parallel, with the accumulators merged as a tree. Workers
+    share the model's compiled copy in the model cache. Returns
+    (accumulator, number of accumulator files, merge levels, bytes read,
+    merge time).
+    """
+
+    hmmset.hmm_list = mmf.load_hmm_list(model_list)
+    model_dir = mmf.compile(mmf_file, model_list, model.model_cache, hmmset)
+
+    beams = get_beams(*prune)
+    mlf.load_index(mlf_file)
+    jobs = [(model_dir, mlf_file, input, model.data, beams, full, '%s/NER.%d.acc.npz' %(output_dir, num))
+            for num, input in enumerate(inputs)]
+    njobs = 1 if model.local == 1 else model.jobs
+    acc_files = util.map_parallel(accumulate_split, jobs, njobs)
+
+    merge_time = time.time()
+    acc, levels, bytes_read = tree_merge(acc_files, output_dir, njobs)
+    merge_time = time.time() - merge_time
+    util.log_write(model.logfh, ' merged [%d] accumulators in [%d] levels, read [%d] bytes in [%1.2f] sec'
+                   %(len(acc_files), levels, bytes_read, merge_time))
+    return acc, len(acc_files), levels, bytes_read, merge_time
+
+def write_log(path, acc, start_time, merge_info, extra_lines=[]):
+    """
+    herest.log for a native pass, ending with HERest's average log prob line
+    """
+    num_files, levels, bytes_read, merge_time = merge_info
+    fh = open(path, 'w')
+    fh.write('Native Baum-Welch: %d utterances, %d failed, %d frames, %1.1f sec\n'
+             %(acc.utts, acc.failed, acc.frames, time.time() - start_time))
+    fh.write('Merged %d accumulators: %d levels, %d bytes read, %1.2f sec\n'
+             %(num_files, levels, bytes_read, merge_time))
+    for line in extra_lines: fh.write('%s\n' %line)
+    fh.write('Reestimation complete - average log prob per frame = %e\n' %(acc.log_lik / max(acc.frames, 1)))
+    fh.close()
+
+def run_iter(model, prev_dir, output_dir, mlf_file, model_list, inputs, prune=(PRUNE_THRESH, PRUNE_INC, PRUNE_LIMIT)):
+    """
+    One iteration of embedded training over the mfc list splits in inputs,
+    writing <output_dir>/MMF, stats and herest.log. prune is HERest's -t
+    (thresh, inc, limit). Returns the updated HMMSet, or None, having done
+    nothing, if the model needs HERest.
+    """
+
+    start_time = time.time()
+    hmmset = mmf.load('%s/MMF' %prev_dir)
+    if not supported(hmmset): return None
+    result = accumulate(model, hmmset, '%s/MMF' %prev_dir, output_dir, mlf_file, model_list, inputs, prune)
+    acc = result[0]
+
+    update(hmmset, acc)
+    hmmset.write('%s/MMF' %output_dir)
+    write_stats(hmmset, acc, '%s/stats' %output_dir)
+    write_log('%s/herest.log' %output_dir, acc, start_time, result[1:])
+    return hmmset
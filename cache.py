@@ -0,0 +1,100 @@
+"""
+Content-addressed cache of training stage outputs, shared by experiments
+
+A stage's key is a hash of everything its outputs depend on: the contents
+of its input files (setup, dictionary, MLFs, previous MMF, ...), the config
+values it reads and the source of the modules that do the work. Paths are
+not hashed, so two experiments whose inputs have the same contents share
+entries. An entry is a directory <cache>/<stage>-<key> holding copies of
+the stage's outputs, stored relative to the experiment dir, and a manifest;
+it is written under a temporary name and renamed, so concurrent runs never
+see half an entry.
+"""
+
+import os, shutil, hashlib
+
+CACHE_VERSION = 1
+MANIFEST = 'manifest'
+
+def stage_key(stage, files, options, modules):
+    """
+    Hash of a stage's input file contents, (section, option, value) config
+    values and module sources
+    """
+    sha = hashlib.sha1('stage cache v%d %s' %(CACHE_VERSION, stage))
+    for path in list(files) + list(modules):
+        if not os.path.isfile(path):
+            sha.update('missing\0')
+            continue
+        fh = open(path, 'rb')
+        while True:
+            data = fh.read(1 << 20)
+            if not data: break
+            sha.update(data)
+        fh.close()
+        sha.update('\0')
+    for section, option, value in options: sha.update('%s:%s=%s\0' %(section, option, value))
+    return sha.hexdigest()
+
+def module_files(names):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return ['%s/%s.py' %(here, name) for name in names]
+
+def copy_path(src, dst):
+    """
+    Copy a file or directory tree, replacing dst; copies get the current
+    time, so nothing restored looks older than a file derived from it
+    (such as an MLF index)
+    """
+    if os.path.isdir(dst): shutil.rmtree(dst)
+    elif os.path.exists(dst): os.remove(dst)
+    parent = os.path.dirname(dst)
+    if parent and not os.path.isdir(parent): os.makedirs(parent)
+    if not os.path.isdir(src):
+        shutil.copy(src, dst)
+        return
+    shutil.copytree(src, dst)
+    for root, dirs, files in os.walk(dst):
+        for name in files: os.utime(os.path.join(root, name), None)
+
+class StageCache:
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root): os.makedirs(root)
+
+    def entry(self, stage, key):
+        return '%s/%s-%s' %(self.root, stage, key)
+
+    def restore(self, stage, key, exp):
+        """
+        Copy a cached entry's outputs into exp; returns the list of
+        outputs restored, or None if there is no entry
+        """
+        entry = self.entry(stage, key)
+        if not os.path.isfile('%s/%s' %(entry, MANIFEST)): return None
+        outputs = open('%s/%s' %(entry, MANIFEST)).read().splitlines()
+        for n, output in enumerate(outputs): copy_path('%s/%d' %(entry, n), os.path.join(exp, output))
+        return outputs
+
+    def store(self, stage, key, exp, outputs):
+        """
+        Copy the outputs (paths in exp) that exist into a new entry;
+        returns the number stored
+        """
+        entry = self.entry(stage, key)
+        if os.path.isdir(entry): return 0
+        tmp = '%s.tmp.%d' %(entry, os.getpid())
+        if os.path.isdir(tmp): shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        stored = []
+        for output in outputs:
+            if not os.path.exists(output): continue
+            copy_path(output, '%s/%d' %(tmp, len(stored)))
+            stored.append(os.path.relpath(output, exp))
+        fh = open('%s/%s' %(tmp, MANIFEST), 'w')
+        for output in stored: fh.write('%s\n' %output)
+        fh.close()
+        try: os.rename(tmp, entry)
+        except OSError: shutil.rmtree(tmp)
+        return len(stored)
@@ -0,0 +1,272 @@
+"""
+Decision-tree state clustering, as HHEd's RO/QS/TB commands do it
+
+Each (phone, state) pool of triphone states is split greedily by the
+phonetic question that most increases the log likelihood of the data
+under single Gaussians, subject to the RO occupancy threshold on both
+sides. Trees are grown once down to a small threshold with the gain of
+every split kept, so the tied-state count for any TB is a walk over the
+trees (plus HHEd's final merge of leaves) and the TB for a target count is
+a bisection over those walks, with no reclustering.
+"""
+
+import numpy
+from questions import split_name
+
+LOG_2PI = numpy.log(2 * numpy.pi)
+MIN_VAR = 1e-10
+
+def load_stats(path):
+    """
+    HERest -s stats file: model name -> (count, [state occupancies])
+    """
+    stats = {}
+    for line in open(path):
+        items = line.split()
+        if len(items) < 3: continue
+        stats[items[1].strip('"')] = (int(items[2]), map(float, items[3:]))
+    return stats
+
+def center_phone(name):
+    return split_name(name)[1]
+
+def cluster_loglik(occ, sum1, sum2):
+    """
+    Log likelihood of the pooled data under one diagonal Gaussian; arrays
+    of clusters along the first axis
+    """
+    occ = numpy.asarray(occ, dtype=numpy.float64)
+    safe = numpy.where(occ > 0, occ, 1.0)[..., numpy.newaxis]
+    var = numpy.maximum(sum2 / safe - (sum1 / safe) ** 2, MIN_VAR)
+    dim = var.shape[-1]
+    return numpy.where(occ > 0, -0.5 * occ * (dim * (1 + LOG_2PI) + numpy.log(var).sum(axis=-1)), 0.0)
+
+class Node:
+
+    def __init__(self, members, occ, sum1, sum2):
+        self.members = members
+        self.occ = occ[members].sum()
+        self.sum1 = sum1[members].sum(axis=0)
+        self.sum2 = sum2[members].sum(axis=0)
+        self.loglik = float(cluster_loglik(self.occ, self.sum1, self.sum2))
+        self.question = None
+        self.gain = 0.0
+        self.no = self.yes = None
+
+    def split(self):
+        return self.yes is not None
+
+class Tree:
+    """
+    Tree for one (phone, state) pool. members are rows of the pool's
+    statistics; masks[q, i] says whether question q holds for member i.
+    """
+
+    def __init__(self, phone, state, names, occ, sum1, sum2, masks, ro, min_gain):
+        self.phone = phone
+        self.state = state
+        self.names = names
+        self.root = Node(numpy.arange(len(names)), occ, sum1, sum2)
+        self.grow(self.root, occ, sum1, sum2, masks, ro, min_gain)
+
+    def grow(self, node, occ, sum1, sum2, masks, ro, min_gain):
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            m = node.members
+            if len(m) < 2: continue
+            qmasks = masks[:, m]
+            yes_occ = numpy.dot(qmasks, occ[m])
+            yes_sum1 = numpy.dot(qmasks, sum1[m])
+            yes_sum2 = numpy.dot(qmasks, sum2[m])
+            no_occ = node.occ - yes_occ
+            gains = cluster_loglik(yes_occ, yes_sum1, yes_sum2) + \
+                    cluster_loglik(no_occ, node.sum1 - yes_sum1, node.sum2 - yes_sum2) - node.loglik
+            gains[(yes_occ < ro) | (no_occ < ro)] = -numpy.inf
+            best = int(numpy.argmax(gains))
+            if gains[best] < min_gain: continue
+            node.question = best
+            node.gain = float(gains[best])
+            yes = qmasks[best] > 0
+            node.yes = Node(m[yes], occ, sum1, sum2)
+            node.no = Node(m[~yes], occ, sum1, sum2)
+            nodes.extend([node.yes, node.no])
+
+    def leaves(self, tb):
+        """
+        Leaf nodes when only splits gaining at least tb are kept
+        """
+        leaves, nodes = [], [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node.split() and node.gain >= tb: nodes.extend([node.yes, node.no])
+            else: leaves.append(node)
+        return leaves
+
+    def clusters(self, tb):
+        """
+        Leaves, then HHEd's final pass merging pairs of leaves whose
+        combination loses less than tb: a list of lists of leaves
+        """
+        leaves = self.leaves(tb)
+        clusters = [[leaf] for leaf in leaves]
+        occ = numpy.array([leaf.occ for leaf in leaves])
+        sum1 = numpy.array([leaf.sum1 for leaf in leaves])
+        sum2 = numpy.array([leaf.sum2 for leaf in leaves])
+        loglik = numpy.array([leaf.loglik for leaf in leaves])
+        while len(clusters) > 1:
+            merged = cluster_loglik(occ[:,numpy.newaxis] + occ, sum1[:,numpy.newaxis] + sum1, sum2[:,numpy.newaxis] + sum2)
+            loss = loglik[:,numpy.newaxis] + loglik - merged
+            loss[numpy.tril_indices(len(clusters))] = numpy.inf
+            i, j = numpy.unravel_index(numpy.argmin(loss), loss.shape)
+            if loss[i,j] >= tb: break
+            occ[i] += occ[j]
+            sum1[i] += sum1[j]
+            sum2[i] += sum2[j]
+            loglik[i] = merged[i,j]
+            clusters[i] += clusters[j]
+            del clusters[j]
+            occ, sum1, sum2, loglik = [numpy.delete(a, j, axis=0) for a in [occ, sum1, sum2, loglik]]
+        return clusters
+
+    def macro_names(self, tb):
+        """
+        Leaf node -> tied state name ST_<phone>_<state>_<n>
+        """
+        names = {}
+        for n, cluster in enumerate(self.clusters(tb)):
+            for leaf in cluster: names[leaf] = 'ST_%s_%d_%d' %(self.phone, self.state, n + 1)
+        return names
+
+class Clustering:
+    """
+    Trees for every (phone, state) of the triphones in hmmset, from the
+    state occupancies of a stats file; question_set is a
+    questions.QuestionSet
+    """
+
+    def __init__(self, hmmset, stats_file, question_set, phones, states, ro, min_gain):
+        self.question_set = question_set
+        self.questions = question_set.questions
+        self.ro = ro
+        stats = load_stats(stats_file)
+
+        ## Single Gaussian statistics of every state (moment matched if mixed)
+        weights = hmmset.weights[:, numpy.newaxis]
+        second = numpy.asarray(hmmset.vars) + numpy.asarray(hmmset.means) ** 2
+        owner = hmmset.gaussian_states()
+        S = hmmset.num_states()
+        mean = numpy.array([numpy.bincount(owner, weights=(weights * hmmset.means)[:,d], minlength=S) for d in range(hmmset.vec_size)]).T
+        square = numpy.array([numpy.bincount(owner, weights=(weights * second)[:,d], minlength=S) for d in range(hmmset.vec_size)]).T
+
+        ## Models outside the pools keep their states
+        pooled = set()
+        self.trees = {}
+        for phone in phones:
+            models = [hmm for hmm in hmmset.hmms if center_phone(hmm.name) == phone]
+            names = [hmm.name for hmm in models]
+            masks = question_set.answers(names).astype(numpy.float64)
+            for state in states:
+                rows = [hmm.states[state - 2] for hmm in models]
+                occ = numpy.array([stats.get(name, (0, [0.0] * (state - 1)))[1][state - 2] for name in names])
+                sum1 = occ[:, numpy.newaxis] * mean[rows]
+                sum2 = occ[:, numpy.newaxis] * square[rows]
+                self.trees[(phone, state)] = Tree(phone, state, names, occ, sum1, sum2, masks, ro, min_gain)
+                pooled.update(rows)
+        self.fixed_states = len(set(range(S)) - pooled)
+
+    def states_for_tb(self, tb):
+        return self.fixed_states + sum([len(tree.clusters(tb)) for tree in self.trees.values()])
+
+    def tb_for_states(self, target, tb_min, tb_max, tolerance=0.01):
+        """
+        Bisect for the TB whose state count is closest to target; returns
+        (tb, states)
+        """
+        low, high = tb_min, tb_max
+        best = (tb_min, self.states_for_tb(tb_min))
+        for i in range(60):
+            tb = (low + high) / 2
+            count = self.states_for_tb(tb)
+            if abs(count - target) < abs(best[1] - target): best = (tb, count)
+            if abs(float(count - target) / target) <= tolerance / 10 or high - low < tolerance: break
+            if count > target: low = tb
+            else: high = tb
+        return best
+
+    def assign(self, tree, masks, tb):
+        """
+        Leaf of tree (cut at tb) for each column of a questions x models
+        answer matrix
+        """
+        leaves = [None] * masks.shape[1]
+        groups = [(tree.root, numpy.arange(masks.shape[1]))]
+        while groups:
+            node, members = groups.pop()
+            if not node.split() or node.gain < tb:
+                for m in members: leaves[m] = node
+                continue
+            yes = masks[node.question, members]
+            groups.extend([(node.yes, members[yes]), (node.no, members[~yes])])
+        return leaves
+
+    def write_trees(self, path, tb):
+        """
+        Trees in the format of HHEd's ST command: the questions, then per
+        tree one line per split node: index, question, no branch, yes branch
+        """
+        fh = open(path, 'w')
+        for name, patterns in self.questions:
+            fh.write("QS '%s' { %s }\n" %(name, ','.join(['"%s"' %p for p in patterns])))
+        fh.write('\n')
+        for key in sorted(self.trees.keys()):
+            tree = self.trees[key]
+            names = tree.macro_names(tb)
+            fh.write('%s[%d]\n' %key)
+            if not tree.root.split() or tree.root.gain < tb:
+                fh.write('   "%s"\n\n' %names[tree.root])
+                continue
+
+            ## Internal nodes are numbered 0, -1, -2, ... in breadth-first order
+            index = {}
+            nodes = [tree.root]
+            while nodes:
+                node = nodes.pop(0)
+                index[node] = -len(index)
+                for child in [node.no, node.yes]:
+                    if child.split() and child.gain >= tb: nodes.append(child)
+            def ref(node):
+                if node in index: return '%d' %index[node]
+                return '"%s"' %names[node]
+            fh.write('{\n')
+            for node in sorted(index.keys(), key=lambda n: -index[n]):
+                fh.write('  %3d %-22s %20s %20s\n' %(index[node], "'%s'" %self.questions[node.question][0], ref(node.no), ref(node.yes)))
+            fh.write('}\n\n')
+        fh.close()
+
+    def write_tied_list(self, path, tb, names):
+        """
+        HMM list as HHEd's CO writes it: models whose states all tie to the
+        same clusters share the first such model's name
+        """
+        macros = dict([(key, tree.macro_names(tb)) for key, tree in self.trees.items()])
+        masks = self.question_set.answers(names)
+        tied = [[] for name in names]
+        for key in sorted(self.trees.keys()):
+            members = numpy.array([n for n, name in enumerate(names) if center_phone(name) == key[0]], dtype=numpy.int64)
+            if not len(members): continue
+            for n, leaf in zip(members, self.assign(self.trees[key], masks[:, members], tb)):
+                tied[n].append(macros[key][leaf])
+
+        physical = {}
+        fh = open(path, 'w')
+        for name, states in zip(names, tied):
+            if not states:
+                fh.write('%s\n' %name)
+                continue
+            states = tuple(states)
+            if states not in physical:
+                physical[states] = name
+                fh.write('%s\n' %name)
+            else: fh.write('%s %s\n' %(name, physical[states]))
+        fh.close()
@@ -2,8 +2,9 @@
 Coding functions
 """
 
-import os, sys, gzip
+import os, sys, errno, gzip, hashlib
 import util
+import htk_param
 
 def create_config(model):
     """
@@ -51,42 +52,99 @@ def get_mfc_name_from_wav(wav, path, just_key=False):
 
     new_path = '%s/%s.mfc' %(path, new_path.split('.')[0])
     dir = os.path.dirname(new_path)
-    if not os.path.isdir(dir): os.makedirs(dir)
+    ## Coding and the MLF build name the same files at the same time
+    if not os.path.isdir(dir):
+        try: os.makedirs(dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
     return new_path
 
 
+def config_hash(model, config):
+    """
+    Hash of everything that determines an utterance's features: the front
+    end settings, its source config and which front end computes them
+    """
+    hash = hashlib.md5()
+    hash.update(open(model.mfc_config).read())
+    if os.path.isfile(config): hash.update(open(config).read())
+    else: hash.update(config)
+    hash.update('native' if model.native_front_end else 'hcopy')
+    return hash.hexdigest()
+
+def load_manifest(path):
+    """
+    Manifest lines: <wav> <size> <mtime> <config hash> <mfc>
+    """
+    manifest = {}
+    if not os.path.isfile(path): return manifest
+    for line in open(path):
+        items = line.rstrip('\n').split('\t')
+        if len(items) == 5: manifest[items[0]] = tuple(items[1:])
+    return manifest
+
+def save_manifest(manifest, path):
+    tmp = path + '.tmp'
+    fh = open(tmp, 'w')
+    for wav in sorted(manifest.keys()):
+        fh.write('%s\n' %'\t'.join((wav,) + manifest[wav]))
+    fh.close()
+    os.rename(tmp, path)
+
+def wav_entry(wav, config, mfc, hashes):
+    stat = os.stat(wav)
+    return ('%d' %stat.st_size, '%d' %int(stat.st_mtime), hashes[config], mfc)
+
 def wav_to_mfc(model, output_dir, mfc_list):
     """
     Use HCopy to code each wav in the setup file. HCopy takes a config
     file (-C) and an input (-S). The input is a file where each line
     looks like:
     <wav file> <mfc file>
+    With native_front_end set, the same features are computed by mfcc.py
+    on a local process pool instead.
+
+    A manifest in the data directory records the size, mtime and front end
+    config hash each mfc was coded from; only new or changed wavs are coded.
     """
 
     def hcopy(config, input):
         cmd = 'HCopy -A -T 1 -C %s -C %s -S %s' %(model.mfc_config, config, input)
         return cmd
 
-    ## Create list files for HCopy <wav file> <mfc file>
-    lines_per_split = 500
-    count = 0
-    prev_config = ''
-    cmds = []
-    mfcs = []
-    file = '%s/hcopy.list.0' %output_dir
-    fh = open(file, 'w')
+    manifest_file = '%s/manifest' %model.data
+    manifest = load_manifest(manifest_file)
+    hashes = {}
 
     if model.setup.endswith('gz'): setup_reader = lambda x: gzip.open(x)
     else: setup_reader = lambda x: open(x)
-    
+
+    ## Find the wavs that need (re)coding
+    count = 0
+    mfcs = []
+    jobs = []
     for line in setup_reader(model.setup):
         count += 1
         [wav, config] = line.strip().split()[0:2]
-        if not os.path.isfile(wav): sys.stderr.write('missing [%s]\n' %wav)
         mfc = get_mfc_name_from_wav(wav, model.data)
         mfcs.append(mfc)
+        if not os.path.isfile(wav):
+            sys.stderr.write('missing [%s]\n' %wav)
+            continue
+        if config not in hashes: hashes[config] = config_hash(model, config)
+        if manifest.get(wav) == wav_entry(wav, config, mfc, hashes) and os.path.isfile(mfc): continue
+        if os.path.isfile(mfc): os.remove(mfc)
+        jobs.append((wav, config, mfc))
+    util.log_write(model.logfh, 'coding [%d] new or changed of [%d] files' %(len(jobs), count))
 
-        if count > 1 and (count % lines_per_split == 0 or config != prev_config):
+    ## Create list files for HCopy <wav file> <mfc file>
+    lines_per_split = 500
+    prev_config = ''
+    cmds = []
+    file = '%s/hcopy.list.0' %output_dir
+    fh = open(file, 'w')
+    for index, (wav, config, mfc) in enumerate(jobs):
+        if index > 0 and (index % lines_per_split == 0 or config != prev_config):
             cmds.append(hcopy(prev_config, file))
             fh.close()
             file = '%s/hcopy.list.%d' %(output_dir, len(cmds))
@@ -95,11 +153,27 @@ def wav_to_mfc(model, output_dir, mfc_list):
         fh.write('%s %s\n' %(wav, mfc))
         prev_config = config
 
-    cmds.append(hcopy(config, file))
+    if jobs: cmds.append(hcopy(prev_config, file))
     fh.close()
 
+    ## Nothing to do
+    if not jobs: pass
+
+    ## Native front end: code in-process on a local process pool
+    elif model.native_front_end:
+        import mfcc
+        frames = mfcc.code_files(model, jobs)
+        failed = len([f for f in frames if f < 0])
+        if failed: sys.stderr.write('native front end failed on [%d] files\n' %failed)
+
+        ## Spot check the first file against HCopy when it is available
+        if model.verbose > 0 and os.system('which HCopy > /dev/null 2>&1') == 0:
+            wav, config, mfc = jobs[0]
+            max_diff, max_rel = mfcc.compare_with_hcopy(model.mfc_config, config, wav, output_dir)
+            util.log_write(model.logfh, 'native vs HCopy [%s] max abs diff [%1.4f] max diff/std [%1.4f]' %(wav, max_diff, max_rel))
+
     ## Non-parallel case
-    if model.local == 1:
+    elif model.local == 1:
         for cmd in cmds: os.system(cmd)
 
     ## Parallel case: one command per line in cmds_file
@@ -110,6 +184,21 @@ def wav_to_mfc(model, output_dir, mfc_list):
         fh.close()
         util.run_parallel(cmds_file, model.jobs, output_dir)
 
+    ## Record the files that were coded (stale outputs were removed above)
+    for wav, config, mfc in jobs:
+        if os.path.isfile(mfc):
+            manifest[wav] = wav_entry(wav, config, mfc, hashes)
+        elif wav in manifest:
+            del manifest[wav]
+    save_manifest(manifest, manifest_file)
+
+    ## Pack new features into the data directory's archive
+    if model.use_archive:
+        import archive
+        prefix = archive.get_prefix(model.data)
+        added = archive.pack(mfcs, prefix, [mfc for wav, config, mfc in jobs])
+        util.log_write(model.logfh, 'packed [%d] files into archive [%s]' %(added, prefix))
+
     ## Create a file listing all created MFCs
     fh = open(mfc_list, 'w')
     for mfc in mfcs:
@@ -119,3 +208,67 @@ def wav_to_mfc(model, output_dir, mfc_list):
     ## Clean up
     os.system('rm -f %s/hcopy.list.*' %output_dir)
     return count
+
+
+def read_mfc_frames(mfc):
+    """
+    Read the number of frames from the header of an HTK parameter file
+    """
+    return htk_param.read_header(mfc).nsamples
+
+def write_frame_counts(mfc_list, frames_file):
+    """
+    Cache the frame count of every file in mfc_list, one
+    <mfc file> <frames> per line
+    """
+
+    count = 0
+    fh = open(frames_file, 'w')
+    for line in open(mfc_list):
+        mfc = line.strip()
+        if not mfc: continue
+        frames = 0
+        if os.path.isfile(mfc): frames = read_mfc_frames(mfc)
+        fh.write('%s %d\n' %(mfc, frames))
+        count += 1
+    fh.close()
+    return count
+
+def load_frame_counts(model, mfc_list):
+    """
+    Frame counts for the files in mfc_list, from the cache written after
+    coding (read from the headers for any file not in the cache)
+    """
+
+    frames = {}
+    if os.path.isfile(model.mfc_frames):
+        for line in open(model.mfc_frames):
+            [mfc, count] = line.split()
+            frames[mfc] = int(count)
+
+    for line in open(mfc_list):
+        mfc = line.strip()
+        if mfc and mfc not in frames and os.path.isfile(mfc):
+            frames[mfc] = read_mfc_frames(mfc)
+    return frames
+
+def split_mfc_list(model, mfc_list, output_dir, prefix='mfc.list.'):
+    """
+    Split mfc_list into one list per parallel worker, balancing the total
+    number of frames (not utterances) in each. Writes
+    <output_dir>/<prefix>0000, ... and returns their paths.
+    """
+
+    frames = load_frame_counts(model, mfc_list)
+    mfcs = [line.strip() for line in open(mfc_list) if line.strip()]
+    weights = [frames.get(mfc, 0) for mfc in mfcs]
+
+    files = []
+    nsplits = util.get_num_workers(model.jobs)
+    for split in util.split_by_weight(mfcs, weights, nsplits):
+        file = '%s/%s%04d' %(output_dir, prefix, len(files))
+        fh = open(file, 'w')
+        for mfc in split: fh.write('%s\n' %mfc)
+        fh.close()
+        files.append(file)
+    return files
@@ -5,6 +5,7 @@ Functions for building dictionaries and language models
 import os, re, gzip
 import util
 import coding
+import mlf
 
 def fix_cmu_dict(input, output):
     """
@@ -62,16 +63,17 @@ def make_mlf_from_transcripts(model, orig_dict, setup, data_path, word_mlf, mfc_
     if setup.endswith('gz'): setup_reader = lambda x: gzip.open(x)
     else: setup_reader = lambda x: open(x)
 
-    ## Create MLF-format entries for each utterance
+    ## Write MLF-format entries for each utterance as they are read
     mfcs = []
-    mlf = ['#!MLF!#']
+    writer = mlf.Writer(word_mlf)
     count = 0
     for line in setup_reader(setup):
         skip = False
         items = line.strip().split()
         wav = items[0]
         mfc = coding.get_mfc_name_from_wav(wav, data_path)
-        curr = ['"*/%s.lab"' %os.path.basename(wav).split('.')[0]]
+        name = '*/%s.lab' %os.path.basename(wav).split('.')[0]
+        curr = []
         trans = map(str.upper, items[2:])
         for word in trans:
             if replace_escaped_words and '\\' in word:
@@ -91,20 +93,14 @@ def make_mlf_from_transcripts(model, orig_dict, setup, data_path, word_mlf, mfc_
             curr.append(word)
 
         ## Check for empty transcriptions
-        if len(curr) <= 1: skip = True
+        if len(curr) == 0: skip = True
 
-        curr.append('.')
         if not skip:
-            mlf.extend(curr)
-            for word in curr:
-                words.add(word)
+            writer.write(name, curr)
+            words.update(curr)
             mfcs.append(mfc)
             count += 1
-
-    ## Write the MLF
-    fh = open(word_mlf, 'w')
-    fh.write('\n'.join(mlf) + '\n')
-    fh.close()
+    writer.close()
     
     ## Create a new MFC list file
     fh = open(mfc_list, 'w')
@@ -177,31 +173,20 @@ def build_lm_from_mlf(model, word_mlf, dictionary, vocab, lm_dir, lm, lm_order,
 
     ## Prepare to build an LM by creating a file with one sentence per line
     text_file = '%s/training.txt' %lm_dir
-    text, curr = [], []
     
-    ## Extract a vocab from the MLF
-    cmd = 'cat %s | grep ".lab" -v | grep "MLF" -v | sort | uniq' %word_mlf
-    mlf_vocab = set(os.popen(cmd).read().splitlines())
+    ## Extract a vocab and one sentence per utterance from the MLF
+    mlf_vocab = set()
+    fh = open(text_file, 'w')
+    for name, lines in mlf.records(word_mlf):
+        mlf_vocab.update(lines)
+        fh.write('%s\n' %' '.join(lines))
+    fh.close()
     mlf_dict_vocab = list(mlf_vocab.intersection(dict))
     mlf_dict_vocab.sort()
     fh = open(vocab, 'w')
     for word in mlf_dict_vocab: fh.write(word + '\n')
     fh.close()
 
-    for line in open(word_mlf):
-        line = line.strip()
-        if line.startswith('#!MLF'): continue
-        if line.startswith('"') and '.lab' in line: continue
-        if line == '.':
-            text.append(' '.join(curr))
-            curr = []
-            continue
-        curr.append(line)
-
-    fh = open(text_file, 'w')
-    fh.write('\n'.join(text))
-    fh.close()
-
     ## Build a language model
     cutoff, cutoff_min, cutoff_max = 5, 1, 50
     iters, prev_cutoff = 0, 0
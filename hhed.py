@@ -0,0 +1,43 @@
+"""
+The HHEd commands of the mixture schedule, in-process on an mmf.HMMSet
+
+mixup and mixdown_mono write HHEd scripts using LS (load a HERest stats
+file), FA (set the variance floor to a fraction of the average state
+variance from those stats), MU (split the heaviest Gaussians until states
+have n) and MD (merge Gaussians until states have n). run() applies such a
+script to a model in memory, so the same script serves HHEd and the native
+path.
+"""
+
+import numpy
+import clustering
+
+COMMANDS = ['LS', 'FA', 'MU', 'MD']
+
+def state_occupancy(hmmset, stats_file):
+    """
+    Occupancy of each state from a HERest -s stats file
+    """
+    occ = numpy.zeros(hmmset.num_states())
+    for name, (count, state_occ) in clustering.load_stats(stats_file).items():
+        if name not in hmmset.hmm_names: continue
+        for state, value in zip(hmmset.get_hmm(name).states, state_occ): occ[state] = value
+    return occ
+
+def run(hmmset, script):
+    """
+    Apply the commands of an HHEd script to hmmset
+    """
+    stats_file = None
+    for line in open(script):
+        items = line.split()
+        if not items: continue
+        command = items[0]
+        if command not in COMMANDS: raise ValueError('unsupported HHEd command [%s] in [%s]' %(command, script))
+        if command == 'LS': stats_file = items[1]
+        elif command == 'FA':
+            if stats_file is None: raise ValueError('FA before LS in [%s]' %script)
+            hmmset.floor_variances(state_occupancy(hmmset, stats_file), float(items[1]))
+        elif command == 'MU': hmmset.split_mixtures(hmmset.item_states(' '.join(items[2:])), int(items[1]))
+        elif command == 'MD': hmmset.merge_mixtures(hmmset.item_states(' '.join(items[2:])), int(items[1]))
+    return hmmset
@@ -0,0 +1,258 @@
+"""
+HLEd's label edits in-process, over streaming MLF records
+
+The edit scripts this recipe uses need only a few commands: EX (expand
+words with the first pronunciation in the dictionary), IS (insert labels at
+both ends), NB (labels that take no context and are skipped when finding
+one), TC (make triphones, biphones at the ends), IT (CH matches on the
+center phone only), CH (change a label by its neighbours) and ME (merge a
+sequence of labels into one). The options -d, -l, -m (strip to
+monophones on loading) and -n (write the list of labels in the output) are
+read from an HLEd option string, so each edit is described once and can run
+either way.
+
+The input is cut into contiguous chunks of records that are edited in a
+process pool and joined in order. With native_hled 2 HLEd runs too and any
+utterance whose label names differ is logged.
+"""
+
+import os, fnmatch, time
+import util, mlf
+from aligner import load_dict
+
+COMMANDS = ['EX', 'IS', 'NB', 'TC', 'IT', 'CH', 'ME']
+
+def load_script(path):
+    """
+    Edit commands of an HLEd script: [(command, [arguments])]
+    """
+    commands = []
+    if path is None or path == '/dev/null': return commands
+    for line in open(path):
+        items = line.split()
+        if not items or items[0].startswith('#'): continue
+        if items[0] not in COMMANDS: raise ValueError('unsupported HLEd command [%s] in [%s]' %(items[0], path))
+        commands.append((items[0], items[1:]))
+    return commands
+
+def parse_options(options):
+    """
+    HLEd option string -> dict of the options the native engine reads
+    """
+    items = options.split()
+    parsed = {'dict': None, 'label_dir': None, 'mono': False, 'list': None}
+    n = 0
+    while n < len(items):
+        if items[n] == '-d': parsed['dict'], n = items[n+1], n + 1
+        elif items[n] == '-l': parsed['label_dir'], n = items[n+1].strip('"\''), n + 1
+        elif items[n] == '-n': parsed['list'], n = items[n+1], n + 1
+        elif items[n] == '-m': parsed['mono'] = True
+        n += 1
+    return parsed
+
+def center(name):
+    if '-' in name: name = name.split('-', 1)[1]
+    return name.split('+', 1)[0]
+
+def parse_label(line):
+    """
+    [start, end, name, [other fields]]; times are None when absent
+    """
+    items = line.split()
+    if len(items) >= 3 and items[0].isdigit() and items[1].isdigit(): return [items[0], items[1], items[2], items[3:]]
+    return [None, None, items[0], items[1:]]
+
+def format_label(label):
+    start, end, name, rest = label
+    items = [name] + rest
+    if start is not None: items = [start, end] + items
+    return ' '.join(items)
+
+class Editor:
+    """
+    Applies a list of edit commands to one utterance's labels at a time
+    """
+
+    def __init__(self, commands, prons=None, mono=False):
+        self.commands = commands
+        self.prons = prons
+        self.mono = mono
+
+    def edit(self, labels):
+        if self.mono: labels = [[s, e, center(name), rest] for s, e, name, rest in labels]
+        boundary = set()
+        ignore_contexts = False
+        for command, args in self.commands:
+            if command == 'EX': labels = self.expand(labels)
+            elif command == 'IS':
+                start = labels and labels[0][0] or None
+                end = labels and labels[-1][1] or None
+                labels = [[start, start, args[0], []]] + labels + [[end, end, args[1], []]]
+            elif command == 'NB': boundary.add(args[0])
+            elif command == 'TC': labels = self.triphones(labels, boundary, args)
+            elif command == 'IT': ignore_contexts = True
+            elif command == 'CH': labels = self.change(labels, args, ignore_contexts)
+            elif command == 'ME': labels = self.merge(labels, args[0], args[1:])
+        return labels
+
+    def expand(self, labels):
+        expanded = []
+        for start, end, word, rest in labels:
+            if word not in self.prons: raise KeyError('word [%s] not in dictionary' %word)
+            for phone in self.prons[word][0]: expanded.append([None, None, phone, []])
+        return expanded
+
+    def triphones(self, labels, boundary, args):
+        """
+        l-c+r for every label not in boundary, skipping boundary labels
+        when finding contexts; args may give the contexts of the ends
+        """
+        phones = [label[2] for label in labels]
+        context = [n for n, phone in enumerate(phones) if phone not in boundary]
+        edited = [list(label) for label in labels]
+        for k, n in enumerate(context):
+            left = k > 0 and phones[context[k-1]] or (args and args[0]) or None
+            right = k < len(context) - 1 and phones[context[k+1]] or (len(args) > 1 and args[1]) or None
+            edited[n][2] = '%s%s%s' %(left and left + '-' or '', phones[n], right and '+' + right or '')
+        return edited
+
+    def change(self, labels, args, ignore_contexts):
+        """
+        CH X A Y B: Y becomes X where its neighbours match A and B; a
+        missing neighbour matches only *
+        """
+        new, left, old, right = args
+        base = ignore_contexts and center or (lambda name: name)
+        def match(n, pattern):
+            if n < 0 or n >= len(labels): return pattern == '*'
+            return fnmatch.fnmatchcase(base(labels[n][2]), pattern)
+        edited = [list(label) for label in labels]
+        for n in range(len(labels)):
+            if match(n, old) and match(n - 1, left) and match(n + 1, right): edited[n][2] = new
+        return edited
+
+    def merge(self, labels, name, pattern):
+        merged = []
+        for label in labels:
+            merged.append(label)
+            if len(merged) < len(pattern): continue
+            tail = merged[-len(pattern):]
+            if [l[2] for l in tail] != pattern: continue
+            del merged[-len(pattern):]
+            merged.append([tail[0][0], tail[-1][1], name, tail[0][3]])
+        return merged
+
+def edit_chunk(job):
+    """
+    Worker: edit the records of one MLF chunk; returns the output chunk and
+    the label names it holds in order of first appearance
+    """
+    script, options, input, output = job
+    options = parse_options(options)
+    prons = options['dict'] and load_dict(options['dict']) or None
+    editor = Editor(load_script(script), prons, options['mono'])
+    writer = mlf.Writer(output)
+    names, seen = [], set()
+    for name, lines in mlf.records(input):
+        labels = editor.edit([parse_label(line) for line in lines])
+        if options['label_dir']: name = '%s/%s' %(options['label_dir'], os.path.basename(name))
+        writer.write(name, [format_label(label) for label in labels])
+        for label in labels:
+            if label[2] not in seen:
+                seen.add(label[2])
+                names.append(label[2])
+    writer.close()
+    return output, names
+
+def edit(script, inputs, output, options, work_dir, njobs):
+    """
+    Apply an HLEd script with HLEd options to the MLFs in inputs, writing
+    output (and the -n label list); returns the number of utterances
+    """
+
+    ## Contiguous chunks of records, so joining them keeps the order
+    count = 0
+    for input in inputs:
+        for name in mlf.names(input): count += 1
+    nchunks = max(1, min(util.get_num_workers(njobs), count))
+    chunks = ['%s/hled.chunk.%d' %(work_dir, n) for n in range(nchunks)]
+    position = [0]
+    def assign(utt):
+        position[0] += 1
+        return (position[0] - 1) * nchunks / max(count, 1)
+    joined = '%s/hled.input' %work_dir
+    mlf.merge(inputs, joined)
+    mlf.split(joined, chunks, assign)
+    os.remove(joined)
+
+    jobs = [(script, options, chunk, '%s.out' %chunk) for chunk in chunks]
+    results = util.map_parallel(edit_chunk, jobs, njobs)
+    written = mlf.merge([r[0] for r in results], output)
+
+    list_file = parse_options(options)['list']
+    if list_file:
+        seen = set()
+        fh = open(list_file, 'w')
+        for out, names in results:
+            for name in names:
+                if name in seen: continue
+                seen.add(name)
+                fh.write('%s\n' %name)
+        fh.close()
+    for chunk in chunks: os.remove(chunk)
+    for out, names in results: os.remove(out)
+    return written
+
+def compare(mlf_a, mlf_b):
+    """
+    Utterances whose label names differ between two MLFs (or that are in
+    only one of them)
+    """
+    a, b = mlf.MLF(mlf_a), mlf.MLF(mlf_b)
+    diffs = [utt for utt in a.keys() if utt not in b or a.labels([utt]) != b.labels([utt])]
+    return sorted(diffs + [utt for utt in b.keys() if utt not in a])
+
+def command(script, inputs, output, options=''):
+    return 'HLEd -A -T 1 %s -i %s %s %s' %(options, output, script or '/dev/null', ' '.join(inputs))
+
+def run(model, script, inputs, output, log_dir, options='', log_name='hled.log', append=True):
+    """
+    Apply an HLEd script: in-process with [train_params] native_hled,
+    otherwise (or also, to check, with native_hled 2) with HLEd; the log
+    is appended to unless append is 0
+    """
+
+    hled_log = '%s/%s' %(log_dir, log_name)
+    if not model.native_hled or model.native_hled == 2:
+        cmd = '%s %s %s' %(command(script, inputs, output, options), append and '>>' or '>', hled_log)
+        ## run-command quotes the whole command, so one with quotes of its
+        ## own (e.g. -l "*") has to run here
+        if model.local == 1 or '"' in cmd: os.system(cmd)
+        else: util.run(cmd, log_dir)
+    if not model.native_hled: return
+
+    start_time = time.time()
+    native = output
+    list_file = parse_options(options)['list']
+    if model.native_hled == 2:
+        native = '%s.native' %output
+        if list_file: options = options.replace(list_file, '%s.native' %list_file)
+    njobs = 1 if model.local == 1 else model.jobs
+    count = edit(script, inputs, native, options, log_dir, njobs)
+    script = script or '/dev/null'
+    util.log_write(model.logfh, ' native HLEd [%s]: [%d] utterances in [%1.2f] sec' %(script, count, time.time() - start_time))
+
+    if model.native_hled == 2 and not os.path.isfile(output):
+        util.log_write(model.logfh, ' native HLEd [%s]: HLEd wrote no output, keeping the native one' %script)
+        os.rename(native, output)
+        if list_file: os.rename('%s.native' %list_file, list_file)
+    elif model.native_hled == 2:
+        diffs = compare(output, native)
+        util.log_write(model.logfh, ' native HLEd [%s]: [%d] utterances differ from HLEd' %(script, len(diffs)))
+        for utt in diffs[:10]: util.log_write(model.logfh, '  differs [%s]' %utt)
+        os.remove(native)
+        os.remove(mlf.index_file(native))
+        if list_file:
+            same = set(open(list_file).read().split()) == set(open('%s.native' %list_file).read().split())
+            util.log_write(model.logfh, ' native HLEd [%s]: label list matches HLEd [%s]' %(script, same))
+            os.remove('%s.native' %list_file)
@@ -0,0 +1,209 @@
+"""
+Reading and writing HTK parameter (feature) files
+
+An HTK parameter file is a 12 byte header
+    nSamples   (int32)  number of frames
+    sampPeriod (int32)  frame period in 100ns units
+    sampSize   (int16)  bytes per frame
+    parmKind   (int16)  base kind (MFCC, FBANK, ...) plus qualifier bits
+followed by the frames. Compressed (_C) files store each frame as int16
+values preceded by float32 scale (A) and offset (B) vectors, x = (s + B) / A,
+and count those two vectors as 4 extra frames in nSamples. Files saved with
+a CRC (_K) end with a 16 bit checksum of the data.
+"""
+
+import os, struct
+import numpy
+
+BASE_KINDS = ['WAVEFORM', 'LPC', 'LPREFC', 'LPCEPSTRA', 'LPDELCEP', 'IREFC',
+              'MFCC', 'FBANK', 'MELSPEC', 'USER', 'DISCRETE', 'PLP']
+
+## Qualifier bits, in the order HTK prints them
+QUALIFIERS = [('_E', 0100), ('_D', 0400), ('_N', 0200), ('_A', 01000),
+              ('_T', 0100000), ('_C', 02000), ('_K', 010000), ('_Z', 04000),
+              ('_0', 020000), ('_V', 040000)]
+QUALIFIER_BITS = dict(QUALIFIERS)
+BASE_MASK = 077
+
+HAS_COMPRESSION = QUALIFIER_BITS['_C']
+HAS_CRC = QUALIFIER_BITS['_K']
+
+def kind_to_string(kind):
+    """
+    Parameter kind code -> string, e.g. 11014 -> MFCC_D_A_Z_0
+    """
+    name = BASE_KINDS[kind & BASE_MASK]
+    for qual, bit in QUALIFIERS:
+        if kind & bit: name += qual
+    return name
+
+def string_to_kind(name):
+    """
+    Parameter kind string -> code; qualifiers may come in any order
+    """
+    items = name.strip('<>').upper().split('_')
+    kind = BASE_KINDS.index(items[0])
+    for qual in items[1:]:
+        kind |= QUALIFIER_BITS['_' + qual]
+    return kind
+
+def calc_crc(data):
+    """
+    HTK's 16 bit CRC (CCITT polynomial, zero initial value) of a byte string
+    """
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte << 8
+        for i in range(8):
+            if crc & 0x8000: crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else: crc = (crc << 1) & 0xFFFF
+    return crc
+
+class Header:
+    """
+    Parsed header of a parameter file. nsamples is the number of frames of
+    data (the compression vectors are not counted).
+    """
+
+    def __init__(self, nsamples, period, size, kind, byteorder='<'):
+        self.nsamples = nsamples
+        self.period = period
+        self.size = size
+        self.kind = kind
+        self.byteorder = byteorder
+
+    def compressed(self):
+        return bool(self.kind & HAS_COMPRESSION)
+
+    def has_crc(self):
+        return bool(self.kind & HAS_CRC)
+
+    def dim(self):
+        if self.compressed(): return self.size / 2
+        return self.size / 4
+
+    def kind_string(self, storage=True):
+        """
+        Kind as a string; storage=False drops the _C and _K qualifiers,
+        which only describe how the file is stored
+        """
+        kind = self.kind
+        if not storage: kind &= ~(HAS_COMPRESSION | HAS_CRC)
+        return kind_to_string(kind)
+
+def parse_header(data):
+    """
+    Parse a 12 byte header. VAX (little-endian) order is tried first since
+    that is what coding.create_config asks HCopy for.
+    """
+
+    for byteorder in ['<', '>']:
+        nsamples, period, size, kind = struct.unpack(byteorder + 'iihh', data[:12])
+        if nsamples >= 0 and period > 0 and size > 0 and (kind & BASE_MASK) < len(BASE_KINDS):
+            break
+    header = Header(nsamples, period, size, kind, byteorder)
+    if header.compressed(): header.nsamples -= 4
+    return header
+
+def read_header(path):
+    fh = open(path, 'rb')
+    data = fh.read(12)
+    fh.close()
+    if len(data) < 12: raise IOError('truncated HTK parameter file [%s]' %path)
+    return parse_header(data)
+
+def read(path, check_crc=False):
+    """
+    Read a parameter file, returning (header, frames) where frames is a
+    float32 array of shape (nsamples, dim). Uncompressed files are returned
+    as a read-only memory map of the file; compressed files are decoded.
+    """
+
+    header = read_header(path)
+    dim = header.dim()
+    order = header.byteorder
+    data_bytes = header.nsamples * header.size
+    if header.compressed(): data_bytes += 2 * dim * 4
+
+    if check_crc and header.has_crc():
+        fh = open(path, 'rb')
+        fh.seek(12)
+        data = fh.read(data_bytes)
+        stored = struct.unpack(order + 'H', fh.read(2))[0]
+        fh.close()
+        if calc_crc(data) != stored:
+            raise IOError('CRC mismatch in HTK parameter file [%s]' %path)
+
+    if header.nsamples == 0:
+        return header, numpy.zeros((0, dim), dtype=numpy.float32)
+
+    if not header.compressed():
+        frames = numpy.memmap(path, dtype=order + 'f4', mode='r', offset=12,
+                              shape=(header.nsamples, dim))
+        return header, frames
+
+    scale_offset = numpy.memmap(path, dtype=order + 'f4', mode='r', offset=12, shape=(2, dim))
+    shorts = numpy.memmap(path, dtype=order + 'i2', mode='r', offset=12 + 8 * dim,
+                          shape=(header.nsamples, dim))
+    frames = (shorts + scale_offset[1]) / scale_offset[0]
+    return header, frames.astype(numpy.float32)
+
+def compress(frames):
+    """
+    HTK compression: returns (A, B, shorts) with x ~= (shorts + B) / A
+    """
+
+    frames = numpy.asarray(frames, dtype=numpy.float64)
+    xmax = frames.max(axis=0)
+    xmin = frames.min(axis=0)
+    span = xmax - xmin
+    flat = span <= 0
+    span[flat] = 1.0
+    A = 2 * 32767.0 / span
+    B = (xmax + xmin) * 32767.0 / span
+
+    ## A constant column is stored as all zeros with offset = the value
+    A[flat] = 1.0
+    B[flat] = xmin[flat]
+
+    shorts = numpy.round(frames * A - B)
+    shorts = numpy.clip(shorts, -32767, 32767).astype(numpy.int16)
+    return A.astype(numpy.float32), B.astype(numpy.float32), shorts
+
+def encode(frames, kind, period, compressed=False, crc=False, byteorder='<'):
+    """
+    Serialise frames (nsamples x dim) as the bytes of an HTK parameter file
+    """
+
+    if isinstance(kind, str): kind = string_to_kind(kind)
+    kind &= ~(HAS_COMPRESSION | HAS_CRC)
+    if compressed: kind |= HAS_COMPRESSION
+    if crc: kind |= HAS_CRC
+
+    frames = numpy.asarray(frames, dtype=numpy.float32)
+    if frames.ndim == 1: frames = frames.reshape((-1, 1))
+    nsamples, dim = frames.shape
+
+    if compressed:
+        A, B, shorts = compress(frames)
+        data = A.astype(byteorder + 'f4').tostring() + B.astype(byteorder + 'f4').tostring()
+        data += shorts.astype(byteorder + 'i2').tostring()
+        header = struct.pack(byteorder + 'iihh', nsamples + 4, period, 2 * dim, kind)
+    else:
+        data = frames.astype(byteorder + 'f4').tostring()
+        header = struct.pack(byteorder + 'iihh', nsamples, period, 4 * dim, kind)
+
+    if crc: data += struct.pack(byteorder + 'H', calc_crc(data))
+    return header + data
+
+def write(path, frames, kind, period, compressed=False, crc=False, byteorder='<'):
+    """
+    Write an HTK parameter file. kind is a code or a string like MFCC_0_D_A_Z
+    and period is in 100ns units.
+    """
+
+    dir = os.path.dirname(path)
+    if dir and not os.path.isdir(dir): os.makedirs(dir)
+    fh = open(path, 'wb')
+    fh.write(encode(frames, kind, period, compressed, crc, byteorder))
+    fh.close()
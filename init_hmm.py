@@ -2,13 +2,18 @@
 Functions for initializing HMMs for training
 """
 
-import os, random, re
+import os, random
+import numpy
 import util
+import htk_param
+import archive
+import mmf
+import hled
 random.seed(0)
 
 def word_to_phone_mlf(model, dict, word_mlf, phone_mlf, mono_list):
     """
-    Convert the word-level mlf to a phone level mlf with HLEd
+    Convert the word-level mlf to a phone level mlf with HLEd (or hled.py)
     """
 
     if not os.path.isfile(word_mlf):
@@ -26,12 +31,7 @@ def word_to_phone_mlf(model, dict, word_mlf, phone_mlf, mono_list):
     fh.close()
 
     ## Convert the word level MLF into a phone MLF
-    cmd_log = '%s/hhed_word_to_phone.log' %model.exp
-    cmd  = 'HLEd -A -T 1 -l "*"'
-    cmd += ' -d %s' %dict
-    cmd += ' -i %s' %phone_mlf
-    cmd += ' %s %s > %s' %(led_file, word_mlf, cmd_log)
-    os.system(cmd)
+    hled.run(model, led_file, [word_mlf], phone_mlf, model.exp, '-l "*" -d %s' %dict, 'hhed_word_to_phone.log', append=False)
 
     ## Create list of phones (appearing in the phone MLF)
     monophones = set()
@@ -56,10 +56,10 @@ def make_proto_hmm(model, mfc_list, proto_hmm):
     ## Start writing a proto hmm
     fh = open(proto_hmm, 'w')
 
-    ## Get info from feature files
-    lines = os.popen('HList -z -h -r %s' %open(mfc_list).read().splitlines()[0]).read().splitlines()
-    kind = lines[0].split()[-1].replace('_C_K', '')
-    comps = int(lines[1].split()[2])
+    ## Get info from the first feature file's header
+    header = htk_param.read_header(open(mfc_list).readline().strip())
+    kind = header.kind_string(storage=False)
+    comps = header.dim()
 
     fh.write('~o <VecSize> %d <%s>\n' %(comps, kind))
     fh.write('~h "proto_hmm"\n\n')
@@ -79,6 +79,89 @@ def make_proto_hmm(model, mfc_list, proto_hmm):
     fh.write('<EndHMM>\n')
     fh.close()
 
+def merge_stats(a, b):
+    """
+    Combine (count, mean, sum of squared deviations) statistics of two sets
+    of frames (Chan et al.'s pairwise update, stable for large counts)
+    """
+    if a is None: return b
+    if b is None: return a
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (float(count_b) / count)
+    m2 = m2_a + m2_b + delta ** 2 * (float(count_a) * count_b / count)
+    return count, mean, m2
+
+def accumulate_stats(job):
+    """
+    Worker for compute_global_stats: statistics over a chunk of files
+    """
+    data_dir, mfcs = job
+    features = archive.FeatureSource(data_dir)
+    stats = None
+    for mfc in mfcs:
+        frames = numpy.asarray(features.get(mfc), dtype=numpy.float64)
+        if len(frames) == 0: continue
+        mean = frames.mean(axis=0)
+        stats = merge_stats(stats, (len(frames), mean, ((frames - mean) ** 2).sum(axis=0)))
+    return stats
+
+def compute_global_stats(model, mfcs):
+    """
+    Per-dimension frame count, mean and sum of squared deviations over all
+    the files in mfcs, accumulated in parallel chunks; None if there are
+    no frames
+    """
+    njobs = 1
+    if model.local != 1: njobs = model.jobs
+    nchunks = 4 * util.get_num_workers(njobs)
+    chunks = [(model.data, mfcs[i::nchunks]) for i in range(nchunks) if mfcs[i::nchunks]]
+    stats = None
+    for chunk_stats in util.map_parallel(accumulate_stats, chunks, njobs):
+        stats = merge_stats(stats, chunk_stats)
+    return stats
+
+def write_hcompv_output(proto_hmm, output_dir, mean, var, floor_fraction):
+    """
+    Write what HCompV -m -f <floor_fraction> would: <output_dir>/proto_hmm
+    with every state set to the global mean and variance, and
+    <output_dir>/vFloors
+    """
+
+    ## Structure of the prototype
+    lines = open(proto_hmm).read().splitlines()
+    items = lines[0].split()
+    kind = items[-1]
+    vec_size = len(mean)
+    num_states = 0
+    trans = []
+    for index, line in enumerate(lines):
+        if line.strip().upper().startswith('<NUMSTATES>'): num_states = int(line.split()[1])
+        if line.strip().upper().startswith('<TRANSP>'):
+            trans = [map(float, row.split()) for row in lines[index+1:index+1+num_states]]
+
+    to_str = lambda values: ''.join([' %e' %v for v in values])
+    gconst = vec_size * numpy.log(2 * numpy.pi) + numpy.log(var).sum()
+
+    fh = open('%s/proto_hmm' %output_dir, 'w')
+    fh.write('~o\n<STREAMINFO> 1 %d\n<VECSIZE> %d<NULLD>%s<DIAGC>\n' %(vec_size, vec_size, kind.upper()))
+    fh.write('~h "proto_hmm"\n<BEGINHMM>\n<NUMSTATES> %d\n' %num_states)
+    for state in range(2, num_states):
+        fh.write('<STATE> %d\n' %state)
+        fh.write('<MEAN> %d\n%s\n' %(vec_size, to_str(mean)))
+        fh.write('<VARIANCE> %d\n%s\n' %(vec_size, to_str(var)))
+        fh.write('<GCONST> %e\n' %gconst)
+    fh.write('<TRANSP> %d\n' %num_states)
+    for row in trans: fh.write('%s\n' %to_str(row))
+    fh.write('<ENDHMM>\n')
+    fh.close()
+
+    fh = open('%s/vFloors' %output_dir, 'w')
+    fh.write('~v varFloor1\n<Variance> %d\n%s\n' %(vec_size, to_str(var * floor_fraction)))
+    fh.close()
+
 def initialize_hmms(model, root_dir, mfc_list, mono_list, proto_hmm):
     """
     Compute mean and variance of each feature across all utterances and
@@ -90,37 +173,50 @@ def initialize_hmms(model, root_dir, mfc_list, mono_list, proto_hmm):
     util.create_new_dir(output_dir)
     cmd_log = '%s/hcompv.log' %output_dir
 
-    ## Sample from the full mfc list to reduce computation
-    sampled_mfc_list = '%s/mfc_sample.list' %output_dir
-    fh = open(sampled_mfc_list, 'w')
-    mfcs = open(mfc_list).read().splitlines()
-    random.shuffle(mfcs)
-    mfc_frac = model.var_floor_fraction
-    num_mfcs_for_hcompv = int(mfc_frac * len(mfcs))
-    for mfc in mfcs[:num_mfcs_for_hcompv]:
-        fh.write('%s\n' %mfc)
-    fh.close()
-
-    cmd  = 'HCompV -A -T 1 -m'
-    cmd += ' -C %s' %model.mfc_config
-    cmd += ' -f 0.01'
-    cmd += ' -S %s' %sampled_mfc_list
-    cmd += ' -M %s' %output_dir
-    cmd += ' %s > %s' %(proto_hmm, cmd_log)
-
-    if model.local == 1: os.system(cmd)
-    else: util.run(cmd, output_dir)
+    ## Native estimate: stream over all the data
+    if model.native_hcompv:
+        mfcs = open(mfc_list).read().splitlines()
+        num_mfcs_for_hcompv = len(mfcs)
+        stats = compute_global_stats(model, mfcs)
+        if stats is None:
+            util.log_write(model.logfh, 'No frames in the files listed here [%s]' %mfc_list)
+            util.exit(model.log)
+        count, mean, m2 = stats
+        write_hcompv_output(proto_hmm, output_dir, mean, m2 / count, 0.01)
+        util.log_write(model.logfh, 'computed global mean and variance over [%d] frames' %count)
+
+    else:
+        ## Sample from the full mfc list to reduce computation
+        sampled_mfc_list = '%s/mfc_sample.list' %output_dir
+        fh = open(sampled_mfc_list, 'w')
+        mfcs = open(mfc_list).read().splitlines()
+        random.shuffle(mfcs)
+        mfc_frac = model.var_floor_fraction
+        num_mfcs_for_hcompv = int(mfc_frac * len(mfcs))
+        for mfc in mfcs[:num_mfcs_for_hcompv]:
+            fh.write('%s\n' %mfc)
+        fh.close()
+
+        cmd  = 'HCompV -A -T 1 -m'
+        cmd += ' -C %s' %model.mfc_config
+        cmd += ' -f 0.01'
+        cmd += ' -S %s' %sampled_mfc_list
+        cmd += ' -M %s' %output_dir
+        cmd += ' %s > %s' %(proto_hmm, cmd_log)
+
+        if model.local == 1: os.system(cmd)
+        else: util.run(cmd, output_dir)
 
     ## Copy the initial HMM for each monophone
     proto_hmm = '%s/proto_hmm' %output_dir    
     hmm_defs_init = '%s/init.mmf' %output_dir
-    hmm = re.search(re.compile('<BEGINHMM>.*<ENDHMM>', re.DOTALL), open(proto_hmm).read()).group()
+    hmm = mmf.load(proto_hmm).format_hmm(0)
 
     fh = open(hmm_defs_init, 'w')
     for line in open(mono_list):
         phone = line.strip()
         fh.write('~h "%s"\n' %phone)
-        fh.write('%s\n' %hmm)
+        fh.write(hmm)
     fh.close()
 
     ## Create mmf header file
@@ -0,0 +1,88 @@
+"""
+Journal of completed training steps, so a run can resume after a failure
+
+Model.train appends one line per finished step:
+
+<stage> <mix size> <step> <output HMM dir> <lik/fr>
+
+(- for a missing value), flushed to disk before the next step starts. A
+step is a Baum-Welch iteration (named by its number) or a named piece of a
+stage such as align or mixup. With --resume the journal is read back and
+every step it holds, whose output HMM dir still exists, is skipped; without
+it the journal starts empty.
+"""
+
+import os, threading
+
+class Entry:
+
+    def __init__(self, stage, mix_size, step, hmm_dir=None, lik=None):
+        self.stage = stage
+        self.mix_size = mix_size
+        self.step = str(step)
+        self.hmm_dir = hmm_dir
+        self.lik = lik
+
+    def key(self):
+        return (self.stage, self.mix_size, self.step)
+
+    def format(self):
+        lik = '-'
+        if self.lik is not None: lik = '%1.6f' %self.lik
+        return '%s %d %s %s %s' %(self.stage, self.mix_size, self.step, self.hmm_dir or '-', lik)
+
+def parse_entry(line):
+    items = line.split()
+    if len(items) != 5: return None
+    stage, mix_size, step, hmm_dir, lik = items
+    if hmm_dir == '-': hmm_dir = None
+    if lik == '-': lik = None
+    else: lik = float(lik)
+    return Entry(stage, int(mix_size), step, hmm_dir, lik)
+
+class Journal:
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        self.order = []
+        if resume and os.path.isfile(path):
+            for line in open(path):
+                entry = parse_entry(line)
+                if entry is None: continue
+                if entry.key() not in self.entries: self.order.append(entry.key())
+                self.entries[entry.key()] = entry
+        self.fh = open(path, resume and 'a' or 'w')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, stage, mix_size, step):
+        """
+        The entry of a completed step, or None if it has to run
+        """
+        entry = self.entries.get((stage, mix_size, str(step)))
+        if entry is None: return None
+        if entry.hmm_dir and not os.path.isdir(entry.hmm_dir): return None
+        return entry
+
+    def record(self, stage, mix_size, step, hmm_dir=None, lik=None):
+        entry = Entry(stage, mix_size, step, hmm_dir, lik)
+        self.lock.acquire()
+        try:
+            if entry.key() not in self.entries: self.order.append(entry.key())
+            self.entries[entry.key()] = entry
+            self.fh.write('%s\n' %entry.format())
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+        finally: self.lock.release()
+        return entry
+
+    def last(self, stage):
+        """
+        The most recent entry of a stage with an HMM dir, or None
+        """
+        for key in reversed(self.order):
+            if key[0] == stage and self.entries[key].hmm_dir: return self.entries[key]
+        return None
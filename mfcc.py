@@ -0,0 +1,281 @@
+"""
+NumPy implementation of the HTK MFCC front end, an in-process alternative
+to HCopy for the settings coding.create_config writes. Whole utterances are
+processed at once: framing, pre-emphasis and windowing are array
+operations, the spectrum is one batched FFT, and the filterbank, DCT and
+liftering are matrix products.
+"""
+
+import os, sys, wave, subprocess
+from cStringIO import StringIO
+import numpy
+import util
+import htk_param
+
+def load_htk_config(path):
+    """
+    Read an HTK config file into a dict; module prefixes (HPARM:) and
+    quotes are dropped
+    """
+    config = {}
+    for line in open(path):
+        line = line.split('#')[0].strip()
+        if '=' not in line: continue
+        key, val = line.split('=', 1)
+        key = key.split(':')[-1].strip().upper()
+        config[key] = val.strip().strip('\'"')
+    return config
+
+def is_true(val):
+    return str(val).upper() in ['T', 'TRUE', '1']
+
+def read_nist(data):
+    """
+    Samples from an uncompressed NIST sphere file held in a string
+    """
+    header_size = int(data[8:16].strip())
+    fields = {}
+    for line in data[16:header_size].splitlines():
+        items = line.split()
+        if len(items) == 3: fields[items[0]] = items[2]
+    if 'shorten' in fields.get('sample_coding', ''):
+        raise IOError('shorten compressed sphere file, set HWAVEFILTER to sph2pipe')
+    order = '>' if fields.get('sample_byte_format', '01') == '10' else '<'
+    samples = numpy.fromstring(data[header_size:], dtype=order + 'i2')
+    return samples, int(fields.get('sample_rate', 16000))
+
+def read_audio(wav, config):
+    """
+    Return (samples, sample period in 100ns units) for a wav, honouring the
+    SOURCEFORMAT and HWAVEFILTER settings of its HTK config
+    """
+
+    if 'HWAVEFILTER' in config:
+        cmd = config['HWAVEFILTER'].replace('$', wav)
+        data = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).communicate()[0]
+    else:
+        data = open(wav, 'rb').read()
+
+    if data.startswith('NIST_1A'):
+        samples, rate = read_nist(data)
+    elif data.startswith('RIFF'):
+        reader = wave.open(StringIO(data))
+        if reader.getsampwidth() != 2: raise IOError('only 16 bit audio is supported [%s]' %wav)
+        rate = reader.getframerate()
+        samples = numpy.fromstring(reader.readframes(reader.getnframes()), dtype='<i2')
+        samples = samples[::reader.getnchannels()]
+    else:
+        ## Headerless 16 bit audio at SOURCERATE
+        samples = numpy.fromstring(data, dtype='<i2')
+        rate = 1e7 / float(config.get('SOURCERATE', 625))
+
+    return samples.astype(numpy.float64), int(round(1e7 / rate))
+
+def mel(freq):
+    return 1127.0 * numpy.log(1.0 + freq / 700.0)
+
+class FrontEnd:
+    """
+    MFCC analysis with the semantics of HTK 3.4 HSigP/HParm for the
+    parameters in an HTK config (TARGETKIND, TARGETRATE, WINDOWSIZE,
+    PREEMCOEF, USEHAMMING, NUMCHANS, NUMCEPS, CEPLIFTER, USEPOWER,
+    ZMEANSOURCE, ENORMALISE, DELTAWINDOW, ACCWINDOW). ENORMALISE only
+    affects the _E energy term, not c0.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.target_kind = config.get('TARGETKIND', 'MFCC_0_D_A_Z')
+        self.kind = htk_param.string_to_kind(self.target_kind)
+        self.target_rate = int(float(config.get('TARGETRATE', 100000)))
+        self.window_size = float(config.get('WINDOWSIZE', 256000))
+        self.preemph = float(config.get('PREEMCOEF', 0.97))
+        self.use_hamming = is_true(config.get('USEHAMMING', 'T'))
+        self.num_chans = int(config.get('NUMCHANS', 20))
+        self.num_ceps = int(config.get('NUMCEPS', 12))
+        self.lifter = int(config.get('CEPLIFTER', 22))
+        self.use_power = is_true(config.get('USEPOWER', 'F'))
+        self.zmean_source = is_true(config.get('ZMEANSOURCE', 'F'))
+        self.enormalise = is_true(config.get('ENORMALISE', 'T'))
+        self.escale = float(config.get('ESCALE', 0.1))
+        self.sil_floor = float(config.get('SILFLOOR', 50.0))
+        self.delta_window = int(config.get('DELTAWINDOW', 2))
+        self.acc_window = int(config.get('ACCWINDOW', 2))
+        self.save_compressed = is_true(config.get('SAVECOMPRESSED', 'F'))
+        self.save_crc = is_true(config.get('SAVEWITHCRC', 'F'))
+        self.byteorder = '<' if config.get('BYTEORDER', 'VAX').upper() == 'VAX' else '>'
+
+        if htk_param.BASE_KINDS[self.kind & htk_param.BASE_MASK] != 'MFCC':
+            raise ValueError('native front end only computes MFCC, not [%s]' %self.target_kind)
+        self.analysis = {}
+
+    def has(self, qual):
+        return bool(self.kind & htk_param.QUALIFIER_BITS[qual])
+
+    def get_analysis(self, period):
+        """
+        Window, filterbank and DCT matrices for a source sample period
+        (cached, since they only depend on the sample rate)
+        """
+
+        if period in self.analysis: return self.analysis[period]
+
+        win_size = int(self.window_size / period)
+        frame_rate = int(self.target_rate / period)
+        fft_n = 2
+        while fft_n < win_size: fft_n *= 2
+
+        index = numpy.arange(win_size)
+        if self.use_hamming: window = 0.54 - 0.46 * numpy.cos(2 * numpy.pi * index / (win_size - 1))
+        else: window = numpy.ones(win_size)
+
+        ## Triangular mel filters over FFT bins 1 .. fft_n/2-1 (HTK's klo=2, khi=fft_n/2)
+        fres = 1e7 / (period * fft_n)
+        num_chans = self.num_chans
+        mlo, mhi = 0.0, mel(fft_n / 2 * fres)
+        centres = mlo + (mhi - mlo) * numpy.arange(1, num_chans + 2) / float(num_chans + 1)
+        bins = numpy.arange(1, fft_n / 2)
+        melk = mel(bins * fres)
+        lo_chan = numpy.searchsorted(centres, melk, side='left')
+        lower = numpy.concatenate([[mlo], centres])
+        lo_wt = (centres[numpy.minimum(lo_chan, num_chans)] - melk) / \
+                (centres[numpy.minimum(lo_chan, num_chans)] - lower[numpy.minimum(lo_chan, num_chans)])
+        fbank = numpy.zeros((fft_n / 2 + 1, num_chans))
+        for b, chan, wt in zip(bins, lo_chan, lo_wt):
+            if chan > 0: fbank[b, chan - 1] += wt
+            if chan < num_chans: fbank[b, chan] += 1.0 - wt
+
+        ## DCT with liftering folded in: c_j = sqrt(2/N) sum_k f_k cos(pi j (k - 0.5) / N)
+        j = numpy.arange(1, self.num_ceps + 1)
+        k = numpy.arange(1, num_chans + 1) - 0.5
+        dct = numpy.sqrt(2.0 / num_chans) * numpy.cos(numpy.pi * numpy.outer(k, j) / num_chans)
+        if self.lifter > 0: dct *= 1.0 + self.lifter / 2.0 * numpy.sin(numpy.pi * j / self.lifter)
+        c0 = numpy.sqrt(2.0 / num_chans) * numpy.ones((num_chans, 1))
+
+        self.analysis[period] = (win_size, frame_rate, fft_n, window, fbank, dct, c0)
+        return self.analysis[period]
+
+    def static(self, samples, period):
+        """
+        Static coefficients (c1..cN, then c0 and/or log energy) for every frame
+        """
+
+        win_size, frame_rate, fft_n, window, fbank, dct, c0 = self.get_analysis(period)
+        num_frames = 0
+        if len(samples) >= win_size: num_frames = (len(samples) - win_size) / frame_rate + 1
+        samples = numpy.ascontiguousarray(samples, dtype=numpy.float64)
+        frames = numpy.lib.stride_tricks.as_strided(samples, shape=(num_frames, win_size),
+                                                    strides=(frame_rate * 8, 8)).copy()
+
+        if self.zmean_source: frames -= frames.mean(axis=1)[:,numpy.newaxis]
+        energy = numpy.log(numpy.maximum((frames ** 2).sum(axis=1), 1e-30))
+
+        ## Pre-emphasis within each frame, as HTK does it
+        frames[:,1:] -= self.preemph * frames[:,:-1].copy()
+        frames[:,0] *= 1.0 - self.preemph
+        frames *= window
+
+        spectrum = numpy.abs(numpy.fft.rfft(frames, fft_n))
+        if self.use_power: spectrum **= 2
+        log_fbank = numpy.log(numpy.maximum(numpy.dot(spectrum, fbank), 1.0))
+
+        columns = [numpy.dot(log_fbank, dct)]
+        if self.has('_0'): columns.append(numpy.dot(log_fbank, c0))
+        if self.has('_E'):
+            if self.enormalise and num_frames > 0:
+                max_e = energy.max()
+                energy = numpy.maximum(energy, max_e - self.sil_floor * numpy.log(10.0) / 10.0)
+                energy = 1.0 - (max_e - energy) * self.escale
+            columns.append(energy[:,numpy.newaxis])
+        return numpy.hstack(columns)
+
+    def deltas(self, feats, window):
+        """
+        HTK regression coefficients, replicating the first and last frames
+        """
+        num_frames = len(feats)
+        if num_frames == 0: return feats.copy()
+        index = numpy.arange(num_frames)
+        norm = 2.0 * sum([theta * theta for theta in range(1, window + 1)])
+        delta = numpy.zeros(feats.shape)
+        for theta in range(1, window + 1):
+            ahead = feats[numpy.minimum(index + theta, num_frames - 1)]
+            behind = feats[numpy.maximum(index - theta, 0)]
+            delta += theta * (ahead - behind)
+        return delta / norm
+
+    def compute(self, samples, period):
+        feats = self.static(samples, period)
+        if self.has('_Z') and len(feats) > 0: feats -= feats.mean(axis=0)
+        blocks = [feats]
+        if self.has('_D') or self.has('_A'): blocks.append(self.deltas(feats, self.delta_window))
+        if self.has('_A'): blocks.append(self.deltas(blocks[1], self.acc_window))
+        return numpy.hstack(blocks).astype(numpy.float32)
+
+    def code(self, wav, source_config, mfc):
+        samples, period = read_audio(wav, source_config)
+        feats = self.compute(samples, period)
+        htk_param.write(mfc, feats, self.kind, self.target_rate, self.save_compressed,
+                        self.save_crc, self.byteorder)
+        return len(feats)
+
+## Per-process front ends, keyed by (mfc config, source config)
+front_ends = {}
+
+def code_file(job):
+    """
+    Worker for code_files: job is (mfc config, source config, wav, mfc)
+    """
+    mfc_config, source_config, wav, mfc = job
+    key = (mfc_config, source_config)
+    if key not in front_ends:
+        config = load_htk_config(source_config)
+        config.update(load_htk_config(mfc_config))
+        front_ends[key] = (FrontEnd(config), config)
+    front_end, config = front_ends[key]
+    try: return front_end.code(wav, config, mfc)
+    except Exception, e:
+        sys.stderr.write('failed to code [%s]: %s\n' %(wav, e))
+        return -1
+
+def code_files(model, jobs):
+    """
+    Code (wav, source config, mfc) triples on a local process pool;
+    returns the number of frames written for each (-1 on failure)
+    """
+    njobs = 1
+    if model.local != 1: njobs = model.jobs
+    return util.map_parallel(code_file, [(model.mfc_config, config, wav, mfc) for wav, config, mfc in jobs], njobs)
+
+def compare_with_hcopy(mfc_config, source_config, wav, output_dir):
+    """
+    Code one wav with HCopy and with the native front end and return the
+    largest absolute difference and the largest difference relative to
+    each coefficient's standard deviation
+    """
+
+    htk_mfc = '%s/hcopy_check.mfc' %output_dir
+    native_mfc = '%s/native_check.mfc' %output_dir
+    os.system('HCopy -C %s -C %s %s %s' %(mfc_config, source_config, wav, htk_mfc))
+    code_file((mfc_config, source_config, wav, native_mfc))
+
+    htk_header, htk_feats = htk_param.read(htk_mfc)
+    native_header, native_feats = htk_param.read(native_mfc)
+    if htk_feats.shape != native_feats.shape:
+        raise ValueError('HCopy gave %s frames, native gave %s' %(htk_feats.shape, native_feats.shape))
+    diff = numpy.abs(numpy.asarray(htk_feats) - native_feats)
+    std = numpy.maximum(numpy.asarray(htk_feats).std(axis=0), 1e-6)
+    return diff.max(), (diff / std).max()
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 4:
+        sys.stderr.write('Usage: python %s <mfc config> <source config> <wav> [<wav> ...]\n' %sys.argv[0])
+        sys.exit()
+
+    import tempfile, shutil
+    tmp_dir = tempfile.mkdtemp()
+    for wav in sys.argv[3:]:
+        max_diff, max_rel = compare_with_hcopy(sys.argv[1], sys.argv[2], wav, tmp_dir)
+        print '%s max abs diff [%1.5f] max diff / std [%1.5f]' %(wav, max_diff, max_rel)
+    shutil.rmtree(tmp_dir)
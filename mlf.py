@@ -0,0 +1,189 @@
+"""
+HTK master label files, streamed a record at a time
+
+An MLF is a header line, then for each utterance a quoted label file name,
+its label lines and a line holding a period. Records are read one at a time,
+and an index of utterance id -> byte offset and length is kept beside the
+MLF (<mlf>.index) so single utterances can be read by seeking; the index
+is rebuilt whenever it is older than the MLF. Filtering, merging and
+splitting stream records from the inputs to the outputs, so no MLF is ever
+held in memory whole.
+"""
+
+import os
+from archive import utt_id
+
+HEADER = '#!MLF!#'
+
+def records(path):
+    """
+    (label file name, [label lines]) for each record, as a generator
+    """
+    name, lines = None, []
+    for line in open(path):
+        line = line.strip()
+        if not line or line == HEADER: continue
+        if name is None:
+            if line.startswith('"'): name, lines = line.strip('"'), []
+        elif line == '.':
+            yield name, lines
+            name = None
+        else: lines.append(line)
+
+def names(path):
+    """
+    Label file names, as a generator
+    """
+    for line in open(path):
+        if line.startswith('"'): yield line.strip().strip('"')
+
+def utt_ids(path):
+    for name in names(path): yield utt_id(name)
+
+def label_names(lines):
+    """
+    Label of each line, whether or not it has start and end times
+    """
+    labels = []
+    for line in lines:
+        items = line.split()
+        if len(items) >= 3 and items[0].isdigit() and items[1].isdigit(): labels.append(items[2])
+        else: labels.append(items[0])
+    return labels
+
+class Writer:
+
+    def __init__(self, path):
+        self.fh = open(path, 'w')
+        self.fh.write('%s\n' %HEADER)
+        self.count = 0
+
+    def write(self, name, lines):
+        self.fh.write('"%s"\n' %name)
+        for line in lines: self.fh.write('%s\n' %line)
+        self.fh.write('.\n')
+        self.count += 1
+
+    def close(self):
+        self.fh.close()
+        return self.count
+
+def index_file(path):
+    return '%s.index' %path
+
+def build_index(path):
+    """
+    Write <path>.index: one line per record, <utt id> <byte offset> <bytes>;
+    a later record for the same id replaces an earlier one
+    """
+    tmp = '%s.%d' %(index_file(path), os.getpid())
+    out = open(tmp, 'w')
+    offset = start = 0
+    utt = None
+    for line in open(path, 'rb'):
+        if utt is None and line.startswith('"'):
+            utt, start = utt_id(line.strip().strip('"')), offset
+        offset += len(line)
+        if utt is not None and line.strip() == '.':
+            out.write('%s %d %d\n' %(utt, start, offset - start))
+            utt = None
+    out.close()
+    os.rename(tmp, index_file(path))
+
+def load_index(path):
+    index_path = index_file(path)
+    if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path):
+        build_index(path)
+    index = {}
+    for line in open(index_path):
+        items = line.split()
+        if len(items) == 3: index[items[0]] = (int(items[1]), int(items[2]))
+    return index
+
+class MLF:
+    """
+    Random access to the records of an MLF by utterance id
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = load_index(path)
+        self.fh = None
+
+    def __contains__(self, utt):
+        return utt in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, utt):
+        """
+        (label file name, [label lines]) of one utterance
+        """
+        if self.fh is None: self.fh = open(self.path, 'rb')
+        offset, length = self.index[utt]
+        self.fh.seek(offset)
+        lines = self.fh.read(length).splitlines()
+        return lines[0].strip().strip('"'), [line.strip() for line in lines[1:-1] if line.strip()]
+
+    def labels(self, utts=None):
+        """
+        Label names of each utterance (only those in utts when given),
+        keyed by utterance id
+        """
+        if utts is None: utts = self.keys()
+        labels = {}
+        for utt in utts:
+            if utt in self.index: labels[utt] = label_names(self.get(utt)[1])
+        return labels
+
+def filter(path, output, utts, keep=True):
+    """
+    Copy the records of utterances in utts (or, with keep False, those not
+    in it) to output; returns the number written
+    """
+    writer = Writer(output)
+    for name, lines in records(path):
+        if (utt_id(name) in utts) == keep: writer.write(name, lines)
+    return writer.close()
+
+def merge(paths, output):
+    """
+    Concatenate the records of several MLFs; returns the number written
+    """
+    writer = Writer(output)
+    for path in paths:
+        for name, lines in records(path): writer.write(name, lines)
+    return writer.close()
+
+def split(path, outputs, assign):
+    """
+    Stream each record to outputs[assign(utt id)], dropping records for
+    which assign returns None; returns the number written to each
+    """
+    writers = [Writer(output) for output in outputs]
+    for name, lines in records(path):
+        n = assign(utt_id(name))
+        if n is not None: writers[n].write(name, lines)
+    return [writer.close() for writer in writers]
+
+if __name__ == '__main__':
+
+    import sys
+    usage = 'Usage: python %s index <mlf>\n' %sys.argv[0]
+    usage += '       python %s filter <mlf> <id or mfc list> <output>\n' %sys.argv[0]
+    usage += '       python %s merge <output> <mlf> [<mlf> ...]\n' %sys.argv[0]
+    if len(sys.argv) < 3 or sys.argv[1] not in ['index', 'filter', 'merge']:
+        sys.stderr.write(usage)
+        sys.exit()
+
+    if sys.argv[1] == 'index':
+        print 'indexed [%d] utterances in [%s]' %(len(MLF(sys.argv[2])), index_file(sys.argv[2]))
+    elif sys.argv[1] == 'filter':
+        utts = set([utt_id(line.strip()) for line in open(sys.argv[3]) if line.strip()])
+        print 'wrote [%d] utterances to [%s]' %(filter(sys.argv[2], sys.argv[4], utts), sys.argv[4])
+    else:
+        print 'wrote [%d] utterances to [%s]' %(merge(sys.argv[3:], sys.argv[2]), sys.argv[2])
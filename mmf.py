@@ -0,0 +1,528 @@
+"""
+HTK model (MMF) files as NumPy arrays
+
+An HMMSet holds every Gaussian of every state in contiguous arrays:
+    means    (G x D)   float64
+    vars     (G x D)   float64 diagonal covariances
+    gconsts  (G)       log((2 pi)^D |Sigma|)
+    weights  (G)       mixture weight of each Gaussian in its state
+States own contiguous runs of Gaussians, state s being
+state_start[s] .. state_start[s+1]-1. Shared states (~s macros), shared
+transition matrices (~t) and variance floors (~v) keep their names, so a
+model written back out has the same macro structure. The text written is
+the form HTK itself writes (keywords in capitals, values as %e). Macro types
+this module does not model (e.g. ~j, ~b) and the global options (~o) are
+kept as the original text.
+
+compile() turns an MMF plus HMM list into a directory of .npy arrays named
+by the hash of their contents; load_compiled() memory-maps it, so worker
+processes loading the same model share one copy through the page cache.
+"""
+
+import os, re, fnmatch, cPickle, hashlib, shutil
+import numpy
+
+TOKEN = re.compile(r'~[a-z]|<[^>]*>|"[^"]*"|[^\s<>"~]+')
+MACRO = re.compile(r'~[a-z]')
+LOG_2PI = numpy.log(2 * numpy.pi)
+ARRAYS = ['means', 'vars', 'gconsts', 'weights', 'state_start']
+COMPILED_VERSION = 1
+
+def to_str(values):
+    return ''.join([' %e' %v for v in values])
+
+def compute_gconsts(vars):
+    return vars.shape[1] * LOG_2PI + numpy.log(vars).sum(axis=1)
+
+def load_hmm_list(path):
+    """
+    HMM list as [(logical name, physical name)]; a line with one name maps
+    it to itself
+    """
+    models = []
+    for line in open(path):
+        items = line.split()
+        if not items: continue
+        models.append((items[0], items[-1]))
+    return models
+
+class State:
+    def __init__(self, name=None):
+        self.name = name
+
+class TransP:
+    def __init__(self, matrix, name=None):
+        self.matrix = matrix
+        self.name = name
+
+class HMM:
+    """
+    states holds the state index of each emitting state (HTK states 2..N-1)
+    """
+    def __init__(self, name, states, transp):
+        self.name = name
+        self.states = states
+        self.transp = transp
+
+    def num_states(self):
+        return len(self.states) + 2
+
+class Parser:
+    """
+    Recursive descent over the tokens of one or more MMF texts
+    """
+
+    def __init__(self, hmmset):
+        self.hmmset = hmmset
+        self.means, self.vars, self.gconsts, self.weights = [], [], [], []
+        self.state_sizes = []
+
+    def parse(self, text):
+        self.text = text
+        self.tokens = TOKEN.findall(text)
+        self.macro_pos = [m.start() for m in MACRO.finditer(text)] + [len(text)]
+        self.pos = 0
+        self.macro_count = 0
+
+        while self.pos < len(self.tokens):
+            tok = self.next()
+            if tok[0] != '~': raise ValueError('expected a macro, found [%s]' %tok)
+            kind = tok[1]
+            start = self.macro_pos[self.macro_count - 1]
+
+            if kind == 'o':
+                self.parse_options()
+                self.add_raw(start)
+            elif kind in 'vsth':
+                name = self.next().strip('"')
+                if kind == 'v':
+                    self.expect('<VARIANCE>')
+                    self.hmmset.var_floors[name] = self.vector()
+                    self.hmmset.macros.append(('v', name))
+                elif kind == 's':
+                    state = self.parse_state(name)
+                    self.hmmset.macros.append(('s', state))
+                elif kind == 't':
+                    transp = self.parse_transp(name)
+                    self.hmmset.macros.append(('t', transp))
+                else:
+                    hmm = self.parse_hmm(name)
+                    self.hmmset.macros.append(('h', hmm))
+            else:
+                self.skip_to_macro()
+                self.add_raw(start)
+
+    def add_raw(self, start):
+        self.hmmset.macros.append(('raw', self.text[start:self.macro_pos[self.macro_count]]))
+
+    def next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        if tok[0] == '~': self.macro_count += 1
+        return tok
+
+    def peek(self):
+        if self.pos >= len(self.tokens): return ''
+        return self.tokens[self.pos].upper()
+
+    def expect(self, keyword):
+        tok = self.next()
+        if tok.upper() != keyword: raise ValueError('expected %s, found [%s]' %(keyword, tok))
+
+    def vector(self):
+        n = int(self.next())
+        values = numpy.array(self.tokens[self.pos:self.pos+n], dtype=numpy.float64)
+        self.pos += n
+        return values
+
+    def skip_to_macro(self):
+        while self.pos < len(self.tokens) and self.tokens[self.pos][0] != '~': self.pos += 1
+
+    def parse_options(self):
+        while self.pos < len(self.tokens) and self.tokens[self.pos][0] != '~':
+            tok = self.next().upper()
+            if tok == '<VECSIZE>': self.hmmset.vec_size = int(self.next())
+            elif tok in ['<DIAGC>', '<FULLC>', '<INVDIAGC>', '<LLTC>', '<XFORMC>']: self.hmmset.cov_kind = tok
+            elif tok.startswith('<') and tok.strip('<>').split('_')[0] in ['MFCC', 'FBANK', 'PLP', 'MELSPEC', 'USER', 'LPC', 'LPCEPSTRA']:
+                self.hmmset.parm_kind = tok.strip('<>')
+
+    def parse_gaussian(self, weight):
+        self.expect('<MEAN>')
+        mean = self.vector()
+        self.expect('<VARIANCE>')
+        var = self.vector()
+        gconst = None
+        if self.peek() == '<GCONST>':
+            self.next()
+            gconst = float(self.next())
+        self.means.append(mean)
+        self.vars.append(var)
+        self.gconsts.append(gconst)
+        self.weights.append(weight)
+
+    def parse_state(self, name=None):
+        size = 0
+        if self.peek() == '<NUMMIXES>':
+            self.next()
+            self.next()
+            while self.peek() == '<MIXTURE>':
+                self.next()
+                self.next()
+                self.parse_gaussian(float(self.next()))
+                size += 1
+        else:
+            self.parse_gaussian(1.0)
+            size = 1
+        self.state_sizes.append(size)
+        self.hmmset.states.append(State(name))
+        index = len(self.hmmset.states) - 1
+        if name is not None: self.hmmset.state_names[name] = index
+        return index
+
+    def parse_transp(self, name=None):
+        self.expect('<TRANSP>')
+        n = int(self.next())
+        matrix = numpy.array(self.tokens[self.pos:self.pos+n*n], dtype=numpy.float64).reshape((n, n))
+        self.pos += n * n
+        self.hmmset.transps.append(TransP(matrix, name))
+        index = len(self.hmmset.transps) - 1
+        if name is not None: self.hmmset.transp_names[name] = index
+        return index
+
+    def parse_hmm(self, name):
+        self.expect('<BEGINHMM>')
+        while self.peek() != '<NUMSTATES>': self.next()
+        self.next()
+        num_states = int(self.next())
+        states = []
+        for i in range(2, num_states):
+            self.expect('<STATE>')
+            self.next()
+            if self.peek() == '~S':
+                self.next()
+                states.append(self.hmmset.state_names[self.next().strip('"')])
+            else:
+                states.append(self.parse_state())
+        if self.peek() == '~T':
+            self.next()
+            transp = self.hmmset.transp_names[self.next().strip('"')]
+        else:
+            transp = self.parse_transp()
+        self.expect('<ENDHMM>')
+        self.hmmset.hmms.append(HMM(name, states, transp))
+        index = len(self.hmmset.hmms) - 1
+        self.hmmset.hmm_names[name] = index
+        return index
+
+    def finish(self):
+        hmmset = self.hmmset
+        hmmset.means = numpy.array(self.means)
+        hmmset.vars = numpy.array(self.vars)
+        hmmset.weights = numpy.array(self.weights)
+        hmmset.state_start = numpy.concatenate([[0], numpy.cumsum(self.state_sizes)]).astype(numpy.int64)
+        gconsts = compute_gconsts(hmmset.vars) if len(self.vars) else numpy.zeros(0)
+        for i, gconst in enumerate(self.gconsts):
+            if gconst is not None: gconsts[i] = gconst
+        hmmset.gconsts = gconsts
+        if hmmset.vec_size == 0 and len(self.means): hmmset.vec_size = hmmset.means.shape[1]
+
+class HMMSet:
+
+    def __init__(self):
+        self.vec_size = 0
+        self.parm_kind = ''
+        self.cov_kind = '<DIAGC>'
+        self.macros = []
+        self.var_floors = {}
+        self.states = []
+        self.state_names = {}
+        self.transps = []
+        self.transp_names = {}
+        self.hmms = []
+        self.hmm_names = {}
+        self.means = numpy.zeros((0, 0))
+        self.vars = numpy.zeros((0, 0))
+        self.gconsts = numpy.zeros(0)
+        self.weights = numpy.zeros(0)
+        self.state_start = numpy.zeros(1, dtype=numpy.int64)
+        self.hmm_list = []
+
+    def num_gaussians(self):
+        return len(self.means)
+
+    def num_states(self):
+        return len(self.states)
+
+    def state_gaussians(self, state):
+        return range(self.state_start[state], self.state_start[state+1])
+
+    def num_mixes(self):
+        return numpy.diff(self.state_start)
+
+    def gaussian_states(self):
+        """
+        Owning state of every Gaussian
+        """
+        return numpy.repeat(numpy.arange(len(self.states)), self.num_mixes())
+
+    def update_gconsts(self):
+        self.gconsts = compute_gconsts(self.vars)
+
+    def get_hmm(self, name):
+        return self.hmms[self.hmm_names[name]]
+
+    def tied_states(self, hmm_list=None):
+        """
+        Map every logical model in an HMM list (by default the one compiled
+        in) to its physical state indices
+        """
+        if hmm_list is not None: models = load_hmm_list(hmm_list)
+        else: models = self.hmm_list
+        return dict([(logical, self.get_hmm(physical).states) for logical, physical in models])
+
+    def set_state_sizes(self, sizes, means, vars, weights):
+        """
+        Replace all Gaussians; sizes gives the new number of Gaussians per state
+        """
+        self.means = numpy.asarray(means, dtype=numpy.float64)
+        self.vars = numpy.asarray(vars, dtype=numpy.float64)
+        self.weights = numpy.asarray(weights, dtype=numpy.float64)
+        self.state_start = numpy.concatenate([[0], numpy.cumsum(sizes)]).astype(numpy.int64)
+        self.update_gconsts()
+
+    ## Mixture operations, as HHEd's MU, MD and FA do them
+
+    def item_states(self, item):
+        """
+        State indices named by an HHEd item list such as
+        {(sil,sp).state[2-4].mix}; models are matched by physical name and
+        by logical name in the HMM list
+        """
+        match = re.match(r'\{\(?([^).]*)\)?\.state\[(\d+)(?:-(\d+))?\]', item.replace(' ', ''))
+        if not match: raise ValueError('unsupported item list [%s]' %item)
+        patterns = match.group(1).split(',')
+        first = int(match.group(2))
+        last = int(match.group(3) or first)
+        names = [(hmm.name, hmm.name) for hmm in self.hmms] + self.hmm_list
+        states = set()
+        for name, physical in names:
+            if not [p for p in patterns if fnmatch.fnmatchcase(name, p)]: continue
+            hmm = self.get_hmm(physical)
+            for i in range(max(first, 2), min(last, hmm.num_states() - 1) + 1): states.add(hmm.states[i-2])
+        return sorted(states)
+
+    def split_mixtures(self, states, target, perturb=0.2):
+        """
+        Grow each state in states to target Gaussians by repeatedly splitting
+        its heaviest one: the weight is halved and the means move apart by
+        perturb standard deviations
+        """
+        selected = numpy.zeros(self.num_states(), dtype=bool)
+        selected[states] = True
+        sizes = self.num_mixes()
+        means, vars, weights = self.means, self.vars, self.weights
+        while True:
+            split = selected & (sizes < target) & (sizes > 0)
+            if not split.any(): break
+            starts = numpy.concatenate([[0], numpy.cumsum(sizes)])
+            owner = numpy.repeat(numpy.arange(len(sizes)), sizes)
+            order = numpy.lexsort((-weights, owner))
+            heaviest = order[starts[:-1][split]]
+            offset = perturb * numpy.sqrt(vars[heaviest])
+            weights = weights.copy()
+            weights[heaviest] /= 2
+            means = means.copy()
+            means[heaviest] += offset
+            at = starts[1:][split]
+            means = numpy.insert(means, at, means[heaviest] - 2 * offset, axis=0)
+            vars = numpy.insert(vars, at, vars[heaviest], axis=0)
+            weights = numpy.insert(weights, at, weights[heaviest])
+            sizes = sizes + split
+        self.set_state_sizes(sizes, means, vars, weights)
+
+    def merge_mixtures(self, states, target):
+        """
+        Shrink each state in states to target Gaussians by repeatedly merging
+        the pair whose moment-matched merge loses the least likelihood
+        """
+        selected = set(states)
+        sizes, means, vars, weights = [], [], [], []
+        for s in range(self.num_states()):
+            g = self.state_gaussians(s)
+            w, m, v = self.weights[g], self.means[g], self.vars[g]
+            while s in selected and len(w) > target:
+                total = w[:,numpy.newaxis] + w
+                wi, wj = w[:,numpy.newaxis,numpy.newaxis], w[numpy.newaxis,:,numpy.newaxis]
+                mean = (wi * m[:,numpy.newaxis] + wj * m[numpy.newaxis]) / total[..., numpy.newaxis]
+                square = v + m * m
+                second = (wi * square[:,numpy.newaxis] + wj * square[numpy.newaxis]) / total[..., numpy.newaxis]
+                var = numpy.maximum(second - mean ** 2, 1e-10)
+                log_det = numpy.log(v).sum(axis=1)
+                loss = total * numpy.log(var).sum(axis=2) - (w * log_det)[:,numpy.newaxis] - w * log_det
+                loss[numpy.tril_indices(len(w))] = numpy.inf
+                i, j = numpy.unravel_index(numpy.argmin(loss), loss.shape)
+                keep = [k for k in range(len(w)) if k != j]
+                m[i], v[i], w[i] = mean[i,j], var[i,j], total[i,j]
+                m, v, w = m[keep], v[keep], w[keep]
+            sizes.append(len(w))
+            means.append(m)
+            vars.append(v)
+            weights.append(w)
+        self.set_state_sizes(sizes, numpy.concatenate(means), numpy.concatenate(vars), numpy.concatenate(weights))
+
+    def floor_variances(self, state_occ, fraction, name='varFloor1'):
+        """
+        Set the variance floor to fraction times the occupancy-weighted
+        average within-state variance and apply it
+        """
+        owner = self.gaussian_states()
+        occ = state_occ[owner] * self.weights
+        floor = fraction * numpy.dot(occ, self.vars) / max(occ.sum(), 1e-10)
+        if name not in self.var_floors:
+            at = len([kind for kind, item in self.macros if kind == 'raw' and item.startswith('~o')])
+            self.macros.insert(at, ('v', name))
+        self.var_floors[name] = floor
+        self.vars = numpy.maximum(self.vars, floor)
+        self.update_gconsts()
+
+    ## Text output
+
+    def format_state(self, state):
+        lines = []
+        gaussians = self.state_gaussians(state)
+        if len(gaussians) > 1: lines.append('<NUMMIXES> %d' %len(gaussians))
+        for mix, g in enumerate(gaussians):
+            if len(gaussians) > 1: lines.append('<MIXTURE> %d %e' %(mix + 1, self.weights[g]))
+            lines.append('<MEAN> %d' %self.vec_size)
+            lines.append(to_str(self.means[g]))
+            lines.append('<VARIANCE> %d' %self.vec_size)
+            lines.append(to_str(self.vars[g]))
+            lines.append('<GCONST> %e' %self.gconsts[g])
+        return '\n'.join(lines) + '\n'
+
+    def format_transp(self, transp):
+        matrix = self.transps[transp].matrix
+        return '<TRANSP> %d\n' %len(matrix) + ''.join(['%s\n' %to_str(row) for row in matrix])
+
+    def format_hmm(self, hmm):
+        """
+        <BEGINHMM> ... <ENDHMM> text of one model
+        """
+        hmm = self.hmms[hmm]
+        text = '<BEGINHMM>\n<NUMSTATES> %d\n' %hmm.num_states()
+        for i, state in enumerate(hmm.states):
+            text += '<STATE> %d\n' %(i + 2)
+            if self.states[state].name is not None: text += '~s "%s"\n' %self.states[state].name
+            else: text += self.format_state(state)
+        if self.transps[hmm.transp].name is not None: text += '~t "%s"\n' %self.transps[hmm.transp].name
+        else: text += self.format_transp(hmm.transp)
+        return text + '<ENDHMM>\n'
+
+    def format(self):
+        parts = []
+        for kind, item in self.macros:
+            if kind == 'raw': parts.append(item)
+            elif kind == 'v':
+                var = self.var_floors[item]
+                parts.append('~v "%s"\n<VARIANCE> %d\n%s\n' %(item, len(var), to_str(var)))
+            elif kind == 's': parts.append('~s "%s"\n' %self.states[item].name + self.format_state(item))
+            elif kind == 't': parts.append('~t "%s"\n' %self.transps[item].name + self.format_transp(item))
+            elif kind == 'h': parts.append('~h "%s"\n' %self.hmms[item].name + self.format_hmm(item))
+        return ''.join(parts)
+
+    def write(self, path):
+        fh = open(path, 'w')
+        fh.write(self.format())
+        fh.close()
+
+    ## Binary form: arrays plus the pickled structure
+
+    def structure(self):
+        return dict([(key, value) for key, value in self.__dict__.items() if key not in ARRAYS])
+
+    def save_binary(self, path):
+        arrays = dict([(key, self.__dict__[key]) for key in ARRAYS])
+        arrays['structure'] = numpy.frombuffer(cPickle.dumps(self.structure(), 2), dtype=numpy.uint8)
+        fh = open(path, 'wb')
+        numpy.savez(fh, **arrays)
+        fh.close()
+
+    def save_compiled(self, dir):
+        """
+        One .npy file per array plus the pickled structure, in dir
+        """
+        if not os.path.isdir(dir): os.makedirs(dir)
+        for key in ARRAYS:
+            numpy.save('%s/%s.npy' %(dir, key), numpy.ascontiguousarray(self.__dict__[key]))
+        cPickle.dump(self.structure(), open('%s/structure.pkl' %dir, 'wb'), 2)
+
+def load_binary(path):
+    data = numpy.load(path)
+    hmmset = HMMSet()
+    hmmset.__dict__.update(cPickle.loads(data['structure'].tostring()))
+    for key in ARRAYS:
+        hmmset.__dict__[key] = data[key]
+    return hmmset
+
+def content_hash(paths):
+    sha = hashlib.sha1('compiled model v%d' %COMPILED_VERSION)
+    for path in paths:
+        fh = open(path, 'rb')
+        while True:
+            data = fh.read(1 << 20)
+            if not data: break
+            sha.update(data)
+        fh.close()
+        sha.update('\0')
+    return sha.hexdigest()
+
+def compile(mmf_file, hmm_list, cache_dir, hmmset=None):
+    """
+    Compile an MMF and its HMM list into cache_dir/<content hash>, unless
+    that is already there; hmmset, if given, is mmf_file already parsed.
+    Returns the compiled directory.
+    """
+    dir = '%s/%s' %(cache_dir, content_hash([mmf_file, hmm_list]))
+    if os.path.isfile('%s/structure.pkl' %dir): return dir
+    if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+
+    if hmmset is None: hmmset = load(mmf_file)
+    hmmset.hmm_list = load_hmm_list(hmm_list)
+
+    ## Build under a temporary name so readers never see a partial model
+    tmp_dir = '%s.tmp.%d' %(dir, os.getpid())
+    if os.path.isdir(tmp_dir): shutil.rmtree(tmp_dir)
+    hmmset.save_compiled(tmp_dir)
+    try: os.rename(tmp_dir, dir)
+    except OSError: shutil.rmtree(tmp_dir)
+    return dir
+
+def load_compiled(dir):
+    """
+    Load a compiled model; the arrays are read-only memory maps
+    """
+    hmmset = HMMSet()
+    hmmset.__dict__.update(cPickle.load(open('%s/structure.pkl' %dir, 'rb')))
+    for key in ARRAYS:
+        hmmset.__dict__[key] = numpy.load('%s/%s.npy' %(dir, key), mmap_mode='r')
+    return hmmset
+
+def load(paths):
+    """
+    Parse one MMF (or a list of them, as with several HTK -H options)
+    """
+    if isinstance(paths, str): paths = [paths]
+    hmmset = HMMSet()
+    parser = Parser(hmmset)
+    for path in paths: parser.parse(open(path).read())
+    parser.finish()
+    return hmmset
+
+def count_gaussians(path):
+    """
+    Number of <MEAN> tokens in an MMF (as grep -c), read as a stream
+    without parsing the model
+    """
+    count = 0
+    for line in open(path): count += line.upper().count('<MEAN>')
+    return count
@@ -2,8 +2,10 @@
 Functions for running MMI
 """
 
-import os, sys
+import os, sys, time
 import util
+import coding
+import mlf
 
 class SplitList:
 
@@ -344,8 +346,9 @@ def create_num_lattices(model, output_dir, lm, dict, word_mlf):
 
     ## Split the word mlf labels to create inputs for HLRescore
     label_list = '%s/labels.list' %output_dir
-    cmd = 'grep "\.lab" %s > %s' %(word_mlf, label_list)
-    os.system(cmd)
+    fh = open(label_list, 'w')
+    for name in mlf.names(word_mlf): fh.write('"%s"\n' %name)
+    fh.close()
     split_label = SplitList(output_dir, label_list, by_path=False, by_letters=model.split_path_letters)
 
     ## Create the HLRescore commands
@@ -436,7 +439,6 @@ def run_iter(model, model_dir, num_lattice_dir, den_lattice_dir, root_dir, model
 
     output_dir = '%s/HMMI-%d-%d' %(root_dir, mix_size, iter)
     util.create_new_dir(output_dir)
-    utts_per_split = max(250, (1 + (model.setup_length / 200)))
 
     ## Create a config file to use with HLRescore
     hmmirest_config = '%s/hmmirest.config' %output_dir
@@ -471,13 +473,11 @@ def run_iter(model, model_dir, num_lattice_dir, den_lattice_dir, root_dir, model
         cmd += ' -M %s %s' %(output_dir, model_list)
         return cmd
 
-    ## Split up MFC list with unix split
-    cmd = 'split -a 4 -d -l %d %s %s/%s' %(utts_per_split, mfc_list, output_dir, 'mfc.list.')
-    os.system(cmd)
+    ## Split up MFC list into splits with equal numbers of frames
+    inputs = coding.split_mfc_list(model, mfc_list, output_dir)
 
     ## Create the HERest commands
     cmds = []
-    inputs = os.popen('ls %s/mfc.list.*' %output_dir).read().splitlines()
     split_num = 0
     for input in inputs:
         split_num += 1
@@ -502,10 +502,14 @@ def run_iter(model, model_dir, num_lattice_dir, den_lattice_dir, root_dir, model
     os.system('ls %s/HDR*.acc* > %s' %(output_dir, acc_file))
 
     ## Combine acc files into a new HMM
+    merge_time = time.time()
     cmd = hmmirest(acc_file, 0)
     cmd += ' >> %s/hmmirest.log' %output_dir
     if model.local == 1: os.system(cmd)
     else: util.run(cmd, output_dir)
+    acc_files = open(acc_file).read().split()
+    util.log_write(model.logfh, ' merged [%d] accumulators, read [%d] bytes in [%1.2f] sec'
+                   %(len(acc_files), util.file_bytes(acc_files), time.time() - merge_time))
     
     ## Clean up
     #os.system('rm -f %s/mfc.list.* %s/HER*.acc' %(output_dir, output_dir))
@@ -7,6 +7,7 @@ Dependencies:
     HTK (tested with version 3.4)
     sph2pipe (for audio processing)
     Python (tested with 2.6.6)
+    NumPy
 
 ----------
 Inputs:
@@ -26,23 +27,51 @@ import os, sys, re, random, time, gzip
 import util
 from util import log_write as log
 
+## Stage cache keys: the options that pick an implementation or stop
+## iterations early, and the modules whose code the training stages'
+## outputs depend on
+NATIVE_OPTIONS = [('train_params', option) for option in ['native_hcompv', 'native_herest', 'native_align',
+                  'align_retry_beams', 'native_tree', 'native_hled', 'native_mixup']]
+CONVERGE_OPTIONS = [('train_params', option) for option in ['converge', 'converge_gain', 'converge_min_iters',
+                    'converge_max_iters', 'converge_held_out']]
+TRAIN_MODULES = ['train_hmm', 'baum_welch', 'aligner', 'hled', 'hhed', 'mlf', 'mmf', 'gmm', 'coding', 'archive',
+                 'htk_param', 'util']
 
 class Model:
-    def __init__(self, config, train=False):
+    def __init__(self, config, train=False, resume=False):
         """
-        Initialize an HTK object from a parsed config file
+        Initialize an HTK object from a parsed config file; with resume,
+        train() skips the steps its journal records as done
 
         exp               [experiment directory path]
         data              [data directory path]
         dict              [dictionary path]
         tree_questions    [tree questions path]
         setup             [setup file path]
+        cache             [paths: optional stage cache dir shared by experiments (cache.py)]
         local             [only run locally (ignore jobs)]
         jobs              [max number of parallel jobs to create]
+        executor          [parallel backend: run-command (grid) or local (process pool)]
         verbose           [0, 1, 2, ...]
+        native            [front_end: code with mfcc.py instead of HCopy]
+        archive           [front_end: also pack features into <data>/feats (archive.py)]
+        native_hcompv     [train_params: global mean/variance over all data in-process]
+        native_herest     [train_params: Baum-Welch with baum_welch.py instead of HERest]
+        native_align      [train_params: forced alignment with aligner.py instead of HVite]
+        align_retry_beams [train_params: beams to retry failed alignments with, e.g. 500_1000_2000]
+        native_tree       [train_params: find the state tying threshold with clustering.py]
+        native_mixup      [train_params: mixup, mixdown and FA variance floor with hhed.py instead of HHEd]
+        native_hled       [train_params: label edits with hled.py instead of HLEd (2: run both and compare)]
+        native_semitied   [train_params: semi-tied transform with semitied.py instead of HERest -u stw]
+        converge          [train_params: stop Baum-Welch iterations early once lik/fr stops improving]
+        converge_gain     [train_params: relative lik/fr gain below which iterations stop, e.g. 0.001]
+        converge_min_iters [train_params: iterations each run at least before stopping]
+        converge_max_iters [train_params: iterations each run at most (0: the configured counts)]
+        converge_held_out [train_params: fraction of utterances held out of Baum-Welch to judge convergence on]
         """
 
         self.config = config
+        self.resume = resume
 
         ## Load training pipeline
         self.train_pipeline = {}
@@ -63,7 +92,7 @@ class Model:
 
         ## Create experiment directory and a new log file
         self.exp = config.get('paths', 'exp')
-        if self.train_pipeline and self.train_pipeline['clean']: os.system('rm -rf %s' %self.exp)
+        if self.train_pipeline and self.train_pipeline['clean'] and not resume: os.system('rm -rf %s' %self.exp)
         if not os.path.isdir(self.exp): os.makedirs(self.exp)
         self.log = '%s/log' %self.exp
         if os.path.isfile(self.log):
@@ -79,6 +108,7 @@ class Model:
         self.orig_dict = config.get('paths', 'dict')
         self.tree_questions = config.get('paths', 'tree_questions')
         self.setup = config.get('paths', 'setup')
+        self.cache_dir = util.get_option(config, 'paths', 'cache', '')
         if not self.setup.endswith('gz'): self.setup_length = int(os.popen('wc -l %s' %self.setup).read().split()[0])
         else: self.setup_length = int(os.popen('zcat %s | wc -l' %self.setup).read().split()[0])
 
@@ -86,6 +116,8 @@ class Model:
         self.local = int(config.get('settings', 'local'))
         self.jobs = int(config.get('settings', 'jobs'))
         self.verbose = int(config.get('settings', 'verbose'))
+        self.executor = util.get_option(config, 'settings', 'executor', 'run-command')
+        util.set_executor(self.executor)
 
         ## Load HMM parameters
         self.states = int(config.get('hmm_params', 'states'))
@@ -101,10 +133,25 @@ class Model:
         self.frame_length = int(config.get('front_end', 'frame_length'))
         self.delta_window = int(config.get('front_end', 'delta_window'))
         self.num_cepstra = int(config.get('front_end', 'num_cepstra'))
+        self.native_front_end = util.get_option(config, 'front_end', 'native', 0)
+        self.use_archive = util.get_option(config, 'front_end', 'archive', 0)
 
         ## Load training parameters
         self.split_path_letters = int(config.get('train_params', 'split_path_letters'))
         self.var_floor_fraction = float(config.get('train_params', 'var_floor_fraction'))
+        self.native_hcompv = util.get_option(config, 'train_params', 'native_hcompv', 0)
+        self.native_herest = util.get_option(config, 'train_params', 'native_herest', 0)
+        self.native_align = util.get_option(config, 'train_params', 'native_align', 0)
+        self.align_retry_beams = [int(b) for b in util.get_option(config, 'train_params', 'align_retry_beams', '500_1000_2000').split('_') if b]
+        self.native_tree = util.get_option(config, 'train_params', 'native_tree', 0)
+        self.native_hled = util.get_option(config, 'train_params', 'native_hled', 0)
+        self.native_mixup = util.get_option(config, 'train_params', 'native_mixup', 0)
+        self.native_semitied = util.get_option(config, 'train_params', 'native_semitied', 0)
+        self.converge = util.get_option(config, 'train_params', 'converge', 0)
+        self.converge_gain = util.get_option(config, 'train_params', 'converge_gain', 0.001)
+        self.converge_min_iters = util.get_option(config, 'train_params', 'converge_min_iters', 2)
+        self.converge_max_iters = util.get_option(config, 'train_params', 'converge_max_iters', 0)
+        self.converge_held_out = util.get_option(config, 'train_params', 'converge_held_out', 0.0)
         self.lm_order = int(config.get('train_params', 'lm_order'))
         self.initial_mono_iters = int(config.get('train_params', 'initial_mono_iters'))
         self.mono_iters = int(config.get('train_params', 'mono_iters'))
@@ -122,6 +169,9 @@ class Model:
         ## Shared files created during training
         self.htk_dict = '%s/dict' %self.exp
         self.mfc_list = '%s/mfc.list' %self.exp
+        self.held_out_list = '%s/mfc.list.held_out' %self.exp
+        self.mfc_frames = '%s/mfc.frames' %self.exp
+        self.model_cache = '%s/model_cache' %self.exp
         self.coding_root = '%s/Coding' %self.exp
         self.mono_root = '%s/Mono' %self.exp
         self.mixup_mono_root = '%s/Mono_mixup' %self.exp
@@ -143,6 +193,143 @@ class Model:
         self.tri_list = '%s/tri.list' %self.exp
         self.tied_list = '%s/tied.list' %self.exp
 
+    def step(self, stage, mix_size, step, func, *args):
+        """
+        Run one step of a stage, func(*args) -> (output HMM dir or None,
+        lik/fr or None), and journal it. A step the journal already holds
+        is skipped and its recorded result returned.
+        """
+        entry = self.journal.get(stage, mix_size, step)
+        if entry is not None:
+            log(self.logfh, 'resume: skipped [%s %d %s], done in [%s]' %(stage, mix_size, step, entry.hmm_dir or '-'))
+            return entry.hmm_dir, entry.lik
+        hmm_dir, lik = func(*args)
+        self.journal.record(stage, mix_size, step, hmm_dir, lik)
+        return hmm_dir, lik
+
+    def bw_iter(self, stage, root_dir, prev_dir, mlf_file, model_list, mix_size, iter, extra=''):
+        """
+        One journaled iteration of Baum-Welch; returns the new HMM dir
+        """
+        import train_hmm
+        def run():
+            hmm_dir, k, L = train_hmm.run_iter(self, root_dir, prev_dir, mlf_file, model_list, mix_size, iter, extra)
+            log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+            return hmm_dir, L
+        return self.step(stage, mix_size, iter, run)[0]
+
+    def mixup(self, stage, root_dir, prev_dir, model_list, mix_size, estimateVarFloor=0):
+        """
+        Journaled mixup to mix_size Gaussians; returns the new HMM dir
+        """
+        import train_hmm
+        def run():
+            hmm_dir = train_hmm.mixup(self, root_dir, prev_dir, model_list, mix_size, estimateVarFloor)
+            log(self.logfh, 'mixed up to [%d] in [%s]' %(mix_size, hmm_dir))
+            return hmm_dir, None
+        return self.step(stage, mix_size, 'mixup', run)[0]
+
+    def bw_iters(self, stage, root_dir, hmm_dir, mlf_file, model_list, mix_size, first, count):
+        """
+        Journaled Baum-Welch iterations first, first+1, ...: count of them,
+        or with converge, between converge_min_iters and converge_max_iters
+        (count if 0), stopping once the relative gain in lik/fr is below
+        converge_gain, or held-out lik/fr stops improving (then the best
+        model is kept). Returns (HMM dir, last iteration number).
+        """
+        import train_hmm
+        max_iters = count
+        if self.converge and self.converge_max_iters > 0: max_iters = self.converge_max_iters
+        best_dir, best_lik, prev_lik = hmm_dir, None, None
+        iter = first - 1
+        for iter in range(first, first+max_iters):
+            hmm_dir = self.bw_iter(stage, root_dir, hmm_dir, mlf_file, model_list, mix_size, iter)
+            if not self.converge: continue
+
+            ## Training lik/fr is that of the model going into the iteration
+            lik = self.journal.get(stage, mix_size, iter).lik
+            held_out = None
+            if self.converge_held_out > 0:
+                def score():
+                    L = train_hmm.score_held_out(self, hmm_dir, mlf_file, model_list)
+                    if L is not None: log(self.logfh, 'held-out lik/fr [%1.4f] in [%s]' %(L, hmm_dir))
+                    return None, L
+                held_out = self.step(stage, mix_size, '%d.held_out' %iter, score)[1]
+
+            done = iter - first + 1
+            if held_out is not None:
+                if best_lik is not None and held_out <= best_lik and done >= self.converge_min_iters:
+                    log(self.logfh, 'converged after [%d] iterations: held-out lik/fr [%1.4f] not above [%1.4f], keeping [%s]'
+                        %(done, held_out, best_lik, best_dir))
+                    return best_dir, iter
+                if best_lik is None or held_out > best_lik: best_dir, best_lik = hmm_dir, held_out
+                continue
+            best_dir = hmm_dir
+            if prev_lik is not None and lik is not None and done >= self.converge_min_iters:
+                gain = float(lik - prev_lik) / abs(prev_lik)
+                if gain < self.converge_gain:
+                    log(self.logfh, 'converged after [%d] iterations: lik/fr gain [%1.6f] below [%1.6f]' %(done, gain, self.converge_gain))
+                    return hmm_dir, iter
+            prev_lik = lik
+        if self.converge and best_lik is not None: return best_dir, iter
+        return hmm_dir, iter
+
+    def set_final_dir(self, stage, root_dir, hmm_dir):
+        """
+        Record the HMM dir a stage finished with as <root_dir>/<stage>.final,
+        so it travels with the root dir (e.g. through the stage cache)
+        """
+        fh = open('%s/%s.final' %(root_dir, stage), 'w')
+        fh.write('%s\n' %os.path.basename(hmm_dir))
+        fh.close()
+
+    def final_dir(self, stage, root_dir, default):
+        """
+        The HMM dir a stage finished with, or default if it didn't record one
+        """
+        path = '%s/%s.final' %(root_dir, stage)
+        if not os.path.isfile(path): return default
+        return '%s/%s' %(root_dir, open(path).read().strip())
+
+    def stage_key(self, stage, files, options, modules):
+        """
+        Stage cache key of a stage's input files, config options
+        ((section, option), or (section, None) for a whole section) and
+        modules; None when the stage shouldn't use the cache: no cache is
+        configured, or a resumed run has already started the stage here
+        """
+        if not self.cache_dir: return None
+        if self.resume and [key for key in self.journal.entries if key[0] == stage and key[2] != 'cached']: return None
+        values = []
+        for section, option in options:
+            if option is None: values.extend([(section, name, value) for name, value in sorted(self.config.items(section))])
+            elif self.config.has_option(section, option): values.append((section, option, self.config.get(section, option)))
+            else: values.append((section, option, None))
+        import cache
+        return cache.stage_key(stage, files, values, cache.module_files(modules))
+
+    def restore_stage(self, stage, key):
+        """
+        Copy a stage's outputs from the stage cache; returns False if the
+        stage has to run
+        """
+        if self.journal.get(stage, 0, 'cached'):
+            log(self.logfh, 'resume: skipped [%s], restored from the stage cache' %stage)
+            return True
+        if key is None: return False
+        import cache
+        restored = cache.StageCache(self.cache_dir).restore(stage, key, self.exp)
+        if restored is None: return False
+        log(self.logfh, 'restored [%d] outputs of [%s] from the stage cache [%s]' %(len(restored), stage, key))
+        self.journal.record(stage, 0, 'cached')
+        return True
+
+    def store_stage(self, stage, key, outputs):
+        if key is None: return
+        import cache
+        count = cache.StageCache(self.cache_dir).store(stage, key, self.exp, outputs)
+        log(self.logfh, 'stored [%d] outputs of [%s] in the stage cache [%s]' %(count, stage, key))
+
     def train(self):
 
         ## Copy config file to the experiment dir
@@ -150,336 +337,499 @@ class Model:
         self.config.write(open(config_output, 'w'))
         log(self.logfh, 'TRAINING with config [%s]' %config_output)
 
-        if self.train_pipeline['coding']:
+        ## Journal of completed steps
+        import journal
+        self.journal = journal.Journal('%s/journal' %self.exp, self.resume)
+        if self.resume: log(self.logfh, 'resuming with [%d] steps done in [%s]' %(len(self.journal), self.journal.path))
+
+        ## One pool of job slots for all the tasks running at once
+        if self.local != 1: util.set_job_slots(util.get_num_workers(self.jobs))
+        dict_mfc_list = '%s/mfc.list.filtered.by.dict' %self.misc
+
+        ## The HMM dir each stage finished with (set_final_dir), defaulting
+        ## to the last one of the configured iteration counts
+        num_mono = self.mono_mixup_schedule[-1]
+        num_tri = self.tri_mixup_schedule[-1]
+        finals = {'flat_start': (self.mono_root, '%s/HMM-1-%d' %(self.mono_root, self.initial_mono_iters+self.mono_iters)),
+                  'mixup_mono': (self.mixup_mono_root, '%s/HMM-%d-%d' %(self.mixup_mono_root, num_mono, self.mono_iters)),
+                  'mixdown_mono': (self.mixdown_mono_root, '%s/HMM-1-0' %self.mixdown_mono_root),
+                  'mono_to_tri': (self.xword_root, '%s/HMM-1-%d' %(self.xword_root, self.initial_tri_iters+self.tri_iters+1)),
+                  'mixup_tri': (self.xword_root, '%s/HMM-%d-%d' %(self.xword_root, num_tri, self.tri_iters_per_split)),
+                  'mono_to_tri_from_xword': (self.xword_1_root, '%s/HMM-1-%d' %(self.xword_1_root, self.tri_iters+2)),
+                  'mixup_tri_2': (self.xword_1_root, '%s/HMM-%d-%d' %(self.xword_1_root, num_tri, self.tri_iters_per_split)),
+                  'diag': (self.diag_root, '%s/HMM-%d-%d' %(self.diag_root, num_tri, self.tri_iters_per_split))}
+        def final(stage):
+            root_dir, default = finals[stage]
+            return self.final_dir(stage, root_dir, default)
+
+        def coding_task():
             log(self.logfh, 'CODING started')
             import coding
-            util.create_new_dir(self.coding_root)
-            coding.create_config(self)
-            count = coding.wav_to_mfc(self, self.coding_root, self.mfc_list)
-            os.system('cp %s %s/mfc.list.original' %(self.mfc_list, self.misc))
-            log(self.logfh, 'wrote mfc files [%d]' %count)
+            def code():
+                if not os.path.isdir(self.coding_root): os.makedirs(self.coding_root)
+                coding.create_config(self)
+                count = coding.wav_to_mfc(self, self.coding_root, self.mfc_list)
+                os.system('cp %s %s/mfc.list.original' %(self.mfc_list, self.misc))
+                log(self.logfh, 'wrote mfc files [%d]' %count)
+                coding.write_frame_counts(self.mfc_list, self.mfc_frames)
+                log(self.logfh, 'cached frame counts [%s]' %self.mfc_frames)
+                return None, None
+            self.step('coding', 0, 'coding', code)
             log(self.logfh, 'CODING finished')
 
-        if self.train_pipeline['lm']:
+        def lm_task():
             log(self.logfh, 'MLF/LM/DICT started')
             import dict_and_lm
-            phone_set = dict_and_lm.fix_cmu_dict(self.orig_dict, self.htk_dict)
-            num_utts, words = dict_and_lm.make_mlf_from_transcripts(self, self.htk_dict, self.setup, self.data, self.word_mlf, self.mfc_list)
-            log(self.logfh, 'wrote word mlf [%d utts] [%s]' %(num_utts, self.word_mlf))
-            os.system('cp %s %s/mfc.list.filtered.by.dict' %(self.mfc_list, self.misc))
-            num_entries = dict_and_lm.make_train_dict(self.htk_dict, self.train_dict, words)
-            dict_and_lm.make_decode_dict(self.htk_dict, self.decode_dict, words)
-            log(self.logfh, 'wrote training dictionary [%d entries] [%s]' %(num_entries, self.train_dict))
-
-            util.create_new_dir(self.lm_dir)
-            train_vocab = '%s/vocab' %self.lm_dir
-            ppl = dict_and_lm.build_lm_from_mlf(self, self.word_mlf, self.train_dict, train_vocab, self.lm_dir, self.lm, self.lm_order)
-            log(self.logfh, 'wrote lm [%s] training ppl [%1.2f]' %(self.lm, ppl))
+            key = self.stage_key('lm', [self.orig_dict, self.setup],
+                                 [('paths', 'data'), ('train_params', 'lm_order')], ['dict_and_lm', 'mlf', 'coding'])
+            if not self.restore_stage('lm', key):
+                def build():
+                    phone_set = dict_and_lm.fix_cmu_dict(self.orig_dict, self.htk_dict)
+                    num_utts, words = dict_and_lm.make_mlf_from_transcripts(self, self.htk_dict, self.setup, self.data, self.word_mlf, dict_mfc_list)
+                    log(self.logfh, 'wrote word mlf [%d utts] [%s]' %(num_utts, self.word_mlf))
+                    num_entries = dict_and_lm.make_train_dict(self.htk_dict, self.train_dict, words)
+                    dict_and_lm.make_decode_dict(self.htk_dict, self.decode_dict, words)
+                    log(self.logfh, 'wrote training dictionary [%d entries] [%s]' %(num_entries, self.train_dict))
+
+                    util.create_new_dir(self.lm_dir)
+                    train_vocab = '%s/vocab' %self.lm_dir
+                    ppl = dict_and_lm.build_lm_from_mlf(self, self.word_mlf, self.train_dict, train_vocab, self.lm_dir, self.lm, self.lm_order)
+                    log(self.logfh, 'wrote lm [%s] training ppl [%1.2f]' %(self.lm, ppl))
+                    return None, None
+                self.step('lm', 0, 'lm', build)
+                self.store_stage('lm', key, [self.htk_dict, self.word_mlf, dict_mfc_list, self.train_dict, self.decode_dict, self.lm_dir, self.lm])
             log(self.logfh, 'MLF/LM/DICT finished')
             
-        if self.train_pipeline['flat_start']:
+        def lm_list_task():
+            ## The coded mfc list is replaced by the one filtered by dict
+            ## once both are done
+            def use_dict_list():
+                os.system('cp %s %s' %(dict_mfc_list, self.mfc_list))
+                log(self.logfh, 'using mfc list filtered by dict [%s]' %self.mfc_list)
+
+                ## Every n-th utterance is held out of Baum-Welch to judge
+                ## convergence on
+                if os.path.isfile(self.held_out_list): os.remove(self.held_out_list)
+                if self.converge and self.converge_held_out > 0:
+                    mfcs = open(self.mfc_list).read().split()
+                    every = max(1, int(round(1 / self.converge_held_out)))
+                    fh = open(self.held_out_list, 'w')
+                    for mfc in mfcs[every-1::every]: fh.write('%s\n' %mfc)
+                    fh.close()
+                    log(self.logfh, 'held out [%d] of [%d] utterances [%s]' %(len(mfcs[every-1::every]), len(mfcs), self.held_out_list))
+                return None, None
+            self.step('lm', 0, 'mfc_list', use_dict_list)
+
+        def flat_start_task():
             log(self.logfh, 'FLAT START started')
             import init_hmm
-            init_hmm.word_to_phone_mlf(self, self.train_dict, self.word_mlf, self.phone_mlf, self.phone_list)
-            log(self.logfh, 'wrote phone mlf [%s]' %self.phone_mlf)
-
-            os.system('cp %s %s/phone.mlf.from.dict' %(self.phone_mlf, self.misc))
-            os.system('bzip2 -f %s/phone.mlf.from.dict' %self.misc)
-            init_hmm.make_proto_hmm(self, self.mfc_list, self.proto_hmm)
-            hmm_dir, num_mfcs = init_hmm.initialize_hmms(self, self.mono_root, self.mfc_list, self.phone_list, self.proto_hmm)
-            log(self.logfh, 'initialized an HMM for each phone in [%s]' %hmm_dir)
-            log(self.logfh, 'used [%d] mfc files to compute variance floor' %num_mfcs)
-
-            import train_hmm
-            for iter in range(1, self.initial_mono_iters+1):
-                hmm_dir, k, L = train_hmm.run_iter(self, self.mono_root, hmm_dir, self.phone_mlf, self.phone_list, 1, iter, '')
-                log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
-
-            align_config = '%s/config.align' %self.mono_root
-            fh = open(align_config, 'w')
-            fh.write('HPARM: TARGETKIND = MFCC_0_D_A_Z\n')
-            fh.close()
-            
-            align_dir = train_hmm.align(self, self.mono_root, self.mfc_list, hmm_dir, self.word_mlf, self.phone_mlf, self.phone_list, self.train_dict, align_config)
-            log(self.logfh, 'aligned with model in [%s], wrote phone mlf [%s]' %(hmm_dir, self.phone_mlf))
-            os.system('cp %s %s/mfc.list.filtered.by.mono.align' %(self.mfc_list, self.misc))
-
-            os.system('cp %s %s/phone.mlf.from.mono.align' %(self.phone_mlf, self.misc))
-            os.system('bzip2 -f %s/phone.mlf.from.mono.align' %self.misc)
-
-            for iter in range(self.initial_mono_iters+1, self.initial_mono_iters+1+self.mono_iters):
-                hmm_dir, k, L = train_hmm.run_iter(self, self.mono_root, hmm_dir, self.phone_mlf, self.phone_list, 1, iter, '')
-                log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
-
+            key = self.stage_key('flat_start', [self.train_dict, self.word_mlf, self.mfc_list, self.held_out_list, self.setup, self.mfc_config],
+                                 [('paths', 'data'), ('front_end', None), ('hmm_params', 'states'),
+                                  ('train_params', 'var_floor_fraction'), ('train_params', 'initial_mono_iters'),
+                                  ('train_params', 'mono_iters')] + NATIVE_OPTIONS + CONVERGE_OPTIONS, ['init_hmm'] + TRAIN_MODULES)
+            if not self.restore_stage('flat_start', key):
+                import train_hmm
+                def init():
+                    init_hmm.word_to_phone_mlf(self, self.train_dict, self.word_mlf, self.phone_mlf, self.phone_list)
+                    log(self.logfh, 'wrote phone mlf [%s]' %self.phone_mlf)
+
+                    os.system('cp %s %s/phone.mlf.from.dict' %(self.phone_mlf, self.misc))
+                    os.system('bzip2 -f %s/phone.mlf.from.dict' %self.misc)
+                    init_hmm.make_proto_hmm(self, self.mfc_list, self.proto_hmm)
+                    hmm_dir, num_mfcs = init_hmm.initialize_hmms(self, self.mono_root, self.mfc_list, self.phone_list, self.proto_hmm)
+                    log(self.logfh, 'initialized an HMM for each phone in [%s]' %hmm_dir)
+                    log(self.logfh, 'used [%d] mfc files to compute variance floor' %num_mfcs)
+                    return hmm_dir, None
+                hmm_dir = self.step('flat_start', 1, 'init', init)[0]
+
+                hmm_dir, iter = self.bw_iters('flat_start', self.mono_root, hmm_dir, self.phone_mlf, self.phone_list, 1, 1, self.initial_mono_iters)
+
+                def realign(hmm_dir):
+                    align_config = '%s/config.align' %self.mono_root
+                    fh = open(align_config, 'w')
+                    fh.write('HPARM: TARGETKIND = MFCC_0_D_A_Z\n')
+                    fh.close()
+
+                    align_dir = train_hmm.align(self, self.mono_root, self.mfc_list, hmm_dir, self.word_mlf, self.phone_mlf, self.phone_list, self.train_dict, align_config)
+                    log(self.logfh, 'aligned with model in [%s], wrote phone mlf [%s]' %(hmm_dir, self.phone_mlf))
+                    os.system('cp %s %s/mfc.list.filtered.by.mono.align' %(self.mfc_list, self.misc))
+
+                    os.system('cp %s %s/phone.mlf.from.mono.align' %(self.phone_mlf, self.misc))
+                    os.system('bzip2 -f %s/phone.mlf.from.mono.align' %self.misc)
+                    return None, None
+                self.step('flat_start', 1, 'align', realign, hmm_dir)
+
+                hmm_dir, iter = self.bw_iters('flat_start', self.mono_root, hmm_dir, self.phone_mlf, self.phone_list, 1, iter+1, self.mono_iters)
+                self.set_final_dir('flat_start', self.mono_root, hmm_dir)
+                self.store_stage('flat_start', key, [self.mono_root, self.phone_mlf, self.phone_list, self.proto_hmm, self.mfc_list,
+                                                     '%s/phone.mlf.from.dict.bz2' %self.misc,
+                                                     '%s/mfc.list.filtered.by.mono.align' %self.misc,
+                                                     '%s/phone.mlf.from.mono.align.bz2' %self.misc])
             log(self.logfh, 'FLAT START finished')
 
-        if self.train_pipeline['mixup_mono']:
+        def mixup_mono_task():
             log(self.logfh, 'MIXUP MONO started')
-            import train_hmm
-
-            hmm_dir = '%s/HMM-%d-%d' %(self.mono_root, 1, self.initial_mono_iters+self.mono_iters)
+            mono_dir = final('flat_start')
+            key = self.stage_key('mixup_mono', ['%s/MMF' %mono_dir, self.phone_mlf, self.phone_list, self.mfc_list, self.held_out_list],
+                                 [('hmm_params', 'states'), ('train_params', 'mono_mixup_schedule'),
+                                  ('train_params', 'mono_iters')] + NATIVE_OPTIONS + CONVERGE_OPTIONS, TRAIN_MODULES)
+            if not self.restore_stage('mixup_mono', key):
+                hmm_dir = mono_dir
             
-            ## mixup everything
-            for mix_size in self.mono_mixup_schedule:
-                hmm_dir = train_hmm.mixup(self, self.mixup_mono_root, hmm_dir, self.phone_list, mix_size)
-                log(self.logfh, 'mixed up to [%d] in [%s]' %(mix_size, hmm_dir))
-                for iter in range(1, self.mono_iters+1):
-                    hmm_dir, k, L = train_hmm.run_iter(self, self.mixup_mono_root, hmm_dir, self.phone_mlf, self.phone_list, mix_size, iter, '')
-                    log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
-
+                ## mixup everything
+                for mix_size in self.mono_mixup_schedule:
+                    hmm_dir = self.mixup('mixup_mono', self.mixup_mono_root, hmm_dir, self.phone_list, mix_size)
+                    hmm_dir = self.bw_iters('mixup_mono', self.mixup_mono_root, hmm_dir, self.phone_mlf, self.phone_list, mix_size, 1, self.mono_iters)[0]
+                self.set_final_dir('mixup_mono', self.mixup_mono_root, hmm_dir)
+                self.store_stage('mixup_mono', key, [self.mixup_mono_root])
             log(self.logfh, 'MIXUP MONO finished')
 
-        if self.train_pipeline['mixdown_mono']:
+        def mixdown_mono_task():
             log(self.logfh, 'MIXDOWN MONO started')
-            import train_hmm
-
-            num_gaussians = self.mono_mixup_schedule[-1]
-            hmm_dir = '%s/HMM-%d-%d' %(self.mixup_mono_root, num_gaussians, self.mono_iters)
-            train_hmm.mixdown_mono(self, self.mixdown_mono_root, hmm_dir, self.phone_list)
-
+            hmm_dir = final('mixup_mono')
+            key = self.stage_key('mixdown_mono', ['%s/MMF' %hmm_dir, self.phone_list],
+                                 [('hmm_params', 'states'), ('train_params', 'mono_mixup_schedule'),
+                                  ('train_params', 'mono_iters')] + NATIVE_OPTIONS, TRAIN_MODULES)
+            if not self.restore_stage('mixdown_mono', key):
+                import train_hmm
+
+                def mixdown():
+                    return train_hmm.mixdown_mono(self, self.mixdown_mono_root, hmm_dir, self.phone_list), None
+                self.set_final_dir('mixdown_mono', self.mixdown_mono_root, self.step('mixdown_mono', 1, 'mixdown', mixdown)[0])
+                self.store_stage('mixdown_mono', key, [self.mixdown_mono_root])
             log(self.logfh, 'MIXDOWN MONO finished')
 
-        if self.train_pipeline['mono_to_tri']:
+        def mono_to_tri_task():
             log(self.logfh, 'MONO TO TRI started')
             import train_hmm
 
             if self.train_pipeline['mixdown_mono']:
-                mono_final_dir = '%s/HMM-1-0' %self.mixdown_mono_root
+                mono_final_dir = final('mixdown_mono')
             else:
-                mono_final_dir = '%s/HMM-%d-%d' %(self.mono_root, 1, self.initial_mono_iters+self.mono_iters)
-                
-            hmm_dir = train_hmm.mono_to_tri(self, self.xword_root, mono_final_dir, self.phone_mlf, self.tri_mlf, self.phone_list, self.tri_list)
-            log(self.logfh, 'initialized triphone models in [%s]' %hmm_dir)
-            log(self.logfh, 'created triphone mlf [%s]' %self.tri_mlf)
-
-            os.system('cp %s %s/tri.mlf.from.mono.align' %(self.tri_mlf, self.misc))
-            os.system('bzip2 -f %s/tri.mlf.from.mono.align' %self.misc)
-            os.system('cp %s %s/tri.list.from.mono.align' %(self.tri_list, self.misc))
-
-            for iter in range(1, self.initial_tri_iters+1):
-                hmm_dir, k, L = train_hmm.run_iter(self, self.xword_root, hmm_dir, self.tri_mlf, self.tri_list, 1, iter, '')
-                log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+                mono_final_dir = final('flat_start')
+
+            key = self.stage_key('mono_to_tri', ['%s/MMF' %mono_final_dir, self.phone_mlf, self.phone_list, self.mfc_list, self.held_out_list,
+                                                 self.tree_questions],
+                                 [('hmm_params', None), ('train_params', 'initial_tri_iters'), ('train_params', 'tri_iters')]
+                                 + NATIVE_OPTIONS + CONVERGE_OPTIONS,
+                                 ['clustering', 'questions', 'triphones'] + TRAIN_MODULES)
+            if not self.restore_stage('mono_to_tri', key):
+                def init():
+                    hmm_dir = train_hmm.mono_to_tri(self, self.xword_root, mono_final_dir, self.phone_mlf, self.tri_mlf, self.phone_list, self.tri_list)
+                    log(self.logfh, 'initialized triphone models in [%s]' %hmm_dir)
+                    log(self.logfh, 'created triphone mlf [%s]' %self.tri_mlf)
+
+                    os.system('cp %s %s/tri.mlf.from.mono.align' %(self.tri_mlf, self.misc))
+                    os.system('bzip2 -f %s/tri.mlf.from.mono.align' %self.misc)
+                    os.system('cp %s %s/tri.list.from.mono.align' %(self.tri_list, self.misc))
+                    return hmm_dir, None
+                hmm_dir = self.step('mono_to_tri', 1, 'init', init)[0]
+
+                hmm_dir, iter = self.bw_iters('mono_to_tri', self.xword_root, hmm_dir, self.tri_mlf, self.tri_list, 1, 1, self.initial_tri_iters)
             
-            xword_tie_dir = '%s/HMM-%d-%d' %(self.xword_root, 1, self.initial_tri_iters+1)
-            hmm_dir = train_hmm.tie_states_search(self, xword_tie_dir, hmm_dir, self.phone_list, self.tri_list, self.tied_list)
-            log(self.logfh, 'tied states in [%s]' %hmm_dir)
-
-            os.system('cp %s %s/tied.list.initial' %(self.tied_list, self.misc))
-
-            hmm_dir = '%s/HMM-%d-%d' %(self.xword_root, 1, self.initial_tri_iters+1)
-            for iter in range(self.initial_tri_iters+2, self.initial_tri_iters+1+self.tri_iters+1):
-                hmm_dir, k, L = train_hmm.run_iter(self, self.xword_root, hmm_dir, self.tri_mlf, self.tied_list, 1, iter, '')
-                log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
-
+                xword_tie_dir = '%s/HMM-%d-%d' %(self.xword_root, 1, iter+1)
+                def tie(hmm_dir):
+                    hmm_dir = train_hmm.tie_states_search(self, xword_tie_dir, hmm_dir, self.phone_list, self.tri_list, self.tied_list)
+                    log(self.logfh, 'tied states in [%s]' %hmm_dir)
+
+                    os.system('cp %s %s/tied.list.initial' %(self.tied_list, self.misc))
+                    return hmm_dir, None
+                hmm_dir = self.step('mono_to_tri', 1, 'tie', tie, hmm_dir)[0]
+
+                hmm_dir = self.bw_iters('mono_to_tri', self.xword_root, hmm_dir, self.tri_mlf, self.tied_list, 1, iter+2, self.tri_iters)[0]
+                self.set_final_dir('mono_to_tri', self.xword_root, hmm_dir)
+                self.store_stage('mono_to_tri', key, [self.xword_root, self.tri_mlf, self.tri_list, self.tied_list,
+                                                      '%s/tri.mlf.from.mono.align.bz2' %self.misc,
+                                                      '%s/tri.list.from.mono.align' %self.misc,
+                                                      '%s/tied.list.initial' %self.misc,
+                                                      '%s/all_tri.list' %self.exp])
             log(self.logfh, 'MONO TO TRI finished')
 
-        if self.train_pipeline['mixup_tri']:
+        def mixup_tri_task():
             log(self.logfh, 'MIXUP TRI started')
-            import train_hmm
 
             ## mixup everything
-            start_gaussians = 1
-            start_iter = self.initial_tri_iters+self.tri_iters+1
-            hmm_dir = '%s/HMM-%d-%d' %(self.xword_root, start_gaussians, start_iter)
+            hmm_dir = final('mono_to_tri')
             for mix_size in self.tri_mixup_schedule:
                 if mix_size==2:
-                    hmm_dir = train_hmm.mixup(self, self.xword_root, hmm_dir, self.tied_list, mix_size, estimateVarFloor=1)
+                    hmm_dir = self.mixup('mixup_tri', self.xword_root, hmm_dir, self.tied_list, mix_size, estimateVarFloor=1)
                 else:
-                    hmm_dir = train_hmm.mixup(self, self.xword_root, hmm_dir, self.tied_list, mix_size)
-                log(self.logfh, 'mixed up to [%d] in [%s]' %(mix_size, hmm_dir))
-                for iter in range(1, self.tri_iters_per_split+1):
-                    hmm_dir, k, L = train_hmm.run_iter(self, self.xword_root, hmm_dir, self.tri_mlf, self.tied_list, mix_size, iter, '')
-                    log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+                    hmm_dir = self.mixup('mixup_tri', self.xword_root, hmm_dir, self.tied_list, mix_size)
+                hmm_dir = self.bw_iters('mixup_tri', self.xword_root, hmm_dir, self.tri_mlf, self.tied_list, mix_size, 1, self.tri_iters_per_split)[0]
+            self.set_final_dir('mixup_tri', self.xword_root, hmm_dir)
             log(self.logfh, 'MIXUP TRI finished')
 
-        if self.train_pipeline['align_with_xword']:
+        def align_with_xword_task():
             log(self.logfh, 'XWORD ALIGN started')
             import train_hmm
 
-            align_config = '%s/config.align' %self.xword_root
-            train_hmm.make_hvite_xword_config(self, align_config, 'MFCC_0_D_A_Z')
-            num_gaussians = self.tri_mixup_schedule[-1]
-            iter_num = self.tri_iters_per_split
-            hmm_dir = '%s/HMM-%d-%d' %(self.xword_root, num_gaussians, iter_num)
-            realigned_mlf = '%s/raw_tri_xword_realigned.mlf' %self.misc
+            def realign():
+                align_config = '%s/config.align' %self.xword_root
+                train_hmm.make_hvite_xword_config(self, align_config, 'MFCC_0_D_A_Z')
+                hmm_dir = final('mixup_tri')
+                realigned_mlf = '%s/raw_tri_xword_realigned.mlf' %self.misc
 
-            # Use the original, mfc list that has prons for every word
-            os.system('cp %s/mfc.list.filtered.by.dict %s' %(self.misc, self.mfc_list))
+                # Use the original, mfc list that has prons for every word
+                os.system('cp %s/mfc.list.filtered.by.dict %s' %(self.misc, self.mfc_list))
             
-            align_dir = train_hmm.align(self, self.xword_root, self.mfc_list, hmm_dir, self.word_mlf, realigned_mlf, self.tied_list, self.train_dict, align_config)
-            log(self.logfh, 'aligned with model in [%s], tri mlf [%s]' %(hmm_dir, realigned_mlf))
-
-            # Because of state tying, the triphones in the mlf will only be
-            # valid for this state tying. Strip down to monophones, the
-            # correct triphones will be created later in mono_to_tri
-            train_hmm.map_tri_to_mono(self, align_dir, realigned_mlf, self.phone_mlf)
-            os.system('cp %s %s/phone.mlf.from.xword.align' %(self.phone_mlf, self.misc))
-            os.system('bzip2 -f %s/phone.mlf.from.xword.align' %self.misc)
-            os.system('bzip2 -f %s' %realigned_mlf)
+                align_dir = train_hmm.align(self, self.xword_root, self.mfc_list, hmm_dir, self.word_mlf, realigned_mlf, self.tied_list, self.train_dict, align_config)
+                log(self.logfh, 'aligned with model in [%s], tri mlf [%s]' %(hmm_dir, realigned_mlf))
+
+                # Because of state tying, the triphones in the mlf will only be
+                # valid for this state tying. Strip down to monophones, the
+                # correct triphones will be created later in mono_to_tri
+                train_hmm.map_tri_to_mono(self, align_dir, realigned_mlf, self.phone_mlf)
+                os.system('cp %s %s/phone.mlf.from.xword.align' %(self.phone_mlf, self.misc))
+                os.system('bzip2 -f %s/phone.mlf.from.xword.align' %self.misc)
+                os.system('bzip2 -f %s' %realigned_mlf)
+                return None, None
+            self.step('align_with_xword', 0, 'align', realign)
 
             log(self.logfh, 'XWORD ALIGN finished')
 
 
-        if self.train_pipeline['mono_to_tri_from_xword']:
+        def mono_to_tri_from_xword_task():
             log(self.logfh, 'MONO TO TRI FROM XWORD started')
             import train_hmm
 
             #Assume that midown mono happened?
-            mono_final_dir = '%s/HMM-1-0' %self.mixdown_mono_root
+            mono_final_dir = final('mixdown_mono')
 
-            hmm_dir = train_hmm.mono_to_tri(self, self.xword_1_root, mono_final_dir, self.phone_mlf, self.tri_mlf, self.phone_list, self.tri_list)
-            log(self.logfh, 'initialized triphone models in [%s]' %hmm_dir)
+            def init():
+                hmm_dir = train_hmm.mono_to_tri(self, self.xword_1_root, mono_final_dir, self.phone_mlf, self.tri_mlf, self.phone_list, self.tri_list)
+                log(self.logfh, 'initialized triphone models in [%s]' %hmm_dir)
 
-            os.system('cp %s %s/tri.mlf.from.xword.align' %(self.tri_mlf, self.misc))
-            os.system('bzip2 -f %s/tri.mlf.from.xword.align' %self.misc)
-            os.system('cp %s %s/tri.list.from.xword.align' %(self.tri_list, self.misc))
+                os.system('cp %s %s/tri.mlf.from.xword.align' %(self.tri_mlf, self.misc))
+                os.system('bzip2 -f %s/tri.mlf.from.xword.align' %self.misc)
+                os.system('cp %s %s/tri.list.from.xword.align' %(self.tri_list, self.misc))
 
-            two_model_config = '%s/config.two_model' %self.xword_1_root
-            fh = open(two_model_config, 'w')
-            fh.write('ALIGNMODELMMF = %s/HMM-%d-%d/MMF\n' %(self.xword_root, self.tri_mixup_schedule[-1], self.tri_iters_per_split))
-            fh.write('ALIGNHMMLIST = %s\n' %self.tied_list)
-            fh.close()
+                two_model_config = '%s/config.two_model' %self.xword_1_root
+                fh = open(two_model_config, 'w')
+                fh.write('ALIGNMODELMMF = %s/MMF\n' %final('mixup_tri'))
+                fh.write('ALIGNHMMLIST = %s\n' %self.tied_list)
+                fh.close()
+                return hmm_dir, None
+            hmm_dir = self.step('mono_to_tri_from_xword', 1, 'init', init)[0]
 
             # Do one pass of two-model re-estimation
-            extra = ' -C %s' %two_model_config
-            hmm_dir, k, L = train_hmm.run_iter(self, self.xword_1_root, hmm_dir, self.tri_mlf, self.tri_list, 1, 1, extra)
-            log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+            extra = ' -C %s/config.two_model' %self.xword_1_root
+            hmm_dir = self.bw_iter('mono_to_tri_from_xword', self.xword_1_root, hmm_dir, self.tri_mlf, self.tri_list, 1, 1, extra)
             
             xword_tie_dir = '%s/HMM-1-2' %self.xword_1_root
-            hmm_dir = train_hmm.tie_states_search(self, xword_tie_dir, hmm_dir, self.phone_list, self.tri_list, self.tied_list)
-            log(self.logfh, 'tied states in [%s]' %hmm_dir)
+            def tie(hmm_dir):
+                hmm_dir = train_hmm.tie_states_search(self, xword_tie_dir, hmm_dir, self.phone_list, self.tri_list, self.tied_list)
+                log(self.logfh, 'tied states in [%s]' %hmm_dir)
 
-            os.system('cp %s %s/tied.list.second' %(self.tied_list, self.misc))
+                os.system('cp %s %s/tied.list.second' %(self.tied_list, self.misc))
+                return hmm_dir, None
+            hmm_dir = self.step('mono_to_tri_from_xword', 1, 'tie', tie, hmm_dir)[0]
 
-            hmm_dir = '%s/HMM-1-2' %self.xword_1_root
-            for iter in range(3, self.tri_iters+3):
-                hmm_dir, k, L = train_hmm.run_iter(self, self.xword_1_root, hmm_dir, self.tri_mlf, self.tied_list, 1, iter, '')
-                log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+            hmm_dir = self.bw_iters('mono_to_tri_from_xword', self.xword_1_root, hmm_dir, self.tri_mlf, self.tied_list, 1, 3, self.tri_iters)[0]
+            self.set_final_dir('mono_to_tri_from_xword', self.xword_1_root, hmm_dir)
 
             log(self.logfh, 'MONO TO TRI FROM XWORD finished')
 
-        if self.train_pipeline['mixup_tri_2']:
+        def mixup_tri_2_task():
             log(self.logfh, 'MIXUP TRI 2 started')
-            import train_hmm
 
             ## mixup everything
-            start_gaussians = 1
-            start_iter = self.tri_iters+2
-            hmm_dir = '%s/HMM-%d-%d' %(self.xword_1_root, start_gaussians, start_iter)
+            hmm_dir = final('mono_to_tri_from_xword')
             for mix_size in self.tri_mixup_schedule:
                 if mix_size==2:
-                    hmm_dir = train_hmm.mixup(self, self.xword_1_root, hmm_dir, self.tied_list, mix_size, estimateVarFloor=1)
+                    hmm_dir = self.mixup('mixup_tri_2', self.xword_1_root, hmm_dir, self.tied_list, mix_size, estimateVarFloor=1)
                 else:
-                    hmm_dir = train_hmm.mixup(self, self.xword_1_root, hmm_dir, self.tied_list, mix_size)
-                log(self.logfh, 'mixed up to [%d] in [%s]' %(mix_size, hmm_dir))
-                for iter in range(1, self.tri_iters_per_split+1):
-                    hmm_dir, k, L = train_hmm.run_iter(self, self.xword_1_root, hmm_dir, self.tri_mlf, self.tied_list, mix_size, iter, '')
-                    log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+                    hmm_dir = self.mixup('mixup_tri_2', self.xword_1_root, hmm_dir, self.tied_list, mix_size)
+                hmm_dir = self.bw_iters('mixup_tri_2', self.xword_1_root, hmm_dir, self.tri_mlf, self.tied_list, mix_size, 1, self.tri_iters_per_split)[0]
+            self.set_final_dir('mixup_tri_2', self.xword_1_root, hmm_dir)
             log(self.logfh, 'MIXUP TRI 2 finished')
             
-        if self.train_pipeline['diag']:
+        def diag_task():
             log(self.logfh, 'DIAG started')
             import train_hmm
  
             num_gaussians = self.tri_mixup_schedule[-1]
-            iter_num = self.tri_iters_per_split
 
             if self.train_pipeline['mixup_tri_2']:
-                seed_dir = '%s/HMM-%d-%d' %(self.xword_1_root, num_gaussians, iter_num)
+                seed_dir = final('mixup_tri_2')
             else:
-                seed_dir = '%s/HMM-%d-%d' %(self.xword_root, num_gaussians, iter_num)
-            hmm_dir, L = train_hmm.diagonalize(self, self.diag_root, seed_dir, self.tied_list, self.tri_mlf, num_gaussians)
-            log(self.logfh, 'ran diag in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+                seed_dir = final('mixup_tri')
+            def diagonalize():
+                hmm_dir, L = train_hmm.diagonalize(self, self.diag_root, seed_dir, self.tied_list, self.tri_mlf, num_gaussians)
+                log(self.logfh, 'ran diag in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+                return hmm_dir, L
+            hmm_dir = self.step('diag', num_gaussians, 'diagonalize', diagonalize)[0]
             
-            for iter in range(1, self.tri_iters_per_split+1):
-                hmm_dir, k, L = train_hmm.run_iter(self, self.diag_root, hmm_dir, self.tri_mlf, self.tied_list, num_gaussians, iter, '')
-                log(self.logfh, 'ran an iteration of BW in [%s] lik/fr [%1.4f]' %(hmm_dir, L))
+            hmm_dir = self.bw_iters('diag', self.diag_root, hmm_dir, self.tri_mlf, self.tied_list, num_gaussians, 1, self.tri_iters_per_split)[0]
+            self.set_final_dir('diag', self.diag_root, hmm_dir)
 
             log(self.logfh, 'DIAG finished')
             
-        if self.train_pipeline['mmi']:
-            log(self.logfh, 'DISCRIM started')
-            
-            ## Common items
-            import mmi
-            mmi_dir = '%s/MMI' %self.exp
-            util.create_new_dir(mmi_dir)
-            mfc_list_mmi = '%s/mfc.list' %mmi_dir
-            os.system('cp %s %s' %(self.mfc_list, mfc_list_mmi))
-
+        ## The MMI stage in four tasks: the weak LM only needs the word MLF,
+        ## and the denominator and numerator lattices only need the final
+        ## model, each filtering its own copy of the mfc list
+        mmi_dir = '%s/MMI' %self.exp
+        mfc_list_mmi = '%s/mfc.list' %mmi_dir
+        mfc_list_den = '%s/mfc.list.den' %mmi_dir
+        mfc_list_num = '%s/mfc.list.num' %mmi_dir
+        num_gaussians = self.tri_mixup_schedule[-1]
+        def mmi_model_dir():
+            if self.train_pipeline['diag']: return final('diag')
+            elif self.train_pipeline['mixup_tri_2']: return final('mixup_tri_2')
+            return final('mixup_tri')
+        lattice_dir = '%s/Denom/Lat_word' %mmi_dir
+        pruned_lattice_dir = '%s/Denom/Lat_prune' %mmi_dir
+        phone_lattice_dir = '%s/Denom/Lat_phone' %mmi_dir
+        num_lattice_dir = '%s/Num/Lat_word' %mmi_dir
+        num_phone_lattice_dir = '%s/Num/Lat_phone' %mmi_dir
+        num_phone_lm_lattice_dir = '%s/Num/Lat_phone_lm' %mmi_dir
+
+        def mmi_lm_task():
             ## Create weak LM
             import dict_and_lm
-            train_vocab = '%s/vocab' %self.lm_dir
-            lm_order = 2
-            target_ppl_ratio = 8
-            ppl = dict_and_lm.build_lm_from_mlf(self, self.word_mlf, self.train_dict, train_vocab, self.lm_dir, self.mmi_lm, lm_order, target_ppl_ratio)
-            log(self.logfh, 'wrote lm for mmi [%s] training ppl [%1.2f]' %(self.mmi_lm, ppl))
+            def weak_lm():
+                train_vocab = '%s/vocab' %self.lm_dir
+                lm_order = 2
+                target_ppl_ratio = 8
+                ppl = dict_and_lm.build_lm_from_mlf(self, self.word_mlf, self.train_dict, train_vocab, self.lm_dir, self.mmi_lm, lm_order, target_ppl_ratio)
+                log(self.logfh, 'wrote lm for mmi [%s] training ppl [%1.2f]' %(self.mmi_lm, ppl))
+                return None, None
+            self.step('mmi', num_gaussians, 'lm', weak_lm)
+
+        def mmi_setup_task():
+            log(self.logfh, 'DISCRIM started')
+            def setup():
+                util.create_new_dir(mmi_dir)
+                os.system('cp %s %s' %(self.mfc_list, mfc_list_den))
+                os.system('cp %s %s' %(self.mfc_list, mfc_list_num))
+                return None, None
+            self.step('mmi', num_gaussians, 'setup', setup)
+
+        def mmi_den_task():
+            import mmi
+            model_dir = mmi_model_dir()
 
             ## Create decoding lattices for every utterance
-            lattice_dir = '%s/Denom/Lat_word' %mmi_dir
-            util.create_new_dir(lattice_dir)
-            num_gaussians = self.tri_mixup_schedule[-1]
-            iter_num = self.tri_iters_per_split
-
-            if self.train_pipeline['diag']:
-                model_dir = '%s/HMM-%d-%d' %(self.diag_root, num_gaussians, iter_num)
-            elif self.train_pipeline['mixup_tri_2']:
-                model_dir = '%s/HMM-%d-%d' %(self.xword_1_root, num_gaussians, iter_num)
-            else:
-                model_dir = '%s/HMM-%d-%d' %(self.xword_root, num_gaussians, iter_num)
-            mmi.decode_to_lattices(model, lattice_dir, model_dir, mfc_list_mmi, self.mmi_lm, self.decode_dict,
-                                   self.tied_list, self.word_mlf)
-            log(self.logfh, 'generated training lattices in [%s]' %lattice_dir)
+            def decode():
+                util.create_new_dir(lattice_dir)
+                mmi.decode_to_lattices(self, lattice_dir, model_dir, mfc_list_den, self.mmi_lm, self.decode_dict,
+                                       self.tied_list, self.word_mlf)
+                log(self.logfh, 'generated training lattices in [%s]' %lattice_dir)
+                return None, None
+            self.step('mmi', num_gaussians, 'decode', decode)
 
             ## Prune and determinize lattices
-            pruned_lattice_dir = '%s/Denom/Lat_prune' %mmi_dir
-            util.create_new_dir(pruned_lattice_dir)
-            mmi.prune_lattices(model, lattice_dir, pruned_lattice_dir, self.decode_dict)
-            log(self.logfh, 'pruned lattices in [%s]' %pruned_lattice_dir)
+            def prune():
+                util.create_new_dir(pruned_lattice_dir)
+                mmi.prune_lattices(self, lattice_dir, pruned_lattice_dir, self.decode_dict)
+                log(self.logfh, 'pruned lattices in [%s]' %pruned_lattice_dir)
+                return None, None
+            self.step('mmi', num_gaussians, 'prune', prune)
 
             ## Phone-mark lattices
-            phone_lattice_dir = '%s/Denom/Lat_phone' %mmi_dir
-            util.create_new_dir(phone_lattice_dir)
-            mmi.phonemark_lattices(model, pruned_lattice_dir, phone_lattice_dir, model_dir, mfc_list_mmi,
-                                   self.mmi_lm, self.decode_dict, self.tied_list)
-            log(self.logfh, 'phone-marked lattices in [%s]' %phone_lattice_dir)
+            def phonemark():
+                util.create_new_dir(phone_lattice_dir)
+                mmi.phonemark_lattices(self, pruned_lattice_dir, phone_lattice_dir, model_dir, mfc_list_den,
+                                       self.mmi_lm, self.decode_dict, self.tied_list)
+                log(self.logfh, 'phone-marked lattices in [%s]' %phone_lattice_dir)
+                return None, None
+            self.step('mmi', num_gaussians, 'phonemark', phonemark)
+
+        def mmi_num_task():
+            import mmi
+            model_dir = mmi_model_dir()
 
             ## Create numerator word lattices
-            num_lattice_dir = '%s/Num/Lat_word' %mmi_dir
-            util.create_new_dir(num_lattice_dir)
-            mmi.create_num_lattices(model, num_lattice_dir, self.mmi_lm, self.decode_dict, self.word_mlf)
-            log(self.logfh, 'generated numerator lattices in [%s]' %num_lattice_dir)
+            def num_lattices():
+                util.create_new_dir(num_lattice_dir)
+                mmi.create_num_lattices(self, num_lattice_dir, self.mmi_lm, self.decode_dict, self.word_mlf)
+                log(self.logfh, 'generated numerator lattices in [%s]' %num_lattice_dir)
+                return None, None
+            self.step('mmi', num_gaussians, 'num_lattices', num_lattices)
 
             ## Phone-mark numerator lattices
-            num_phone_lattice_dir = '%s/Num/Lat_phone' %mmi_dir
-            util.create_new_dir(num_phone_lattice_dir)
-            mmi.phonemark_lattices(model, num_lattice_dir, num_phone_lattice_dir, model_dir, mfc_list_mmi,
-                                   self.mmi_lm, self.decode_dict, self.tied_list)
-            log(self.logfh, 'phone-marked numerator lattices in [%s]' %num_phone_lattice_dir)
+            def num_phonemark():
+                util.create_new_dir(num_phone_lattice_dir)
+                mmi.phonemark_lattices(self, num_lattice_dir, num_phone_lattice_dir, model_dir, mfc_list_num,
+                                       self.mmi_lm, self.decode_dict, self.tied_list)
+                log(self.logfh, 'phone-marked numerator lattices in [%s]' %num_phone_lattice_dir)
+                return None, None
+            self.step('mmi', num_gaussians, 'num_phonemark', num_phonemark)
 
             ## Add LM scores to numerator phone lattices
-            num_phone_lm_lattice_dir = '%s/Num/Lat_phone_lm' %mmi_dir
-            util.create_new_dir(num_phone_lm_lattice_dir)
-            mmi.add_lm_lattices(model, num_phone_lattice_dir, num_phone_lm_lattice_dir, self.decode_dict, self.mmi_lm)
-            log(self.logfh, 'added LM scores to numerator lattices in [%s]' %num_phone_lm_lattice_dir)
+            def num_lm():
+                util.create_new_dir(num_phone_lm_lattice_dir)
+                mmi.add_lm_lattices(self, num_phone_lattice_dir, num_phone_lm_lattice_dir, self.decode_dict, self.mmi_lm)
+                log(self.logfh, 'added LM scores to numerator lattices in [%s]' %num_phone_lm_lattice_dir)
+                return None, None
+            self.step('mmi', num_gaussians, 'num_lm', num_lm)
+
+        def mmi_task():
+            import mmi
+
+            ## Train on the utterances with both lattices, in the original order
+            def merge_lists():
+                num_mfcs = set(open(mfc_list_num).read().splitlines())
+                fh = open(mfc_list_mmi, 'w')
+                count = 0
+                for mfc in open(mfc_list_den).read().splitlines():
+                    if mfc not in num_mfcs: continue
+                    fh.write('%s\n' %mfc)
+                    count += 1
+                fh.close()
+                log(self.logfh, 'utterances with both lattices [%d] in [%s]' %(count, mfc_list_mmi))
+                return None, None
+            self.step('mmi', num_gaussians, 'mfc_list', merge_lists)
 
             ## Modified Baum-Welch estimation
             root_dir = '%s/Models' %mmi_dir
-            util.create_new_dir(root_dir)
+            if not self.journal.get('mmi', num_gaussians, 1): util.create_new_dir(root_dir)
             mmi_iters = 12
             mix_size = num_gaussians
-            for iter in range(1, mmi_iters+1):
-                model_dir = mmi.run_iter(model, model_dir, num_phone_lm_lattice_dir, phone_lattice_dir, root_dir,
+            def mmi_iter(model_dir, iter):
+                model_dir = mmi.run_iter(self, model_dir, num_phone_lm_lattice_dir, phone_lattice_dir, root_dir,
                                          self.tied_list, mfc_list_mmi, mix_size, iter)
                 log(self.logfh, 'ran an iteration of Modified BW in [%s]' %model_dir)
+                return model_dir, None
+            hmm_dir = mmi_model_dir()
+            for iter in range(1, mmi_iters+1):
+                hmm_dir = self.step('mmi', mix_size, iter, mmi_iter, hmm_dir, iter)[0]
 
             log(self.logfh, 'DISCRIM finished')
+
+        ## Stages run as a dependency graph: coding and the dictionary/LM
+        ## build are independent, the acoustic stages form a chain after
+        ## both, and MMI's weak LM and lattice branches overlap
+        import scheduler
+        graph = scheduler.Graph()
+        if self.train_pipeline['coding']: graph.add('coding', coding_task)
+        if self.train_pipeline['lm']:
+            graph.add('lm', lm_task)
+            graph.add('lm_list', lm_list_task, ['coding', 'lm'])
+
+        chain = ['coding', 'lm_list']
+        for name, task in [('flat_start', flat_start_task), ('mixup_mono', mixup_mono_task), ('mixdown_mono', mixdown_mono_task),
+                           ('mono_to_tri', mono_to_tri_task), ('mixup_tri', mixup_tri_task), ('align_with_xword', align_with_xword_task),
+                           ('mono_to_tri_from_xword', mono_to_tri_from_xword_task), ('mixup_tri_2', mixup_tri_2_task), ('diag', diag_task)]:
+            if not self.train_pipeline[name]: continue
+            graph.add(name, task, chain)
+            chain = [name]
+
+        if self.train_pipeline['mmi']:
+            graph.add('mmi_lm', mmi_lm_task, ['lm'])
+            graph.add('mmi_setup', mmi_setup_task, chain + ['mmi_lm'])
+            graph.add('mmi_den', mmi_den_task, ['mmi_setup'])
+            graph.add('mmi_num', mmi_num_task, ['mmi_setup'])
+            graph.add('mmi', mmi_task, ['mmi_den', 'mmi_num'])
+
+        graph.run(self.logfh)
             
 if __name__ == '__main__':
 
     from optparse import OptionParser
     usage = 'Usage: Python %s [options] <config>' %sys.argv[0]
     parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--resume', dest='resume', default=False, action='store_true',
+                      help='skip the steps the experiment journal records as done')
     (options, args) = parser.parse_args()
 
     if len(args) < 1:
@@ -491,7 +841,7 @@ if __name__ == '__main__':
     config.read(args[0])
 
     ## Training
-    model = Model(config, options)
+    model = Model(config, options, options.resume)
     start_time = time.time()
     model.train()
     total_time = time.time() - start_time
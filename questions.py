@@ -0,0 +1,88 @@
+"""
+Phonetic questions compiled to bitsets over context phones
+
+A question file has lines like
+    QS "L_Nasal"  {m-*,n-*,ng-*}
+Patterns of the form <phones>-* ask about the left context and *+<phones>
+about the right, where <phones> may itself be a glob. Each question becomes
+a boolean row over left context phone ids and one over right context ids,
+so answering it for many triphones is an indexing operation. Any other kind
+of pattern is kept and matched against model names directly.
+"""
+
+import re, fnmatch
+import numpy
+
+def load_questions(path):
+    """
+    QS lines of a question file: [(name, [patterns])]
+    """
+    questions = []
+    for line in open(path):
+        match = re.match(r'\s*QS\s+["\']?([^"\'\s]+)["\']?\s*\{(.*)\}', line)
+        if not match: continue
+        patterns = [p.strip().strip('"') for p in match.group(2).split(',') if p.strip()]
+        questions.append((match.group(1), patterns))
+    return questions
+
+def split_name(name):
+    """
+    Model name -> (left, center, right); missing contexts are None
+    """
+    left = right = None
+    if '-' in name: left, name = name.split('-', 1)
+    if '+' in name: name, right = name.split('+', 1)
+    return left, name, right
+
+class QuestionSet:
+    """
+    left[q, p] / right[q, p]: question q holds when the left / right
+    context is phone id p. Id len(phones) stands for no context.
+    """
+
+    def __init__(self, question_file, phones):
+        self.questions = load_questions(question_file)
+        self.names = [name for name, patterns in self.questions]
+        self.phones = list(phones)
+        self.phone_ids = dict([(phone, id) for id, phone in enumerate(self.phones)])
+        self.none = len(self.phones)
+
+        nq = len(self.questions)
+        self.left = numpy.zeros((nq, self.none + 1), dtype=bool)
+        self.right = numpy.zeros((nq, self.none + 1), dtype=bool)
+        self.other = [[] for q in range(nq)]
+        for q, (name, patterns) in enumerate(self.questions):
+            for pattern in patterns:
+                if pattern.endswith('-*') and '+' not in pattern:
+                    self.left[q, :self.none] |= self.match_phones(pattern[:-2])
+                elif pattern.startswith('*+') and '-' not in pattern:
+                    self.right[q, :self.none] |= self.match_phones(pattern[2:])
+                else: self.other[q].append(pattern)
+
+    def match_phones(self, pattern):
+        return numpy.array([fnmatch.fnmatchcase(phone, pattern) for phone in self.phones], dtype=bool)
+
+    def __len__(self):
+        return len(self.questions)
+
+    def context_ids(self, names):
+        """
+        Left and right context id arrays for a list of model names
+        """
+        left, right = [], []
+        for name in names:
+            l, c, r = split_name(name)
+            left.append(self.phone_ids.get(l, self.none))
+            right.append(self.phone_ids.get(r, self.none))
+        return numpy.array(left, dtype=numpy.int64), numpy.array(right, dtype=numpy.int64)
+
+    def answers(self, names):
+        """
+        Boolean matrix, questions x names
+        """
+        left, right = self.context_ids(names)
+        masks = self.left[:, left] | self.right[:, right]
+        for q, patterns in enumerate(self.other):
+            for pattern in patterns:
+                masks[q] |= numpy.array([fnmatch.fnmatchcase(name, pattern) for name in names], dtype=bool)
+        return masks
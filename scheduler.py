@@ -0,0 +1,98 @@
+"""
+The training pipeline as a dependency graph of tasks, run on threads
+
+Model.train adds each enabled stage as a task naming the tasks it needs;
+run() starts every task whose dependencies have finished, so independent
+branches overlap: feature coding with the dictionary/MLF/LM build, the
+weak MMI language model with acoustic training, and the numerator with
+the denominator lattices of MMI. The work inside a task still goes through
+util's executors and process pools, which draw on one global set of job
+slots (util.set_job_slots), so overlapping tasks share the allocation
+instead of each taking all of it: a call gets at most an equal share of
+the slots among the running tasks.
+
+Tasks run on threads (the work is in subprocesses and process pools, so
+the GIL is not a bottleneck). When a task fails no new task is started;
+the running ones finish and the first error is raised again.
+"""
+
+import sys, time, threading
+import util
+
+class Task:
+
+    def __init__(self, name, func, deps):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.state = 'waiting'
+        self.secs = 0.0
+
+class Graph:
+
+    def __init__(self):
+        self.tasks = []
+        self.names = {}
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def add(self, name, func, deps=()):
+        """
+        Add a task after the tasks it depends on; dependencies that are not
+        in the graph (disabled stages) are dropped
+        """
+        if name in self.names: raise ValueError('task [%s] added twice' %name)
+        task = Task(name, func, [dep for dep in deps if dep in self.names])
+        self.tasks.append(task)
+        self.names[name] = task
+        return task
+
+    def ready(self):
+        return [task for task in self.tasks if task.state == 'waiting' and
+                not [dep for dep in task.deps if self.names[dep].state != 'done']]
+
+    def run(self, logfh=None):
+        """
+        Run every task, each as soon as its dependencies are done
+        """
+        cond = threading.Condition()
+        errors = []
+
+        def work(task):
+            start_time = time.time()
+            error = None
+            try: task.func()
+            except: error = sys.exc_info()
+            util.task_finished()
+            cond.acquire()
+            try:
+                task.secs = time.time() - start_time
+                if error is None: task.state = 'done'
+                else:
+                    task.state = 'failed'
+                    errors.append(error)
+                cond.notifyAll()
+            finally: cond.release()
+
+        cond.acquire()
+        try:
+            while True:
+                running = [task for task in self.tasks if task.state == 'running']
+                if not errors:
+                    for task in self.ready():
+                        task.state = 'running'
+                        util.task_started()
+                        running.append(task)
+                        if logfh and len(running) > 1:
+                            util.log_write(logfh, 'started task [%s] alongside %s' %(task.name, [t.name for t in running if t is not task]))
+                        thread = threading.Thread(target=work, args=(task,), name=task.name)
+                        thread.setDaemon(True)
+                        thread.start()
+                if not running: break
+                cond.wait(1.0)
+        finally: cond.release()
+
+        if errors: raise errors[0][0], errors[0][1], errors[0][2]
+        waiting = [task.name for task in self.tasks if task.state == 'waiting']
+        if waiting: raise ValueError('tasks never became ready: %s' %waiting)
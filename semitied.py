@@ -0,0 +1,162 @@
+"""
+Semi-tied covariance (STC) estimation in-process, as an alternative to
+HERest -u stw with HADAPT:TRANSKIND = SEMIT
+
+One global transform A is shared by every Gaussian: each keeps a diagonal
+variance in the space of A x. Given the full covariance W_m of each
+Gaussian about its mean (from the full second order sums of the parallel
+accumulators), each outer iteration fixes the diagonal variances
+diag(A W_m A') and forms, for every row i, G_i = sum_m occ_m / var_mi W_m
+as one matrix product over all Gaussians; the inner iterations then update
+the rows in turn (Gales 1999):
+
+    a_i = c_i G_i^-1 sqrt(occ / (c_i G_i^-1 c_i'))
+
+where c_i is row i of the cofactors of A. As with SEMITIED2INPUTXFORM, A
+becomes an input transform stored in the MMF, the means become A mu and
+the variances diag(A W_m A'); weights and transitions are updated as usual
+and means are not re-estimated (-u stw).
+"""
+
+import time
+import numpy
+import mmf, baum_welch
+
+MACRO = 'SEMITIED'
+SEMITIED_ITERS = 20
+XFORM_ITERS = 100
+MIN_OCC = 1e-5
+ROW_TOL = 1e-9
+
+def covariances(acc, means):
+    """
+    Full covariance of each Gaussian about its current mean; zero where
+    there is no occupancy
+    """
+    ok = acc.occ > MIN_OCC
+    occ = acc.occ[ok][:,numpy.newaxis]
+    mu = means[ok]
+    data_mean = acc.first[ok] / occ
+
+    ## Unpack the upper triangle of the full sums into symmetric matrices
+    D = means.shape[1]
+    i, j = numpy.triu_indices(D)
+    full = numpy.zeros((len(mu), D, D))
+    full[:,i,j] = acc.full[ok]
+    full[:,j,i] = acc.full[ok]
+
+    cov = numpy.zeros((len(means), D, D))
+    cov[ok] = full / occ[:,:,numpy.newaxis] \
+              - data_mean[:,:,numpy.newaxis] * mu[:,numpy.newaxis,:] \
+              - mu[:,:,numpy.newaxis] * data_mean[:,numpy.newaxis,:] \
+              + mu[:,:,numpy.newaxis] * mu[:,numpy.newaxis,:]
+    return cov
+
+def diag_vars(A, cov):
+    """
+    diag(A W_m A') for every Gaussian m
+    """
+    return (numpy.dot(cov, A.T) * A.T[numpy.newaxis,:,:]).sum(axis=1)
+
+def auxiliary(occ, A, cov):
+    """
+    Per frame auxiliary function of A with the variances it implies
+    """
+    vars = numpy.maximum(diag_vars(A, cov), 1e-10)
+    log_det = numpy.linalg.slogdet(A)[1]
+    return (occ.sum() * 2 * log_det - numpy.dot(occ, numpy.log(vars).sum(axis=1))) / (2 * occ.sum())
+
+def estimate(occ, cov, iters=SEMITIED_ITERS, row_iters=XFORM_ITERS):
+    """
+    Semi-tied transform of the Gaussians with occupancy occ and full
+    covariances cov. Returns (A, auxiliary value of each iteration, the
+    first being that of the identity).
+    """
+
+    N, D = cov.shape[:2]
+    A = numpy.eye(D)
+    beta = occ.sum()
+    flat = cov.reshape((N, D * D))
+    history = [auxiliary(occ, A, cov)]
+    for iter in range(iters):
+
+        ## Row statistics with the diagonal variances fixed
+        vars = numpy.maximum(diag_vars(A, cov), 1e-10)
+        G = numpy.dot((occ[:,numpy.newaxis] / vars).T, flat).reshape((D, D, D))
+        G_inv = numpy.array([numpy.linalg.inv(G[i]) for i in range(D)])
+
+        for row_iter in range(row_iters):
+            prev = A.copy()
+            for i in range(D):
+                sign = numpy.linalg.slogdet(A)[0]
+                c = sign * numpy.linalg.inv(A)[:,i]
+                c_G = numpy.dot(c, G_inv[i])
+                A[i] = c_G * numpy.sqrt(beta / numpy.dot(c_G, c))
+            if numpy.abs(A - prev).max() < ROW_TOL: break
+        history.append(auxiliary(occ, A, cov))
+    return A, history
+
+def format_xform(A, parm_kind, name=MACRO):
+    """
+    ~j macro of a single block input transform
+    """
+    D = len(A)
+    text  = '~j "%s"\n<MMFIDMASK> *\n<PARAMETERS> %s\n' %(name, parm_kind)
+    text += '<LINXFORM>\n<VECSIZE> %d\n<BLOCKINFO> 1 %d\n<BLOCK> 1\n<XFORM> %d %d\n' %(D, D, D, D)
+    return text + ''.join(['%s\n' %mmf.to_str(row) for row in A])
+
+def set_input_xform(hmmset, text):
+    """
+    Put an input transform macro after the global options, replacing any
+    there already
+    """
+    hmmset.macros = [(kind, item) for kind, item in hmmset.macros if not (kind == 'raw' and item.startswith('~j'))]
+    at = len([kind for kind, item in hmmset.macros if kind == 'raw' and item.startswith('~o')])
+    hmmset.macros.insert(at, ('raw', text))
+
+def update(hmmset, acc, iters=SEMITIED_ITERS, row_iters=XFORM_ITERS):
+    """
+    M-step of a semi-tied pass; returns (A, auxiliary history)
+    """
+    means = hmmset.means.copy()
+    old_vars = hmmset.vars.copy()
+    cov = covariances(acc, means)
+    used = acc.occ > MIN_OCC
+    A, history = estimate(acc.occ[used], cov[used], iters, row_iters)
+
+    ## Weights and transitions; means and variances are replaced below
+    baum_welch.update(hmmset, acc)
+    vars = numpy.dot(old_vars, (A * A).T)
+    vars[used] = diag_vars(A, cov[used])
+    vars = numpy.maximum(vars, 1e-10)
+    hmmset.set_state_sizes(hmmset.num_mixes(), numpy.dot(means, A.T), vars, hmmset.weights)
+    set_input_xform(hmmset, format_xform(A, hmmset.parm_kind))
+    return A, history
+
+def run_iter(model, prev_dir, output_dir, mlf_file, model_list, inputs,
+             prune=(baum_welch.PRUNE_THRESH, baum_welch.PRUNE_INC, baum_welch.PRUNE_LIMIT)):
+    """
+    One semi-tied pass over the mfc list splits in inputs, writing
+    <output_dir>/MMF (with the transform), SEMITIED, stats and herest.log.
+    Returns False, having done nothing, if the model needs HERest.
+    """
+
+    start_time = time.time()
+    hmmset = mmf.load('%s/MMF' %prev_dir)
+    if not baum_welch.supported(hmmset): return False
+    result = baum_welch.accumulate(model, hmmset, '%s/MMF' %prev_dir, output_dir, mlf_file, model_list, inputs, prune, full=True)
+    acc = result[0]
+
+    xform_time = time.time()
+    A, history = update(hmmset, acc)
+    xform_time = time.time() - xform_time
+    hmmset.write('%s/MMF' %output_dir)
+    fh = open('%s/%s' %(output_dir, MACRO), 'w')
+    fh.write(format_xform(A, hmmset.parm_kind))
+    fh.close()
+    baum_welch.write_stats(hmmset, acc, '%s/stats' %output_dir)
+
+    lines = ['Semi-tied transform: %d iterations, auxiliary per frame %f -> %f, %1.2f sec'
+             %(len(history) - 1, history[0], history[-1], xform_time)]
+    baum_welch.write_log('%s/herest.log' %output_dir, acc, start_time, result[1:], lines)
+    return True
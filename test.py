@@ -24,6 +24,8 @@ class Decoder:
         self.local = int(config.get('settings', 'local'))
         self.jobs = int(config.get('settings', 'jobs'))
         self.verbose = int(config.get('settings', 'verbose'))
+        self.executor = util.get_option(config, 'settings', 'executor', model.executor)
+        util.set_executor(self.executor)
 
         ## Load test parameters
         self.beam = int(config.get('test_params', 'beam'))
@@ -37,6 +39,8 @@ class Decoder:
 
         self.model = model
         self.mfc_config = model.mfc_config
+        self.native_front_end = model.native_front_end
+        self.use_archive = model.use_archive
         self.mfc_list = '%s/mfc.list' %self.exp
         self.word_mlf = '%s/words.mlf' %self.exp
         self.phone_mlf = '%s/phones.mlf' %self.exp
@@ -62,7 +66,7 @@ class Decoder:
         if self.test_pipeline['coding']:
             import coding
             coding_dir = '%s/Coding' %self.exp
-            util.create_new_dir(coding_dir)
+            if not os.path.isdir(coding_dir): os.makedirs(coding_dir)
             count = coding.wav_to_mfc(self, coding_dir, self.mfc_list)
             log(self.logfh, 'CODING finished [%d files]' %count)
 
@@ -2,8 +2,19 @@
 Functions for training HMMs: forward-backward, alignments, state-tying, and mixing up
 """
 
-import os, sys
+import os, sys, time
 import util
+import coding
+import mmf
+import baum_welch
+import clustering
+import questions
+import triphones
+import aligner
+import mlf
+import hled
+import hhed
+import semitied
 
 HEREST_CMD = 'HERest'
 #HEREST_CMD = '/u/arlo/bin/fast_htk/v0/HERest'
@@ -17,7 +28,7 @@ def run_iter(model, root_dir, prev_dir, mlf_file, model_list, mix_size, iter, ex
     util.create_new_dir(output_dir)
 
     mfc_list = '%s/mfc.list' %model.exp
-    utts_per_split = max(250, (1 + (model.setup_length / 200)))
+    if model.converge and model.converge_held_out > 0: mfc_list = held_out_split(model, output_dir)[0]
 
     ## HERest parameters
     min_train_examples = 0
@@ -40,53 +51,110 @@ def run_iter(model, root_dir, prev_dir, mlf_file, model_list, mix_size, iter, ex
         cmd += ' -M %s %s >> %s/herest.%s.log' %(output_dir, model_list, output_dir, log_id)
         return cmd
 
-    ## Split up MFC list with unix split
-    cmd = 'split -a 4 -d -l %d %s %s/%s' %(utts_per_split, mfc_list, output_dir, 'mfc.list.')
-    os.system(cmd)
-
-    ## Create the HERest commands
-    cmds = []
-    inputs = os.popen('ls %s/mfc.list.*' %output_dir).read().splitlines()
-    split_num = 0
-    for input in inputs:
-        split_num += 1
-        cmds.append(herest(input, split_num, extra))
-
-    ## Non-parallel case
-    if model.local == 1:
-        for cmd in cmds:
-            print cmd
-            print os.popen(cmd)
-
-    ## Parallel case: one command per line in cmds_file
-    else:
-        cmds_file = '%s/herest.commands' %output_dir
-        fh = open(cmds_file, 'w')
-        for cmd in cmds: fh.write('%s\n' %cmd)
-        fh.close()
-        util.run_parallel(cmds_file, model.jobs, output_dir)
-
-    ## Gather the created .acc files
-    acc_file = '%s/herest.list' %output_dir
-    os.system('ls %s/HER*.acc > %s' %(output_dir, acc_file))
-
-    ## Combine acc files into a new HMM
-    cmd = herest(acc_file, 0, extra)
-    cmd = cmd.split('>>')[0]
-    cmd += ' >> %s/herest.log' %output_dir
-    if model.local == 1: os.system(cmd)
-    else: util.run(cmd, output_dir)
+    ## Split up MFC list into splits with equal numbers of frames
+    inputs = coding.split_mfc_list(model, mfc_list, output_dir)
+
+    ## Native E-step; HERest handles extra configs and models it can't
+    hmmset = None
+    if model.native_herest and not extra:
+        hmmset = baum_welch.run_iter(model, prev_dir, output_dir, mlf_file, model_list, inputs,
+                                     (prune_thresh, prune_inc, prune_limit))
+
+    if hmmset is None:
+        ## Create the HERest commands
+        cmds = []
+        split_num = 0
+        for input in inputs:
+            split_num += 1
+            cmds.append(herest(input, split_num, extra))
+
+        ## Non-parallel case
+        if model.local == 1:
+            for cmd in cmds:
+                print cmd
+                print os.popen(cmd)
+
+        ## Parallel case: one command per line in cmds_file
+        else:
+            cmds_file = '%s/herest.commands' %output_dir
+            fh = open(cmds_file, 'w')
+            for cmd in cmds: fh.write('%s\n' %cmd)
+            fh.close()
+            util.run_parallel(cmds_file, model.jobs, output_dir)
+
+        ## Gather the created .acc files
+        acc_file = '%s/herest.list' %output_dir
+        os.system('ls %s/HER*.acc > %s' %(output_dir, acc_file))
+
+        ## Combine acc files into a new HMM; HTK accumulators can only be
+        ## summed by HERest itself, so this stays one pass
+        merge_time = time.time()
+        cmd = herest(acc_file, 0, extra)
+        cmd = cmd.split('>>')[0]
+        cmd += ' >> %s/herest.log' %output_dir
+        if model.local == 1: os.system(cmd)
+        else: util.run(cmd, output_dir)
+        acc_files = open(acc_file).read().split()
+        util.log_write(model.logfh, ' merged [%d] accumulators, read [%d] bytes in [%1.2f] sec'
+                       %(len(acc_files), util.file_bytes(acc_files), time.time() - merge_time))
 
     ## Clean up
     os.system('rm -f %s/mfc.list.* %s/HER*.acc' %(output_dir, output_dir))
     os.system('bzip2 %s/herest.*.log %s/run-command*.log' %(output_dir, output_dir))
 
-    ## Get a few stats
-    num_models = int(os.popen('grep "<MEAN>" %s/MMF -c' %output_dir).read().strip())
+    ## Get a few stats; HERest's output is only counted, not parsed
+    if hmmset is not None: num_models = hmmset.num_gaussians()
+    else: num_models = mmf.count_gaussians('%s/MMF' %output_dir)
     likelihood = float(os.popen('cat %s/herest.log | grep aver' %output_dir).read().strip().split()[-1])
 
     return output_dir, num_models, likelihood
 
+def held_out_split(model, output_dir):
+    """
+    Write <output_dir>/mfc.list.train, the training mfc list without the
+    held-out utterances; returns (its path, number held out)
+    """
+    held_out = set()
+    if os.path.isfile(model.held_out_list): held_out = set(open(model.held_out_list).read().split())
+    train_list = '%s/mfc.list.train' %output_dir
+    fh = open(train_list, 'w')
+    for mfc in open(model.mfc_list).read().split():
+        if mfc not in held_out: fh.write('%s\n' %mfc)
+    fh.close()
+    return train_list, len(held_out)
+
+def score_held_out(model, hmm_dir, mlf_file, model_list):
+    """
+    Average log prob per frame of the held-out utterances under the model
+    in hmm_dir (an E-step with baum_welch.py); None if there are none or
+    the model needs HERest
+    """
+    if not os.path.isfile(model.held_out_list): return None
+    hmmset = mmf.load('%s/MMF' %hmm_dir)
+    if not baum_welch.supported(hmmset): return None
+    output_dir = '%s/held_out' %hmm_dir
+    util.create_new_dir(output_dir)
+    inputs = coding.split_mfc_list(model, model.held_out_list, output_dir)
+    acc = baum_welch.accumulate(model, hmmset, '%s/MMF' %hmm_dir, output_dir, mlf_file, model_list, inputs,
+                                (baum_welch.PRUNE_THRESH, baum_welch.PRUNE_INC, baum_welch.PRUNE_LIMIT))[0]
+    os.system('rm -rf %s' %output_dir)
+    if acc.frames == 0: return None
+    return acc.log_lik / acc.frames
+
+def run_hhed_native(model, prev_dir, output_dir, hed_file, model_list):
+    """
+    Apply a mixture HHEd script to the model in prev_dir in-process
+    """
+
+    start_time = time.time()
+    hmmset = mmf.load('%s/MMF' %prev_dir)
+    hmmset.hmm_list = mmf.load_hmm_list(model_list)
+    hhed.run(hmmset, hed_file)
+    hmmset.write('%s/MMF' %output_dir)
+    util.log_write(model.logfh, ' native HHEd [%s]: [%d] gaussians in [%1.2f] sec'
+                   %(os.path.basename(hed_file), hmmset.num_gaussians(), time.time() - start_time))
+    return output_dir
+
 def mixup(model, root_dir, prev_dir, model_list, mix_size, estimateVarFloor=0):
     """
     Run HHEd to initialize a mixup to mix_size gaussians
@@ -107,6 +175,9 @@ def mixup(model, root_dir, prev_dir, model_list, mix_size, estimateVarFloor=0):
     fh.write('MU %d {*.state[2-%d].mix}\n' %(mix_size, model.states-1))
     fh.close()
 
+    if model.native_mixup:
+        return run_hhed_native(model, prev_dir, output_dir, mix_hed, model_list)
+
     hhed_log = '%s/hhed_mix.log' %output_dir
 
     cmd  = 'HHEd -A -D -T 1 -H %s/MMF -M %s' %(prev_dir, output_dir)
@@ -137,6 +208,9 @@ def mixdown_mono(model, root_dir, prev_dir, phone_list):
         fh.write('MD 1 {%s.state[2-%d].mix}\n' %(phone, model.states-1))
     fh.close()
 
+    if model.native_mixup:
+        return run_hhed_native(model, prev_dir, output_dir, mixdown_hed, phone_list)
+
     hhed_log = '%s/hhed_mixdown.log' %output_dir
 
     cmd  = 'HHEd -A -D -T 1 -H %s/MMF -M %s' %(prev_dir, output_dir)
@@ -154,7 +228,6 @@ def align(model, root_dir, mfc_list, model_dir, word_mlf, new_mlf, model_list, d
 
     output_dir = '%s/Align' %root_dir
     util.create_new_dir(output_dir)
-    utts_per_split = max(100, (1 + (model.setup_length / 200)))
 
     ## Copy old mfc list
     os.system('cp %s %s/mfc_old.list' %(mfc_list, output_dir))
@@ -162,10 +235,10 @@ def align(model, root_dir, mfc_list, model_dir, word_mlf, new_mlf, model_list, d
     ## HVite parameters
     prune_thresh = 250
 
-    def hvite(input, output):
+    def hvite(input, output, beam):
         #-o SWT 
         cmd  = 'HVite -D -A -T 1 -b silence -a -m -y lab '
-        cmd += '-t %d' %prune_thresh
+        cmd += '-t %d' %beam
         cmd += ' -C %s' %align_config
         cmd += ' -H %s/MMF' %model_dir
         cmd += ' -i %s' %output
@@ -175,49 +248,75 @@ def align(model, root_dir, mfc_list, model_dir, word_mlf, new_mlf, model_list, d
         cmd += ' >> %s.hvite.log' %output
         return cmd
 
-    ## Split up MFC list with unix split
-    cmd = 'split -a 4 -d -l %d %s %s/%s' %(utts_per_split, mfc_list, output_dir, 'mfc.list.')
-    os.system(cmd)
-
-    ## Create the HVite commands
-    cmds = []
-    outputs = []
-    inputs = os.popen('ls %s/mfc.list.*' %output_dir).read().splitlines()
-    for input in inputs:
-        output = input.replace('mfc.list', 'align.output')
-        outputs.append(output)
-        cmds.append(hvite(input, output))
-
-    if model.local == 1:
-        for cmd in cmds:
-            print cmd
-            print os.popen(cmd).read()
-    else:
-        cmds_file = '%s/hvite.commands' %output_dir
-        fh = open(cmds_file, 'w')
-        for cmd in cmds: fh.write('%s\n' %cmd)
+    def align_pass(pass_list, pass_mlf, beam, prefix):
+        """
+        Align the utterances in pass_list with one beam, writing pass_mlf
+        """
+
+        ## Split up MFC list into splits with equal numbers of frames
+        inputs = coding.split_mfc_list(model, pass_list, output_dir, prefix)
+
+        ## Align in-process when the model allows it
+        if model.native_align:
+            native = aligner.run(model, model_dir, inputs, word_mlf, pass_mlf, model_list, dict, align_config, beam)
+            if native is not None:
+                util.log_write(model.logfh, ' native alignment: beam [%d] aligned [%d] failed [%d]' %((beam,) + native))
+                return
+
+        ## Create the HVite commands
+        cmds = []
+        outputs = []
+        for input in inputs:
+            output = input.replace('mfc.list', 'align.output')
+            outputs.append(output)
+            cmds.append(hvite(input, output, beam))
+
+        if model.local == 1:
+            for cmd in cmds:
+                print cmd
+                print os.popen(cmd).read()
+        else:
+            cmds_file = '%s/%shvite.commands' %(output_dir, prefix.replace('mfc.list.', ''))
+            fh = open(cmds_file, 'w')
+            for cmd in cmds: fh.write('%s\n' %cmd)
+            fh.close()
+            util.run_parallel(cmds_file, model.jobs, output_dir)
+
+        ## Merge and fix silences
+        ## TODO: -s file_list
+        merge_sil = '%s/merge_sp_sil.led' %output_dir
+        fh = open(merge_sil, 'w')
+        fh.write('ME sil sp sil\n')
+        fh.write('ME sil sil sil\n')
+        fh.write('ME sp sil sil\n')
         fh.close()
-        util.run_parallel(cmds_file, model.jobs, output_dir)
 
-    ## Merge and fix silences
-    ## TODO: -s file_list
-    merge_sil = '%s/merge_sp_sil.led' %output_dir
-    fh = open(merge_sil, 'w')
-    fh.write('ME sil sp sil\n')
-    fh.write('ME sil sil sil\n')
-    fh.write('ME sp sil sil\n')
-    fh.close()
+        hled.run(model, merge_sil, outputs, pass_mlf, output_dir, '-D')
 
-    cmd = 'HLEd -D -A -T 1 -i %s %s %s >> %s/hled.log' %(new_mlf, merge_sil, ' '.join(outputs), output_dir)
-            
-    if model.local == 1: os.system(cmd)
-    else: util.run(cmd, output_dir)
+    align_pass(mfc_list, new_mlf, prune_thresh, 'mfc.list.')
 
-    ## Prune failed alignments from the mfc list
-    bad_count = 0
-    mlf_labels = os.popen('grep "\.lab" %s' %new_mlf).read().splitlines()
-    mlf_labels = set([os.path.basename(s).split('.')[0] for s in mlf_labels])
+    ## Rerun only the failed utterances, widening the beam each time
+    mlf_labels = set(mlf.utt_ids(new_mlf))
     mfc_labels = open(mfc_list).read().splitlines()
+    for retry, beam in enumerate(model.align_retry_beams):
+        failed = [mfc for mfc in mfc_labels if os.path.basename(mfc).split('.')[0] not in mlf_labels]
+        if not failed: break
+        retry_list = '%s/retry.%d.list' %(output_dir, retry)
+        retry_mlf = '%s/retry.%d.mlf' %(output_dir, retry)
+        fh = open(retry_list, 'w')
+        for mfc in failed: fh.write(mfc + '\n')
+        fh.close()
+        align_pass(retry_list, retry_mlf, beam, 'retry.%d.mfc.list.' %retry)
+
+        ## Add the recovered alignments
+        recovered = set(mlf.utt_ids(retry_mlf))
+        mlf.merge([new_mlf, retry_mlf], '%s.merged' %new_mlf)
+        os.rename('%s.merged' %new_mlf, new_mlf)
+        mlf_labels.update(recovered)
+        util.log_write(model.logfh, 'retried [%d] failed alignments with beam [%d], recovered [%d]' %(len(failed), beam, len(recovered)))
+
+    ## Prune alignments that failed at every beam from the mfc list
+    bad_count = 0
     fh = open(mfc_list, 'w')
     for mfc in mfc_labels:
         id = os.path.basename(mfc).split('.')[0]
@@ -231,7 +330,7 @@ def align(model, root_dir, mfc_list, model_dir, word_mlf, new_mlf, model_list, d
     util.log_write(model.logfh, 'removed alignments [%d]' %bad_count)
 
     ## Clean up
-    os.system('rm -f %s/mfc.list.* %s/align.output.*' %(output_dir, output_dir))
+    os.system('rm -f %s/mfc.list.* %s/align.output.* %s/retry.*' %(output_dir, output_dir, output_dir))
     return output_dir
 
 def map_tri_to_mono(model, root_dir, tri_mlf, mono_mlf):
@@ -239,10 +338,7 @@ def map_tri_to_mono(model, root_dir, tri_mlf, mono_mlf):
     Convert a triphone mlf to monophones to remove artifacts from state tying
     """
     
-    cmd = 'HLEd -b -m -i %s /dev/null %s' %(mono_mlf, tri_mlf)
-
-    if model.local == 1: os.system(cmd)
-    else: util.run(cmd, '%s' %root_dir)
+    hled.run(model, None, [tri_mlf], mono_mlf, root_dir, '-b -m')
 
     return mono_mlf
 
@@ -274,12 +370,7 @@ def mono_to_tri(model, root_dir, mono_dir, phone_mlf, tri_mlf, mono_list, tri_li
     fh.close()
 
     ## Create a new alignment in tri_mlf and output used triphones to tri_list
-    cmd  = 'HLEd -A -n %s' %tri_list
-    cmd += ' -i %s' %tri_mlf
-    cmd += ' %s %s > %s' %(mktri_led, phone_mlf, hled_log)
-
-    if model.local: os.system(cmd)
-    else: util.run(cmd, output_dir)
+    hled.run(model, mktri_led, [phone_mlf], tri_mlf, output_dir, '-n %s' %tri_list, os.path.basename(hled_log), append=False)
 
     ## Create an HHEd script to clone monophones to triphones
     fh = open(mktri_hed, 'w')
@@ -348,18 +439,9 @@ def tie_states(model, output_dir, model_dir, mono_list, tri_list, tied_list):
     ## Create the full list of possible triphones
     phones = open(mono_list).read().splitlines()
     non_sp_phones = [p for p in phones if p not in ['sp', 'sil']]
-
-    fh = open(all_tri_list, 'w')
-    fh.write('sp\n')
-    fh.write('sil\n')
-    for p1 in non_sp_phones:
-        fh.write('sil-%s+sil\n' %p1)
-        for p2 in non_sp_phones:
-            fh.write('sil-%s+%s\n' %(p1, p2))
-            fh.write('%s-%s+sil\n' %(p2, p1))
-            for p3 in non_sp_phones:
-                fh.write('%s-%s+%s\n' %(p2, p1, p3))
-    fh.close()
+    space = triphones.TriphoneSpace(phones, non_sp_phones)
+    if not os.path.isfile(all_tri_list) or os.path.getmtime(all_tri_list) < os.path.getmtime(mono_list):
+        space.write_list(all_tri_list)
 
     ## Set up decision tree clustering
     fh = open(tree_hed, 'w')
@@ -406,17 +488,27 @@ def tie_states_search(model, output_dir, model_dir, mono_list, tri_list, tied_li
     ## Create the full list of possible triphones
     phones = open(mono_list).read().splitlines()
     non_sp_phones = [p for p in phones if p not in ['sp', 'sil']]
-    fh = open(all_tri_list, 'w')
-    fh.write('sp\n')
-    fh.write('sil\n')
-    for p1 in non_sp_phones:
-        fh.write('sil-%s+sil\n' %p1)
-        for p2 in non_sp_phones:
-            fh.write('sil-%s+%s\n' %(p1, p2))
-            fh.write('%s-%s+sil\n' %(p2, p1))
-            for p3 in non_sp_phones:
-                fh.write('%s-%s+%s\n' %(p2, p1, p3))
-    fh.close()
+    space = triphones.TriphoneSpace(phones, non_sp_phones)
+    if not os.path.isfile(all_tri_list) or os.path.getmtime(all_tri_list) < os.path.getmtime(mono_list):
+        space.write_list(all_tri_list)
+
+    ## Native clustering: grow the trees once and read off the tb for the
+    ## target, and the tbs predicting 1% more and fewer states to bracket
+    ## the HHEd search; HHEd still ties the states
+    narrowed = False
+    if model.native_tree:
+        question_set = questions.QuestionSet(model.tree_questions, phones)
+        clusters = clustering.Clustering(mmf.load('%s/MMF' %model_dir), '%s/stats' %model_dir, question_set,
+                                         non_sp_phones, range(1, model.states+1)[1:-1], ro, tb_min)
+        tb, predicted = clusters.tb_for_states(model.triphone_states, tb_min, tb_max)
+        low = clusters.tb_for_states(model.triphone_states * 1.01, tb_min, tb)[0]
+        high = clusters.tb_for_states(model.triphone_states * 0.99, tb, tb_max)[0]
+        clusters.write_trees('%s/trees.native' %output_dir, tb)
+        clusters.write_tied_list('%s/tied.list.native' %output_dir, tb, list(space.names()))
+        util.log_write(model.logfh, ' native clustering predicts [%d] states at tb [%1.2f] bracket [%1.1f %1.1f]' %(predicted, tb, low, high))
+        if low < tb < high:
+            tb_min, tb_max = low, high
+            narrowed = True
 
     ## Search over tb arguments to get the right number states
     num_states = 0
@@ -448,14 +540,19 @@ def tie_states_search(model, output_dir, model_dir, mono_list, tri_list, tied_li
 
         if model.local == 1: os.system(cmd)
         else: util.run(cmd, output_dir)
-        num_states = int(os.popen('grep -c "<MEAN>" %s/MMF' %output_dir).read().strip())
+        num_states = mmf.count_gaussians('%s/MMF' %output_dir)
 
         
         if abs(float(num_states - model.triphone_states)/model.triphone_states) <= 0.01:
             util.log_write(model.logfh, ' current states [%d] tb [%1.2f]' %(num_states, tb))
             break
         
-        if abs(prev_tb - tb) <= 0.01:
+        ## HHEd's count fell outside the native bracket: reopen it
+        if abs(prev_tb - tb) <= 0.01 and narrowed:
+            tb_min, tb_max = 100.0, 10000.0
+            narrowed = False
+            util.log_write(model.logfh, ' states [%d] outside the native bracket, widening to [%1.1f %1.1f]' %(num_states, tb_min, tb_max))
+        elif abs(prev_tb - tb) <= 0.01:
             util.log_write(model.logfh, ' Could not converge. Stopping. Current states [%d] tb [%1.2f]' %(num_states,tb))
             break
         
@@ -489,8 +586,8 @@ def diagonalize(model, output_dir, model_dir, model_list, mlf_file, mix_size):
     fh.write('HADAPT:USEBIAS = FALSE\n')
     fh.write('HADAPT:BASECLASS = global\n')
     fh.write('HADAPT:SPLITTHRESH = 0.0\n')
-    fh.write('HADAPT:MAXXFORMITER = 100\n')
-    fh.write('HADAPT:MAXSEMITIEDITER = 20\n')
+    fh.write('HADAPT:MAXXFORMITER = %d\n' %semitied.XFORM_ITERS)
+    fh.write('HADAPT:MAXSEMITIEDITER = %d\n' %semitied.SEMITIED_ITERS)
     fh.write('HADAPT:TRACE = 61\n')
     fh.write('HMODEL:TRACE = 512\n')
     fh.write('HADAPT: SEMITIED2INPUTXFORM = TRUE\n')
@@ -505,6 +602,18 @@ def diagonalize(model, output_dir, model_dir, model_list, mlf_file, mix_size):
     fh.write('<CLASS> 1 {*.state[2-4].mix[1-%d]}\n' %max_mix)
     fh.close()
 
+    ## Native semi-tied estimation, from full covariance accumulators
+    if model.native_semitied:
+        hmm_dir = '%s/HMM-%d-0' %(output_dir, mix_size)
+        util.create_new_dir(hmm_dir)
+        mfc_list = '%s/mfc.list' %model.exp
+        if model.converge and model.converge_held_out > 0: mfc_list = held_out_split(model, hmm_dir)[0]
+        inputs = coding.split_mfc_list(model, mfc_list, hmm_dir)
+        if semitied.run_iter(model, model_dir, hmm_dir, mlf_file, model_list, inputs):
+            os.system('rm -f %s/mfc.list.*' %hmm_dir)
+            likelihood = float(os.popen('cat %s/herest.log | grep aver' %hmm_dir).read().strip().split()[-1])
+            return hmm_dir, likelihood
+
     extra = ' -C %s -J %s -K %s/HMM-%d-0 -u stw' %(diag_config, output_dir, output_dir, mix_size)
 
     hmm_dir, k, likelihood = run_iter(model, output_dir, model_dir, mlf_file, model_list, mix_size, 0, extra)
@@ -0,0 +1,65 @@
+"""
+The space of possible triphones, as integer codes
+
+A triphone l-c+r is coded as (l * P + c) * P + r over the ids of the P
+phones in the phone list. The space is every center phone in every context
+of center phones or the boundary phone (sil), plus a few monophones (sp and
+sil). Enumeration is an array operation, and the text list HHEd's AU
+command reads is streamed out only when it is needed.
+"""
+
+import numpy
+
+class TriphoneSpace:
+
+    def __init__(self, phones, centers, boundary='sil', monophones=('sp', 'sil')):
+        self.phones = list(phones)
+        self.phone_ids = dict([(phone, id) for id, phone in enumerate(self.phones)])
+        self.size = len(self.phones)
+        self.centers = numpy.array([self.phone_ids[p] for p in centers], dtype=numpy.int64)
+        self.boundary = self.phone_ids[boundary]
+        self.monophones = list(monophones)
+
+    def __len__(self):
+        K = len(self.centers)
+        return len(self.monophones) + K * (1 + K * (K + 2))
+
+    def encode(self, left, center, right):
+        return (numpy.asarray(left) * self.size + center) * self.size + right
+
+    def decode(self, codes):
+        codes = numpy.asarray(codes)
+        return codes / (self.size * self.size), (codes / self.size) % self.size, codes % self.size
+
+    def name(self, code):
+        left, center, right = self.decode(code)
+        return '%s-%s+%s' %(self.phones[left], self.phones[center], self.phones[right])
+
+    def center_codes(self, center):
+        """
+        Codes of all triphones of one center phone, in all_tri.list order:
+        b-c+b, then for each context l: b-c+l, l-c+b, l-c+r for every r
+        """
+        K = len(self.centers)
+        b = self.boundary
+        rows = numpy.empty((K, K + 2), dtype=numpy.int64)
+        rows[:,0] = self.encode(b, center, self.centers)
+        rows[:,1] = self.encode(self.centers, center, b)
+        rows[:,2:] = self.encode(self.centers[:,numpy.newaxis], center, self.centers[numpy.newaxis,:])
+        return numpy.concatenate([[self.encode(b, center, b)], rows.ravel()])
+
+    def codes(self):
+        return numpy.concatenate([self.center_codes(c) for c in self.centers])
+
+    def names(self):
+        """
+        Every model name in all_tri.list order (a generator)
+        """
+        for phone in self.monophones: yield phone
+        for center in self.centers:
+            for code in self.center_codes(center): yield self.name(code)
+
+    def write_list(self, path):
+        fh = open(path, 'w')
+        for name in self.names(): fh.write('%s\n' %name)
+        fh.close()
@@ -2,26 +2,231 @@
 General utilities
 """
 
-import os, sys, time, re, gzip, cPickle
+import os, sys, time, re, gzip, cPickle, subprocess, threading
 
 attr = ''
 #attr += ' -attr \!squid7 -attr \!squid8 -attr \!squid9 -attr \!squid6 -attr \!squid5'
 #attr += ' -attr Dual-Core-AMD-Opteron-Processor-875'
 #attr +=  '-attr Intel-Xeon-X5550-@-2.67GHz'
 
-def run(cmd, log_dir, my_attr=None):
+## Backend used by run and run_parallel; see set_executor
+executor = 'run-command'
+
+## Job slots shared by everything running at once; see set_job_slots
+job_slots = None
+
+class JobSlots:
+   """
+   A fixed number of job slots shared by concurrently running pipeline
+   tasks. Each parallel call takes as many free slots as it can use, up to
+   a fair share of the total among the running tasks (at least one,
+   waiting until one is free), and sizes its pool to match.
+   """
+   def __init__(self, total):
+      self.total = total
+      self.free = total
+      self.tasks = 0
+      self.cond = threading.Condition()
+
+   def take(self, wanted):
+      self.cond.acquire()
+      try:
+         while self.free == 0: self.cond.wait(1.0)
+         share = self.total / max(1, self.tasks)
+         n = max(1, min(wanted, self.free, share))
+         self.free -= n
+         return n
+      finally: self.cond.release()
+
+   def add_tasks(self, n):
+      self.cond.acquire()
+      try: self.tasks += n
+      finally: self.cond.release()
+
+   def give(self, n):
+      self.cond.acquire()
+      try:
+         self.free += n
+         self.cond.notifyAll()
+      finally: self.cond.release()
+
+def set_job_slots(total):
+   """
+   Share total job slots among all executors and process pools (0 for no
+   limit beyond each call's own njobs)
+   """
+   global job_slots
+   job_slots = None
+   if total > 0: job_slots = JobSlots(total)
+
+def take_slots(wanted):
+   if job_slots is None: return wanted
+   return job_slots.take(wanted)
+
+def give_slots(n):
+   if job_slots is not None: job_slots.give(n)
+
+def task_started():
+   """
+   Count a pipeline task as running, for the fair share of job slots
+   """
+   if job_slots is not None: job_slots.add_tasks(1)
+
+def task_finished():
+   if job_slots is not None: job_slots.add_tasks(-1)
+
+class JobResult:
+   """
+   Outcome of a single command run by an executor
+   """
+   def __init__(self, cmd, returncode, stdout='', stderr='', secs=0.0):
+      self.cmd = cmd
+      self.returncode = returncode
+      self.stdout = stdout
+      self.stderr = stderr
+      self.secs = secs
+
+class ParallelResult:
+   """
+   Outcome of a run_parallel call: the log path and one JobResult per command
+   (the run-command backend only knows the overall exit status)
+   """
+   def __init__(self, log, jobs, returncode=0):
+      self.log = log
+      self.jobs = jobs
+      self.returncode = returncode
+
+   def failed(self):
+      return [job for job in self.jobs if job.returncode != 0]
+
+   def ok(self):
+      return self.returncode == 0 and not self.failed()
+
+def run_command_single(cmd, log_dir, my_attr=None):
    if my_attr == None: my_attr = attr
    rc_log = '%s/run-command_single.log' %log_dir
-   os.system('run-command %s -attr noevict -log %s "%s"' %(my_attr, rc_log, cmd))
+   take_slots(1)
+   try: os.system('run-command %s -attr noevict -log %s "%s"' %(my_attr, rc_log, cmd))
+   finally: give_slots(1)
    return rc_log
 
-def run_parallel(path, njobs, log_dir, my_attr=None):
+def run_command_parallel(path, njobs, log_dir, my_attr=None):
    if my_attr == None: my_attr = attr
    rc_log = '%s/run-command.log' %log_dir
-   cmd = 'run-command %s -attr noevict -J %d -f %s -log %s' %(my_attr, njobs, path, rc_log)
-   #print cmd
-   os.system(cmd)
+   njobs = take_slots(njobs)
+   try:
+      cmd = 'run-command %s -attr noevict -J %d -f %s -log %s' %(my_attr, njobs, path, rc_log)
+      #print cmd
+      status = os.system(cmd)
+   finally: give_slots(njobs)
+   return ParallelResult(rc_log, [], status)
+
+def run_job(cmd):
+   """
+   Run a shell command, capturing its exit code and output
+   """
+   start_time = time.time()
+   p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+   stdout, stderr = p.communicate()
+   return JobResult(cmd, p.returncode, stdout, stderr, time.time() - start_time)
+
+def get_num_workers(njobs):
+   import multiprocessing
+   if njobs <= 0: return multiprocessing.cpu_count()
+   return njobs
+
+def run_local_single(cmd, log_dir, my_attr=None):
+   rc_log = '%s/run-command_single.log' %log_dir
+   take_slots(1)
+   try: job = run_job(cmd)
+   finally: give_slots(1)
+   fh = open(rc_log, 'w')
+   fh.write(job.stdout)
+   fh.write(job.stderr)
+   fh.close()
    return rc_log
+
+def run_local_parallel(path, njobs, log_dir, my_attr=None):
+   """
+   Run each line of <path> as a shell command on a pool of njobs local
+   workers (all cores if njobs <= 0). Each job's stdout/stderr goes to
+   run-command.<n>.log, and a summary of exit codes to run-command.log
+   """
+   from multiprocessing.pool import ThreadPool
+
+   cmds = [cmd for cmd in open(path).read().splitlines() if cmd.strip()]
+   rc_log = '%s/run-command.log' %log_dir
+   nworkers = take_slots(max(1, min(get_num_workers(njobs), len(cmds))))
+   pool = ThreadPool(nworkers)
+   try: jobs = pool.map(run_job, cmds, 1)
+   finally:
+      pool.close()
+      pool.join()
+      give_slots(nworkers)
+
+   fh = open(rc_log, 'w')
+   for index, job in enumerate(jobs):
+      fh.write('job [%d] exit [%d] secs [%1.2f] %s\n' %(index, job.returncode, job.secs, job.cmd))
+      if job.stdout or job.stderr:
+         job_fh = open('%s/run-command.%d.log' %(log_dir, index), 'w')
+         job_fh.write(job.stdout)
+         job_fh.write(job.stderr)
+         job_fh.close()
+   fh.close()
+
+   result = ParallelResult(rc_log, jobs)
+   for job in result.failed():
+      sys.stderr.write('job failed [%d] %s\n' %(job.returncode, job.cmd))
+   return result
+
+def map_parallel(func, args, njobs):
+   """
+   Apply a module-level function to each item of args on a pool of njobs
+   local processes (all cores if njobs <= 0), or fewer if other tasks hold
+   job slots; a single worker runs in-process
+   """
+   import multiprocessing
+   nworkers = take_slots(max(1, min(get_num_workers(njobs), len(args))))
+   try:
+      if nworkers == 1: return map(func, args)
+      pool = multiprocessing.Pool(nworkers)
+      try: results = pool.map(func, args, 1)
+      finally:
+         pool.close()
+         pool.join()
+   finally: give_slots(nworkers)
+   return results
+
+## Available backends: name -> (single command runner, command file runner)
+executors = {'run-command': (run_command_single, run_command_parallel),
+             'local': (run_local_single, run_local_parallel)}
+
+def set_executor(name):
+   if name not in executors:
+      raise ValueError('unknown executor [%s], choose from %s' %(name, sorted(executors.keys())))
+   global executor
+   executor = name
+
+def run(cmd, log_dir, my_attr=None):
+   return executors[executor][0](cmd, log_dir, my_attr)
+
+def run_parallel(path, njobs, log_dir, my_attr=None):
+   return executors[executor][1](path, njobs, log_dir, my_attr)
+
+def file_bytes(paths):
+   """
+   Total size of a list of files (missing files count as 0)
+   """
+   return sum([os.path.getsize(path) for path in paths if os.path.isfile(path)])
+
+def get_option(config, section, option, default):
+   """
+   Read an optional config value, converted to the type of <default>
+   """
+   if not config.has_option(section, option): return default
+   value = config.get(section, option)
+   if default is None: return value
+   return type(default)(value)
    
 def save_pickle(data, path):
     print 'saving: %s' %path
@@ -63,6 +268,23 @@ def get_files(path, pattern):
 
    return L
 
+def split_by_weight(items, weights, nsplits):
+   """
+   Partition items into at most nsplits groups of roughly equal total
+   weight: heaviest item first into the currently lightest group. Each
+   group keeps the original item order.
+   """
+   import heapq
+   nsplits = max(1, min(nsplits, len(items)))
+   heap = [(0, index) for index in range(nsplits)]
+   groups = [[] for index in range(nsplits)]
+   order = sorted(range(len(items)), key=lambda i: weights[i], reverse=True)
+   for i in order:
+      total, index = heapq.heappop(heap)
+      groups[index].append(i)
+      heapq.heappush(heap, (total + weights[i], index))
+   return [[items[i] for i in sorted(group)] for group in groups if group]
+
 def create_new_dir(dir):
    os.system('rm -rf %s' %dir)
    os.makedirs(dir)